@@ -1,6 +1,89 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator as DjangoPaginator
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+MAX_PAGE_SIZE = 500
+APPROXIMATE_COUNT_TIMEOUT = 60  # seconds
+
+
+class CachedCountPaginator(DjangoPaginator):
+    """Paginator whose COUNT(*) is cached briefly per query, so totals may lag slightly."""
+
+    @cached_property
+    def count(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except (AttributeError, EmptyResultSet):
+            return super().count
+        digest = hashlib.md5(f'{sql}|{params!r}'.encode('utf-8')).hexdigest()
+        key = f'pagination:count:{digest}'
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, APPROXIMATE_COUNT_TIMEOUT)
+        return count
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination over the view's ``cursor_ordering`` (a timestamp then id).
+
+    Pages cost the same however deep the client goes and no COUNT(*) is run.
+    """
+    page_size = 100
+    page_size_query_param = 'per_page'
+    max_page_size = MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        return tuple(view.cursor_ordering)
+
 
 class CustomPageNumberPagination(PageNumberPagination):
     page_size = 100 # Default page size
     page_size_query_param = 'per_page'  # Query parameter for custom page size
-    max_page_size = 100000  # Maximum allowed page size
\ No newline at end of file
+    max_page_size = MAX_PAGE_SIZE  # Maximum allowed page size
+    # ?approx_count=true serves a briefly cached total instead of a fresh COUNT(*)
+    approximate_count_query_param = 'approx_count'
+    # ?pagination=cursor switches views that define ``cursor_ordering`` to keyset pages
+    mode_query_param = 'pagination'
+    cursor_query_param = 'cursor'
+
+    cursor_paginator = None
+    approximate_count = False
+
+    def use_cursor(self, request, view):
+        if not getattr(view, 'cursor_ordering', None):
+            return False
+        return (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or self.cursor_query_param in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_cursor(request, view):
+            self.cursor_paginator = KeysetCursorPagination()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+
+        self.approximate_count = request.query_params.get(
+            self.approximate_count_query_param, ''
+        ).lower() in ('1', 'true', 'yes')
+        if self.approximate_count:
+            self.django_paginator_class = CachedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        response = super().get_paginated_response(data)
+        if self.approximate_count:
+            response.data['count_is_approximate'] = True
+        return response
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
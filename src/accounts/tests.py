@@ -1,6 +1,12 @@
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from accounts.pagination import MAX_PAGE_SIZE, CustomPageNumberPagination
 
 from accounts.models import User
 from products.models import Product, Pill, PillItem
@@ -92,3 +98,47 @@ class UserOrdersTests(APITestCase):
 	def test_authentication_required_for_orders(self):
 		response = self.client.get(self.url)
 		self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PaginationTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.admin = User.objects.create_superuser(
+			username='admin',
+			password='adminpass',
+			email='admin@example.com'
+		)
+		for index in range(5):
+			User.objects.create_user(username=f'student{index}', password='pass1234', name=f'Student {index}')
+		self.client.force_authenticate(user=self.admin)
+		self.url = reverse('accounts:dashboard-users-list')
+
+	def test_page_size_is_capped(self):
+		request = Request(APIRequestFactory().get('/', {'per_page': 100000}))
+		self.assertEqual(CustomPageNumberPagination().get_page_size(request), MAX_PAGE_SIZE)
+
+	def test_cursor_mode_walks_pages_without_count(self):
+		seen = []
+		url = f'{self.url}?pagination=cursor&per_page=2'
+		while url:
+			with CaptureQueriesContext(connection) as queries:
+				response = self.client.get(url)
+			self.assertEqual(response.status_code, status.HTTP_200_OK)
+			self.assertNotIn('count', response.data)
+			self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+			seen.extend(user['username'] for user in response.data['results'])
+			url = response.data['next']
+
+		self.assertEqual(sorted(seen), [f'student{index}' for index in range(5)])
+
+	def test_approximate_count_is_cached(self):
+		first = self.client.get(self.url, {'approx_count': 'true'})
+		self.assertEqual(first.data['count'], 5)
+		self.assertTrue(first.data['count_is_approximate'])
+
+		User.objects.create_user(username='late', password='pass1234', name='Late')
+		with CaptureQueriesContext(connection) as queries:
+			second = self.client.get(self.url, {'approx_count': 'true'})
+		self.assertEqual(second.data['count'], 5)
+		self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+		self.assertEqual(self.client.get(self.url).data['count'], 6)
@@ -1,9 +1,8 @@
 
 import json
-import requests
 from django.conf import settings
 
-import requests
+from services import http_client
 
 def send_whatsapp_massage(phone_number, massage):
     url = "https://whats.easytech-sotfware.com/api/v1/send-text"
@@ -15,7 +14,8 @@ def send_whatsapp_massage(phone_number, massage):
             "jid": f"2{phone_number}@s.whatsapp.net"
         }
     
-    req = requests.get(url, params=params)
+    # send-text sends on GET: a read timeout must not deliver the message twice
+    req = http_client.get(url, params=params, idempotent=False)
     
     return req.json()
 
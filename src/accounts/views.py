@@ -321,7 +321,7 @@ class UserOrdersView(generics.ListAPIView):
             .prefetch_related(
                 Prefetch(
                     'items',
-                    queryset=PillItem.objects.select_related('product', 'product__teacher')
+                    queryset=PillItem.objects.select_related('product', 'product__teacher', 'product__cover_image')
                 )
             )
             .order_by('-date_added')
@@ -488,6 +488,7 @@ class UsersListView(generics.ListAPIView):
     ordering_fields = ['created_at']
     search_fields = ['username', 'name', 'email', 'government']
     filterset_class = AdminUserFilter
+    cursor_ordering = ('-created_at', '-id')
 
     def get_queryset(self):
         return User.objects.filter(is_staff=False, is_superuser=False).order_by('-created_at')
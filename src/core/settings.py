@@ -158,6 +158,16 @@ EMAIL_HOST_PASSWORD = 'meczfpooichwkudl'
 #     }
 # }
 
+# Catalog/library versions, cached responses and ETags must be shared by every worker,
+# so production should point this at Redis (the default local-memory cache is per process)
+if os.getenv('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL'),
+        }
+    }
+
 
 #^ < ==========================REST FRAMEWORK SETTINGS========================== >
 
@@ -322,3 +332,41 @@ UPLOAD_DOMAIN = "easy.easy-stream.net"
 USE_UPLOAD_SUBDOMAIN_FOR_LARGE_FILES = True
 LARGE_FILE_THRESHOLD = 50 * 1024 * 1024  # 50 MB
 
+
+
+# ^ < ==========================CATALOG CONFIG========================== >
+
+# Rotate the product cover among its images once a day instead of always using the stored cover
+PRODUCT_COVER_DAILY_ROTATION = os.getenv('PRODUCT_COVER_DAILY_ROTATION', 'False').lower() == 'true'
+
+# 0-999, unique per worker process; derived from host name + pid when unset
+PILL_NUMBER_WORKER_ID = os.getenv('PILL_NUMBER_WORKER_ID')
+
+# Coupons with at least this many uses count them in sharded rows (see products.coupons)
+COUPON_SHARDING_THRESHOLD = int(os.getenv('COUPON_SHARDING_THRESHOLD', '100'))
+COUPON_COUNTER_SHARDS = int(os.getenv('COUPON_COUNTER_SHARDS', '16'))
+
+# Unpaid ('initiated') pills older than this are removed by reap_initiated_pills
+STALE_PILL_DAYS = int(os.getenv('STALE_PILL_DAYS', '30'))
+
+# A running background job that has not reported progress for this long lost its worker and is run again
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', str(15 * 60)))
+
+
+# ^ < ==========================OUTBOUND HTTP CONFIG========================== >
+
+# Pooled keep-alive transport shared by the payment gateways and messaging APIs (see services.http_client)
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+
+# Per-gateway circuit breakers (see services.circuit_breaker): open after CIRCUIT_MIN_CALLS failures
+# at CIRCUIT_FAILURE_RATE within CIRCUIT_WINDOW_SECONDS, fail fast for CIRCUIT_COOLDOWN_SECONDS, then probe
+CIRCUIT_WINDOW_SECONDS = int(os.getenv('CIRCUIT_WINDOW_SECONDS', '60'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_COOLDOWN_SECONDS = int(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '30'))
+
+# While the active gateway's circuit is open, create invoices with the other configured gateway
+PAYMENT_GATEWAY_FAILOVER = os.getenv('PAYMENT_GATEWAY_FAILOVER', 'True').lower() == 'true'
@@ -6,7 +6,8 @@ from django.http import HttpResponse
 from .models import (
     Category, SubCategory, Subject, Teacher, Product, ProductImage, ProductDescription,
     PillItem, Pill, CouponDiscount, Rating, Discount, LovedProduct,
-    SpecialProduct, BestProduct, PurchasedBook
+    SpecialProduct, BestProduct, PurchasedBook, BackgroundJob, CouponRedemption, ArchivedPill,
+    WebhookInboxEntry, PaymentReference
 )
 
 import json
@@ -130,10 +131,8 @@ class FinalPriceListFilter(admin.SimpleListFilter):
         if value:
             try:
                 max_price = float(value)
-                # Filter pills with final_price <= max_price
-                return queryset.filter(id__in=[
-                    pill.id for pill in queryset if pill.final_price() is not None and pill.final_price() <= max_price
-                ])
+                # Filter on the stored order total (see Pill.freeze_totals)
+                return queryset.filter(total__lte=max_price)
             except Exception:
                 return queryset
         return queryset
@@ -173,7 +172,7 @@ class PillAdmin(admin.ModelAdmin):
     def final_price_display(self, obj):
         return obj.final_price()
     final_price_display.short_description = 'Final Price'
-    final_price_display.admin_order_field = None
+    final_price_display.admin_order_field = 'total'
 
     def stock_problem_status(self, obj):
         """Display stock problem status"""
@@ -328,26 +327,9 @@ class PillAdmin(admin.ModelAdmin):
                         error_rows.append((pill.pill_number, "Address relation empty"))
                         continue
                         
-                    # Get pill items - try both relationships
-                    pill_items = None
-                    items_count = 0
-                    
-                    # Try many-to-many first
-                    try:
-                        pill_items = pill.items.all()
-                        items_count = pill_items.count()
-                        print(f"Found {items_count} items via M2M relationship")
-                    except Exception as e:
-                        print(f"M2M items failed: {e}")
-                    
-                    # If M2M didn't work or returned 0, try reverse FK
-                    if not pill_items or items_count == 0:
-                        try:
-                            pill_items = pill.pill_items.all()
-                            items_count = pill_items.count()
-                            print(f"Found {items_count} items via reverse FK relationship")
-                        except Exception as e:
-                            print(f"Reverse FK items failed: {e}")
+                    # Get pill items
+                    pill_items = pill.items.all()
+                    items_count = pill_items.count()
                     
                     # Skip pills with no items
                     if not pill_items or items_count == 0:
@@ -614,6 +596,12 @@ class CouponDiscountAdmin(admin.ModelAdmin):
     readonly_fields = ('coupon',)
     autocomplete_fields = ['user']
 
+@admin.register(CouponRedemption)
+class CouponRedemptionAdmin(admin.ModelAdmin):
+    list_display = ('coupon', 'pill', 'user', 'shard', 'created_at')
+    search_fields = ('coupon__coupon', 'pill__pill_number', 'user__username')
+    raw_id_fields = ('coupon', 'pill', 'user')
+
 @admin.register(Rating)
 class RatingAdmin(admin.ModelAdmin):
     list_display = ('product', 'user', 'star_number', 'date_added')
@@ -649,6 +637,37 @@ class PurchasedBookAdmin(admin.ModelAdmin):
     search_fields = ('product_name', 'user__username', 'user__name', 'pill__pill_number')
 
 
+@admin.register(ArchivedPill)
+class ArchivedPillAdmin(admin.ModelAdmin):
+    list_display = ('pill_number', 'user', 'status', 'total', 'date_added', 'archived_at')
+    search_fields = ('pill_number', 'user__username', 'user__name')
+    raw_id_fields = ('user',)
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'processed', 'total', 'attempts', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'started_at', 'finished_at')
+
+
+@admin.register(PaymentReference)
+class PaymentReferenceAdmin(admin.ModelAdmin):
+    list_display = ('value', 'gateway', 'kind', 'pill', 'created_at')
+    list_filter = ('gateway', 'kind')
+    search_fields = ('=value',)
+    raw_id_fields = ('pill',)
+
+
+@admin.register(WebhookInboxEntry)
+class WebhookInboxEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'gateway', 'reference', 'event_status', 'status', 'pill', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('gateway', 'status', 'event_status')
+    search_fields = ('reference', 'pill__pill_number')
+    raw_id_fields = ('pill',)
+    readonly_fields = ('received_at', 'processed_at')
+
+
 
 
 admin.site.register(ProductImage)
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from .search import create_search_index
+        from .signals import connect_catalog_signals
+        from . import assignments, invoices  # noqa: F401  registers the job handlers
+        connect_catalog_signals()
+        post_migrate.connect(create_search_index, sender=self)
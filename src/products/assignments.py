@@ -0,0 +1,95 @@
+"""
+Cohort book assignment: grant a list of books to many students at once.
+
+Runs as the ``assign_books`` background job (see ``products.jobs``). Students
+are selected by a user filter (year, division, government, user type) or an
+explicit list of ids / phone numbers, walked in id order one chunk at a time.
+Per chunk, the books they already own are read in one query and the missing
+``PurchasedBook`` rows are inserted in one transaction, then progress is
+reported. ``created`` counts the rows actually inserted (owned pairs after
+the insert minus before), so re-runs and overlapping cohorts report no
+grants that never happened.
+"""
+from django.db import transaction
+
+from accounts.models import User
+
+from .caching import bump_library_version
+from .jobs import register, report_progress
+from .models import Product, PurchasedBook
+
+ASSIGN_BOOKS_JOB = 'assign_books'
+USER_FILTER_FIELDS = ('year', 'division', 'government', 'user_type')
+CHUNK_SIZE = 1000
+
+
+def cohort_queryset(payload):
+    users = User.objects.filter(is_active=True)
+    if payload.get('user_ids') or payload.get('phones'):
+        selected = User.objects.none()
+        if payload.get('user_ids'):
+            selected = selected | users.filter(pk__in=payload['user_ids'])
+        if payload.get('phones'):
+            selected = selected | users.filter(username__in=payload['phones'])
+        users = selected
+    filters = {field: value for field, value in (payload.get('user_filter') or {}).items() if field in USER_FILTER_FIELDS}
+    return users.filter(**filters)
+
+
+@register(ASSIGN_BOOKS_JOB)
+def assign_books(job, chunk_size=CHUNK_SIZE):
+    payload = job.payload
+    products = dict(Product.objects.filter(pk__in=payload['product_ids']).values_list('pk', 'name'))
+    users = cohort_queryset(payload)
+    total = users.count()
+    report_progress(job, 0, total)
+
+    processed = created = skipped = 0
+    last_id = 0
+    while True:
+        user_ids = list(users.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not user_ids:
+            break
+
+        owned = set(
+            PurchasedBook.objects.filter(user_id__in=user_ids, product_id__in=products)
+            .values_list('user_id', 'product_id')
+        )
+        books = [
+            PurchasedBook(user_id=user_id, product_id=product_id, product_name=name, price_at_sale=0.0)
+            for user_id in user_ids
+            for product_id, name in products.items()
+            if (user_id, product_id) not in owned
+        ]
+        with transaction.atomic():
+            # ignore_conflicts covers books granted between the read and the insert
+            PurchasedBook.objects.bulk_create(books, batch_size=500, ignore_conflicts=True)
+            bump_library_version(*{book.user_id for book in books})
+            inserted = PurchasedBook.objects.filter(user_id__in=user_ids, product_id__in=products).count() - len(owned)
+
+        processed += len(user_ids)
+        created += inserted
+        skipped += len(user_ids) * len(products) - inserted
+        last_id = user_ids[-1]
+        report_progress(job, processed)
+
+    return {
+        'users': processed,
+        'products': sorted(products),
+        'created': created,
+        'skipped': skipped,
+        'unmatched': unmatched_identifiers(payload),
+    }
+
+
+def unmatched_identifiers(payload):
+    """Listed ids / phones that did not resolve to an active user."""
+    users = User.objects.filter(is_active=True)
+    unmatched = []
+    if payload.get('user_ids'):
+        found = set(users.filter(pk__in=payload['user_ids']).values_list('pk', flat=True))
+        unmatched += [user_id for user_id in payload['user_ids'] if user_id not in found]
+    if payload.get('phones'):
+        found = set(users.filter(username__in=payload['phones']).values_list('username', flat=True))
+        unmatched += [phone for phone in payload['phones'] if phone not in found]
+    return unmatched
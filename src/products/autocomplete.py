@@ -0,0 +1,128 @@
+"""
+Prefix autocomplete over product, teacher and subject names.
+
+Each worker keeps an in-memory trie of the normalized name tokens (see
+``products.search.normalize_text``). Every trie node stores its best
+suggestions already ranked, so a lookup walks the prefix and reads a list:
+no database access. The trie is tagged with the autocomplete version it was
+built for and rebuilt when ``products.signals`` bumps that version, which
+happens only when product, teacher or subject names (or product
+availability, subject or teacher) change. Rating and cover writes leave it
+alone, so the ranking weights may lag until the next rebuild.
+"""
+import threading
+
+from django.db.models import Count
+
+from .caching import get_autocomplete_version
+from .search import normalize_text
+
+MAX_SUGGESTIONS = 20
+MAX_PREFIX_LENGTH = 20
+ARABIC_ARTICLE = 'ال'
+
+_lock = threading.Lock()
+_index = None
+
+
+class TrieNode:
+    __slots__ = ('children', 'suggestions')
+
+    def __init__(self):
+        self.children = {}
+        self.suggestions = []
+
+
+class AutocompleteTrie:
+    """Maps token prefixes to the best-weighted suggestions containing them."""
+
+    def __init__(self, version=None):
+        self.version = version
+        self.root = TrieNode()
+
+    @staticmethod
+    def token_keys(token):
+        keys = [token]
+        # "كيم" should also find "الكيمياء"
+        if token.startswith(ARABIC_ARTICLE) and len(token) > len(ARABIC_ARTICLE) + 1:
+            keys.append(token[len(ARABIC_ARTICLE):])
+        return keys
+
+    def add(self, suggestion, weight):
+        tokens = normalize_text(suggestion['name']).split()
+        prefixes = set()
+        for token in tokens:
+            for key in self.token_keys(token):
+                key = key[:MAX_PREFIX_LENGTH]
+                prefixes.update(key[:length] for length in range(1, len(key) + 1))
+        entry = (-weight, suggestion['name'], suggestion, frozenset(tokens))
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.children.setdefault(char, TrieNode())
+            node.suggestions.append(entry)
+
+    def finalize(self):
+        """Rank and trim every node's suggestions once the trie is filled."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node.suggestions.sort(key=lambda entry: (entry[0], entry[1]))
+            del node.suggestions[MAX_SUGGESTIONS:]
+            stack.extend(node.children.values())
+        return self
+
+    def lookup(self, query, limit=10):
+        tokens = normalize_text(query).split()
+        if not tokens:
+            return []
+        node = self.root
+        for char in tokens[-1][:MAX_PREFIX_LENGTH]:
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        # Earlier words must prefix-match some word of the suggestion too
+        leading = tokens[:-1]
+        results = []
+        for entry in node.suggestions:
+            if all(any(word.startswith(term) for word in entry[3]) for term in leading):
+                results.append(entry[2])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+def build_index(version=None):
+    from .models import Product, Subject, Teacher
+
+    trie = AutocompleteTrie(version)
+    products = Product.objects.filter(is_available=True).values_list('id', 'name', 'ratings_count')
+    for product_id, name, ratings_count in products.iterator(chunk_size=2000):
+        trie.add({'type': 'product', 'id': product_id, 'name': name}, ratings_count)
+
+    teachers = Teacher.objects.annotate(weight=Count('products')).values_list('id', 'name', 'weight')
+    for teacher_id, name, weight in teachers:
+        trie.add({'type': 'teacher', 'id': teacher_id, 'name': name}, weight)
+
+    subjects = Subject.objects.annotate(weight=Count('products')).values_list('id', 'name', 'weight')
+    for subject_id, name, weight in subjects:
+        trie.add({'type': 'subject', 'id': subject_id, 'name': name}, weight)
+    return trie.finalize()
+
+
+def get_index():
+    """The worker's trie for the current autocomplete version, rebuilt when stale."""
+    global _index
+    version = get_autocomplete_version()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    with _lock:
+        if _index is None or _index.version != version:
+            _index = build_index(version)
+        return _index
+
+
+def suggest(query, limit=10):
+    return get_index().lookup(query, limit)
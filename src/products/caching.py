@@ -0,0 +1,227 @@
+"""
+Catalog versioning, response caching and conditional GETs.
+
+Every change to catalog data (products, discounts, images, ratings, the home
+screen lists, categories, subjects, teachers) bumps a single catalog version
+counter in the cache, see ``products.signals``. Each student's library
+(their purchased books) has its own version counter. Cached responses and
+ETags are derived from these counters, so invalidation is just an increment.
+The autocomplete index has its own counter, bumped only when a name or the
+availability of an indexed row changes.
+
+Discounts switch on and off at their start/end time, while the stored
+prices only change (and bump the version) when ``refresh_product_prices``
+runs next; until then products price themselves live. The boundaries are
+noted in the cache whenever the pricing columns are written, and cached
+responses and ETags carry how many of them have passed (see
+``get_catalog_state``). ETags also carry the day when covers rotate daily.
+"""
+import bisect
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+LIBRARY_VERSION_KEY = 'library:version:{user_id}'
+PRICE_BOUNDARIES_KEY = 'catalog:price_boundaries'
+MAX_PRICE_BOUNDARIES = 1000
+AUTOCOMPLETE_VERSION_KEY = 'autocomplete:version'
+CATALOG_RESPONSE_TIMEOUT = 60 * 60 * 24  # stale copies are kept around for a day
+REBUILD_LOCK_TIMEOUT = 30
+
+
+def _initial_version():
+    # Milliseconds, so a flushed cache never restarts at a version clients have seen
+    return int(time.time() * 1000)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_version(), timeout=None)
+
+
+def get_catalog_version():
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def note_price_boundaries(moments):
+    """Remember when stored product prices go stale (written with the pricing columns)."""
+    stamps = {moment.timestamp() for moment in moments if moment}
+    if not stamps:
+        return
+    # Not atomic; a lost boundary only delays the ETag change until the next refresh
+    boundaries = set(cache.get(PRICE_BOUNDARIES_KEY) or ())
+    cache.set(PRICE_BOUNDARIES_KEY, sorted(boundaries | stamps)[:MAX_PRICE_BOUNDARIES], None)
+
+
+def forget_passed_price_boundaries():
+    """Drop the boundaries a price refresh has handled; call it right before bumping the version."""
+    now = time.time()
+    boundaries = cache.get(PRICE_BOUNDARIES_KEY) or []
+    cache.set(PRICE_BOUNDARIES_KEY, [moment for moment in boundaries if moment > now], None)
+
+
+def get_catalog_state():
+    """The catalog version plus the number of noted price boundaries that have passed."""
+    passed = bisect.bisect_right(cache.get(PRICE_BOUNDARIES_KEY) or [], time.time())
+    return f'{get_catalog_version()}-{passed}'
+
+
+def _bump_catalog_version():
+    _bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """
+    Invalidate every catalog response.
+
+    Bumped right away and again on commit, so a response rebuilt from
+    pre-commit data in between is not kept under the new version.
+    """
+    _bump_catalog_version()
+    transaction.on_commit(_bump_catalog_version)
+
+
+def get_autocomplete_version():
+    return _get_version(AUTOCOMPLETE_VERSION_KEY)
+
+
+def bump_autocomplete_version():
+    """Make every worker rebuild its autocomplete trie (now and on commit)."""
+    _bump_version(AUTOCOMPLETE_VERSION_KEY)
+    transaction.on_commit(lambda: _bump_version(AUTOCOMPLETE_VERSION_KEY))
+
+
+def get_library_version(user_id):
+    return _get_version(LIBRARY_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_library_version(*user_ids):
+    """Invalidate the library ETag of the given users (now and on commit)."""
+    keys = [LIBRARY_VERSION_KEY.format(user_id=user_id) for user_id in set(user_ids) if user_id]
+    for key in keys:
+        _bump_version(key)
+    transaction.on_commit(lambda: [_bump_version(key) for key in keys])
+
+
+def catalog_cache_key(name, request):
+    """Build a response cache key from the endpoint name, host and query params."""
+    params = sorted((key, value) for key, values in request.query_params.lists() for value in values)
+    parts = [name, request.scheme, request.get_host(), repr(params)]
+    if getattr(settings, 'PRODUCT_COVER_DAILY_ROTATION', False):
+        parts.append(timezone.localdate().isoformat())
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+    return f'catalog:response:{name}:{digest}'
+
+
+def get_or_build_catalog_response(key, build):
+    """
+    Return the cached payload for ``key`` if it was built for the current
+    catalog version, otherwise rebuild it with ``build()``.
+
+    Stampede protection: when a stale copy exists only the worker that wins
+    the rebuild lock recomputes it, the others keep serving the stale copy.
+    """
+    version = get_catalog_state()
+    entry = cache.get(key)
+    if entry is not None and entry['version'] == version:
+        return entry['data']
+
+    lock_key = f'{key}:lock'
+    have_lock = cache.add(lock_key, 1, REBUILD_LOCK_TIMEOUT)
+    if entry is not None and not have_lock:
+        return entry['data']
+
+    try:
+        data = build()
+        cache.set(key, {'version': version, 'data': data}, CATALOG_RESPONSE_TIMEOUT)
+    finally:
+        if have_lock:
+            cache.delete(lock_key)
+    return data
+
+
+def _opaque_tag(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against ``etag``."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return _opaque_tag(etag) in {_opaque_tag(tag) for tag in if_none_match.split(',')}
+
+
+class CatalogETagMixin:
+    """
+    Weak ETag / If-None-Match support for GET endpoints whose payload only
+    changes with the catalog (plus the user's library when ``etag_per_user``).
+
+    The check runs after authentication but before any queryset or serializer
+    work, so a matching request costs one or two cache lookups. On detail
+    routes the tag names the object, so a tag served for one object never
+    validates another (or a missing) one; only ``If-None-Match: *`` needs a
+    query to confirm the object exists.
+    """
+    etag_per_user = False
+
+    def get_lookup_value(self):
+        """The object looked up by a detail route, ``None`` on list routes."""
+        lookup_url_kwarg = getattr(self, 'lookup_url_kwarg', None) or getattr(self, 'lookup_field', None)
+        return self.kwargs.get(lookup_url_kwarg)
+
+    def object_exists(self):
+        lookup_value = self.get_lookup_value()
+        if lookup_value is None:
+            return True
+        return self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: lookup_value}).exists()
+
+    def get_etag(self, request):
+        tag = f'catalog-{get_catalog_state()}'
+        if getattr(settings, 'PRODUCT_COVER_DAILY_ROTATION', False):
+            tag = f'{tag}-covers-{timezone.localdate().isoformat()}'
+        lookup_value = self.get_lookup_value()
+        if lookup_value is not None:
+            tag = f'{tag}-object-{lookup_value}'
+        if self.etag_per_user:
+            user_id = request.user.pk
+            tag = f'{tag}-library-{user_id}-{get_library_version(user_id)}'
+        return f'W/"{tag}"'
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if_none_match = request.headers.get('If-None-Match')
+        if etag_matches(if_none_match, etag) and (if_none_match.strip() != '*' or self.object_exists()):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+        response['ETag'] = etag
+        if self.etag_per_user:
+            patch_vary_headers(response, ['Authorization'])
+        return response
+
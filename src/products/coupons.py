@@ -0,0 +1,193 @@
+"""
+Coupon redemption without a coupon-wide lock.
+
+Every use of a coupon is a ``CouponRedemption`` row, unique per
+(coupon, pill). The unique index stops a pill from using a coupon twice,
+however many requests race. The remaining uses are taken with a
+conditional ``UPDATE ... WHERE remaining > 0`` rather than
+``select_for_update``:
+
+* Coupons below ``COUPON_SHARDING_THRESHOLD`` uses decrement
+  ``available_use_times`` on the coupon row.
+* Larger coupons (campaign promo codes) are split on first use into
+  ``COUPON_COUNTER_SHARDS`` ``CouponCounterShard`` rows. A redemption
+  decrements a random shard that still has uses, so concurrent checkouts
+  write different rows instead of queueing on one.
+
+Codes are looked up through the indexed ``code_normalized`` column and the
+result, including "no such code", is cached for ``COUPON_CACHE_TIMEOUT``
+seconds; ``products.signals`` drops the entry when the coupon changes.
+"""
+import random
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from .models import CouponCounterShard, CouponDiscount, CouponRedemption, Pill, normalize_coupon_code
+
+COUPON_CACHE_TIMEOUT = 60
+COUPON_CACHE_KEY = 'coupon:code:{code}'
+MISSING = 'missing'
+
+
+class CouponExhausted(Exception):
+    pass
+
+
+def get_coupon_by_code(code):
+    """The coupon for a user-typed code, or ``None``. Cached both ways."""
+    normalized = normalize_coupon_code(code)
+    if not normalized:
+        return None
+    key = COUPON_CACHE_KEY.format(code=normalized)
+    cached = cache.get(key)
+    if cached == MISSING:
+        return None
+    if cached is not None:
+        return cached
+    coupon = CouponDiscount.objects.filter(code_normalized=normalized).first()
+    cache.set(key, coupon if coupon is not None else MISSING, COUPON_CACHE_TIMEOUT)
+    return coupon
+
+
+def forget_coupon(*codes):
+    keys = [COUPON_CACHE_KEY.format(code=normalize_coupon_code(code)) for code in codes if code]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def shard_count():
+    return max(1, int(getattr(settings, 'COUPON_COUNTER_SHARDS', 16)))
+
+
+def sharding_threshold():
+    return int(getattr(settings, 'COUPON_SHARDING_THRESHOLD', 100))
+
+
+def split_uses(total, shards):
+    base, extra = divmod(total, shards)
+    return [base + (1 if index < extra else 0) for index in range(shards)]
+
+
+def build_shards(coupon):
+    """(Re)spread the coupon's ``available_use_times`` over its shards."""
+    with transaction.atomic():
+        CouponCounterShard.objects.filter(coupon=coupon).delete()
+        CouponCounterShard.objects.bulk_create([
+            CouponCounterShard(coupon=coupon, shard=index, remaining=remaining)
+            for index, remaining in enumerate(split_uses(coupon.available_use_times, shard_count()))
+        ])
+
+
+def ensure_sharded(coupon):
+    """Shard a high-use coupon the first time it is redeemed. Returns whether it is sharded."""
+    if coupon.sharded:
+        return True
+    if coupon.available_use_times < sharding_threshold():
+        return False
+    with transaction.atomic():
+        # Only one request wins the flag; it moves the current quota into the shards
+        if CouponDiscount.objects.filter(pk=coupon.pk, sharded=False).update(sharded=True):
+            coupon.available_use_times = CouponDiscount.objects.values_list(
+                'available_use_times', flat=True
+            ).get(pk=coupon.pk)
+            build_shards(coupon)
+            forget_coupon(coupon.coupon)
+    coupon.sharded = True
+    return True
+
+
+def _take_from_shard(coupon):
+    shards = list(
+        CouponCounterShard.objects.filter(coupon=coupon, remaining__gt=0).values_list('shard', flat=True)
+    )
+    random.shuffle(shards)
+    for shard in shards:
+        taken = CouponCounterShard.objects.filter(
+            coupon=coupon, shard=shard, remaining__gt=0
+        ).update(remaining=F('remaining') - 1)
+        if taken:
+            return shard
+    raise CouponExhausted
+
+
+def _take_use(coupon):
+    """Take one use; returns the shard it came from (``None`` for unsharded coupons)."""
+    if ensure_sharded(coupon):
+        return _take_from_shard(coupon)
+    taken = CouponDiscount.objects.filter(
+        pk=coupon.pk, available_use_times__gt=0
+    ).update(available_use_times=F('available_use_times') - 1)
+    if not taken:
+        raise CouponExhausted
+    return None
+
+
+def redeem_coupon(coupon, pill):
+    """
+    Record one use of ``coupon`` by ``pill``. Returns ``False`` when the
+    coupon has no uses left. Redeeming the same pill again is a no-op that
+    returns ``True``.
+    """
+    try:
+        with transaction.atomic():
+            redemption, created = CouponRedemption.objects.get_or_create(
+                coupon=coupon, pill=pill, defaults={'user_id': pill.user_id}
+            )
+            if created:
+                redemption.shard = _take_use(coupon)
+                if redemption.shard is not None:
+                    CouponRedemption.objects.filter(pk=redemption.pk).update(shard=redemption.shard)
+    except CouponExhausted:
+        return False
+    return True
+
+
+def release_coupons(pill_ids):
+    """
+    Set-based ``release_coupon`` for pills about to be deleted: one counter
+    update per coupon (or shard), whatever the number of pills. Pills whose
+    coupon predates the ledger get their use back as well.
+    """
+    redemptions = CouponRedemption.objects.filter(pill_id__in=pill_ids)
+    by_counter = defaultdict(int)
+    for coupon_id, shard in redemptions.values_list('coupon_id', 'shard'):
+        by_counter[(coupon_id, shard)] += 1
+    legacy = (
+        Pill.objects.filter(pk__in=pill_ids, coupon__isnull=False)
+        .exclude(pk__in=redemptions.values('pill_id'))
+        .values_list('coupon_id', 'coupon__sharded')
+    )
+    for coupon_id, sharded in legacy:
+        by_counter[(coupon_id, 0 if sharded else None)] += 1
+
+    for (coupon_id, shard), uses in by_counter.items():
+        if shard is None:
+            CouponDiscount.objects.filter(pk=coupon_id).update(available_use_times=F('available_use_times') + uses)
+        else:
+            CouponCounterShard.objects.filter(coupon_id=coupon_id, shard=shard).update(remaining=F('remaining') + uses)
+    redemptions.delete()
+    return sum(by_counter.values())
+
+
+def release_coupon(pill):
+    """Give the pill's coupon use back (e.g. when an unpaid pill is discarded)."""
+    if not pill.coupon_id:
+        return False
+    with transaction.atomic():
+        redemption = CouponRedemption.objects.filter(coupon_id=pill.coupon_id, pill=pill).first()
+        if redemption is None:
+            return False
+        if redemption.shard is not None:
+            CouponCounterShard.objects.filter(
+                coupon_id=pill.coupon_id, shard=redemption.shard
+            ).update(remaining=F('remaining') + 1)
+        else:
+            CouponDiscount.objects.filter(pk=pill.coupon_id).update(
+                available_use_times=F('available_use_times') + 1
+            )
+        redemption.delete()
+    return True
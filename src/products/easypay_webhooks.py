@@ -5,7 +5,9 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
-from products.models import Pill
+from django.db import transaction
+from products.models import PaymentReference, Pill
+from products.webhook_inbox import record_webhook
 from django.utils import timezone
 from services.easypay_service import easypay_service
 
@@ -93,91 +95,30 @@ def handle_easypay_webhook_post(request, api_key):
                 'missing_fields': missing_fields
             }, status=400)
         
-        # Find the pill with matching EasyPay sequence
-        try:
-            pill = Pill.objects.get(easypay_invoice_sequence=easypay_sequence)
-            logger.info(f"Found pill {pill.pill_number} for EasyPay sequence {easypay_sequence}")
-        except Pill.DoesNotExist:
-            logger.error(f"No pill found with EasyPay sequence: {easypay_sequence}")
-            return JsonResponse({
-                'error': 'Invoice not found',
-                'easy_pay_sequence': easypay_sequence
-            }, status=404)
-        except Exception as e:
-            logger.error(f"Error finding pill: {str(e)}")
-            return JsonResponse({
-                'error': 'Database error while finding invoice'
-            }, status=500)
-        
         # Verify signature
         is_signature_valid = easypay_service.verify_webhook_signature(
             amount, customer_phone, received_signature
         )
         
         if not is_signature_valid:
-            logger.error(f"Invalid signature for pill {pill.pill_number}")
+            logger.error(f"Invalid signature for EasyPay sequence {easypay_sequence}")
             logger.error(f"  - Expected pattern: amount + customer_phone + secret_key")
             logger.error(f"  - Received signature: {received_signature}")
             return JsonResponse({
                 'error': 'Invalid signature'
             }, status=403)
         
-        logger.info(f"✓ Signature verification passed for pill {pill.pill_number}")
-        
-        # Process payment status
-        if status_paid == 'PAID':
-            logger.info(f"Processing payment confirmation for pill {pill.pill_number}")
-            
-            old_status = pill.status
-            pill.status = 'p'
-            
-            # Update EasyPay data with webhook information 
-            easypay_payload = pill.easypay_data or {}
-            easypay_payload['webhook_received'] = True
-            easypay_payload['webhook_timestamp'] = timezone.now().isoformat()
-            easypay_payload['webhook_data'] = webhook_data
-            pill.easypay_data = easypay_payload
-            
-            pill.save(update_fields=['status', 'easypay_data'])
-            
-            logger.info(f"✓ Updated pill {pill.pill_number}:")
-            logger.info(f"  - Status: {old_status} → {pill.status}")
-            logger.info(f"  - Amount: {amount}")
-            
-            # Grant purchased books to user - THIS IS CRITICAL for adding books after payment
-            try:
-                pill.grant_purchased_books()
-                logger.info(f"✓ Purchased books granted for pill {pill.pill_number}")
-            except Exception as e:
-                logger.error(f"Failed to grant purchased books for pill {pill.pill_number}: {str(e)}")
-                # Don't fail the webhook for book granting errors - the payment was still successful
-            
-            # Send payment notification if applicable
-            try:
-                pill.send_payment_notification()
-                logger.info(f"✓ Payment notification sent for pill {pill.pill_number}")
-            except Exception as e:
-                logger.error(f"Failed to send payment notification for pill {pill.pill_number}: {str(e)}")
-                # Don't fail the webhook for notification errors
-        
-        else:
-            logger.info(f"Non-payment status received for pill {pill.pill_number}: {status_paid}")
-            
-            # Update EasyPay data with webhook information for non-payment statuses
-            easypay_payload = pill.easypay_data or {}
-            easypay_payload['webhook_received'] = True
-            easypay_payload['webhook_timestamp'] = timezone.now().isoformat()
-            easypay_payload['webhook_data'] = webhook_data
-            pill.easypay_data = easypay_payload
-            pill.save(update_fields=['easypay_data'])
+        logger.info(f"✓ Signature verification passed for EasyPay sequence {easypay_sequence}")
         
-        logger.info(f"✓ EasyPay webhook processed successfully for pill {pill.pill_number}")
+        # Store it and acknowledge at once; drain_webhooks applies it to the pill
+        entry, created = record_webhook(request, 'easypay', easypay_sequence, status_paid)
         
         return JsonResponse({
-            'message': 'Webhook processed successfully',
-            'pill_number': pill.pill_number,
+            'message': 'Webhook received',
+            'easy_pay_sequence': easypay_sequence,
             'status': status_paid,
-            'processed_at': timezone.now().isoformat()
+            'duplicate': not created,
+            'received_at': entry.received_at.isoformat()
         }, status=200)
         
     except Exception as e:
@@ -191,6 +132,53 @@ def handle_easypay_webhook_post(request, api_key):
         }, status=500)
 
 
+def apply_easypay_webhook(webhook_data):
+    """
+    Apply a stored EasyPay callback to its pill (run by drain_webhooks).
+    Returns the pill.
+    """
+    easypay_sequence = webhook_data.get("easy_pay_sequence")
+    status_paid = webhook_data.get("status")
+    
+    # Find the pill with matching EasyPay sequence
+    pill = PaymentReference.find_pill('easypay', 'invoice_sequence', easypay_sequence)
+    if pill is None:
+        raise Pill.DoesNotExist(f"No pill for EasyPay sequence {easypay_sequence}")
+    logger.info(f"Found pill {pill.pill_number} for EasyPay sequence {easypay_sequence}")
+    
+    # Update EasyPay data with webhook information
+    easypay_payload = pill.easypay_data or {}
+    easypay_payload['webhook_received'] = True
+    easypay_payload['webhook_timestamp'] = timezone.now().isoformat()
+    easypay_payload['webhook_data'] = webhook_data
+    pill.easypay_data = easypay_payload
+    
+    # Process payment status
+    if status_paid == 'PAID':
+        logger.info(f"Processing payment confirmation for pill {pill.pill_number}")
+        
+        old_status = pill.status
+        pill.status = 'p'
+        pill.save(update_fields=['status', 'easypay_data'])
+        
+        logger.info(f"✓ Updated pill {pill.pill_number}:")
+        logger.info(f"  - Status: {old_status} → {pill.status}")
+        logger.info(f"  - Amount: {webhook_data.get('amount')}")
+        
+        # Grant purchased books to user - a failure here retries the whole entry
+        pill.grant_purchased_books()
+        logger.info(f"✓ Purchased books granted for pill {pill.pill_number}")
+        
+        # Send payment notification once the payment is committed
+        transaction.on_commit(pill.send_payment_notification)
+    else:
+        logger.info(f"Non-payment status received for pill {pill.pill_number}: {status_paid}")
+        pill.save(update_fields=['easypay_data'])
+    
+    logger.info(f"✓ EasyPay webhook processed successfully for pill {pill.pill_number}")
+    return pill
+
+
 def test_easypay_webhook_signature():
     """
     Test function to verify EasyPay webhook signature calculation
@@ -0,0 +1,104 @@
+"""
+Sparse fieldsets for read endpoints.
+
+``?fields=id,name,main_image`` renders only the listed top-level fields and
+``?omit=images,descriptions`` drops the listed ones. Serializers opt in with
+``SparseFieldsetMixin`` and describe, in ``field_sources``, which model
+columns and product relations each field reads. Views using
+``SparseQuerysetMixin`` trim ``.only()`` / ``select_related`` to those
+columns, and the product loader only batch-loads the relations that are
+actually rendered.
+"""
+from rest_framework import permissions, serializers
+
+FIELDS_PARAM = 'fields'
+OMIT_PARAM = 'omit'
+
+
+def _param_names(request, name):
+    raw = request.query_params.get(name) if request is not None else None
+    if not raw:
+        return None
+    return {part.strip() for part in raw.split(',') if part.strip()}
+
+
+def is_sparse_request(request):
+    if request is None or request.method not in permissions.SAFE_METHODS:
+        return False
+    return _param_names(request, FIELDS_PARAM) is not None or _param_names(request, OMIT_PARAM) is not None
+
+
+def selected_field_names(request, names):
+    """Filter ``names`` (keeping their order) by the request's fields/omit params."""
+    if not is_sparse_request(request):
+        return list(names)
+    fields = _param_names(request, FIELDS_PARAM)
+    omit = _param_names(request, OMIT_PARAM) or set()
+    return [name for name in names if (fields is None or name in fields) and name not in omit]
+
+
+def resolve_sources(field_sources, names):
+    """
+    Union of the ``(columns, relations)`` read by ``names``.
+
+    ``columns`` is None when a field has no entry in ``field_sources``, since
+    the columns it needs are then unknown and nothing may be deferred.
+    """
+    columns, relations = set(), set()
+    for name in names:
+        if name not in field_sources:
+            columns = None
+            continue
+        field_columns, field_relations = field_sources[name]
+        if columns is not None:
+            columns.update(field_columns)
+        relations.update(field_relations)
+    return columns, relations
+
+
+class SparseFieldsetMixin:
+    """
+    Drop the top-level fields a read request did not ask for.
+
+    ``field_sources`` maps a field name to ``(columns, relations)``: the
+    ``.only()`` paths it reads relative to the serializer's model, and the
+    product relations the ``ProductBatchLoader`` must load for it. Nested
+    uses of the serializer always render every field.
+    """
+    field_sources = {}
+
+    def _is_sparse_root(self):
+        if self.parent is None:
+            return True
+        return self.parent is self.root and isinstance(self.root, serializers.ListSerializer)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self._is_sparse_root():
+            return fields
+        keep = set(selected_field_names(self.context.get('request'), fields))
+        return {name: field for name, field in fields.items() if name in keep}
+
+    def get_loader_relations(self):
+        """Product relations needed by the fields this serializer renders."""
+        return resolve_sources(self.field_sources, self.fields)[1]
+
+
+class SparseQuerysetMixin:
+    """Trim the view queryset to the columns behind the requested fields."""
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if not is_sparse_request(self.request):
+            return queryset
+
+        serializer_class = self.get_serializer_class()
+        names = selected_field_names(self.request, serializer_class.Meta.fields)
+        columns, _ = resolve_sources(serializer_class.field_sources, names)
+        if columns is None:
+            return queryset
+
+        # Columns on related rows ("product__name") are read through a join
+        joins = {column.rsplit('__', 1)[0] for column in columns if '__' in column}
+        columns |= {join.split('__', 1)[0] for join in joins}
+        return queryset.select_related(None).select_related(*sorted(joins)).only(*sorted(columns) or ['pk'])
@@ -1,7 +1,8 @@
 
-from .models import Category, Pill, Product, ProductImage, CouponDiscount, PurchasedBook
+from .models import Category, PaymentReference, Pill, Product, ProductImage, CouponDiscount, PurchasedBook
 from django_filters import rest_framework as filters
-from django.db.models import Q, F, FloatField, Case, When, Exists, OuterRef
+from rest_framework.filters import SearchFilter
+from django.db.models import Q, Exists, OuterRef
 from django.utils import timezone
 
 class ProductFilter(filters.FilterSet):
@@ -9,82 +10,25 @@ class ProductFilter(filters.FilterSet):
     price_max = filters.NumberFilter(method='filter_by_discounted_price_max')
     size = filters.CharFilter(method='filter_by_size')
     has_images = filters.BooleanFilter(method='filter_has_images')
+    ordering = filters.OrderingFilter(
+        fields=(
+            ('date_added', 'date_added'),
+            ('effective_price', 'price'),
+            ('ratings_avg', 'rating'),
+            ('ratings_count', 'ratings_count'),
+        )
+    )
 
     class Meta:
         model = Product
         fields = ['category', 'sub_category', 'subject', 'teacher', 'year']
 
     def filter_by_discounted_price_min(self, queryset, name, value):
-        now = timezone.now()
-
-        # Annotate the queryset with product discounts
-        queryset = queryset.annotate(
-            product_discount_price=Case(
-                When(
-                    Q(discounts__discount_start__lte=now) &
-                    Q(discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            ),
-            category_discount_price=Case(
-                When(
-                    Q(category__discounts__discount_start__lte=now) &
-                    Q(category__discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('category__discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            )
-        ).annotate(
-            final_price=Case(
-                When(
-                    product_discount_price__lt=F('category_discount_price'),
-                    then=F('product_discount_price')
-                ),
-                default=F('category_discount_price'),
-                output_field=FloatField()
-            )
-        )
-
-        return queryset.filter(final_price__gte=value).distinct()
+        # effective_price is materialized on Product (see Product.refresh_pricing)
+        return queryset.filter(effective_price__gte=value)
 
     def filter_by_discounted_price_max(self, queryset, name, value):
-        now = timezone.now()
-
-        # Same annotation logic as above
-        queryset = queryset.annotate(
-            product_discount_price=Case(
-                When(
-                    Q(discounts__discount_start__lte=now) &
-                    Q(discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            ),
-            category_discount_price=Case(
-                When(
-                    Q(category__discounts__discount_start__lte=now) &
-                    Q(category__discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('category__discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            )
-        ).annotate(
-            final_price=Case(
-                When(
-                    product_discount_price__lt=F('category_discount_price'),
-                    then=F('product_discount_price')
-                ),
-                default=F('category_discount_price'),
-                output_field=FloatField()
-            )
-        )
-
-        return queryset.filter(final_price__lte=value).distinct()
+        return queryset.filter(effective_price__lte=value)
 
     def filter_by_size(self, queryset, name, value):
         return queryset.filter(availabilities__size__iexact=value).distinct()
@@ -100,7 +44,9 @@ class ProductFilter(filters.FilterSet):
     def filter_queryset(self, queryset):
         # Apply all filters (including search)
         queryset = super().filter_queryset(queryset)
-        # Simply order the results without slicing
+        # Explicit ?ordering= wins, otherwise newest first
+        if self.form.cleaned_data.get('ordering'):
+            return queryset
         return queryset.order_by('-date_added')
     
     
@@ -118,11 +64,14 @@ class CouponDiscountFilter(filters.FilterSet):
     def filter_available(self, queryset, name, value):
         now = timezone.now()
         if value:
+            has_uses = Q(sharded=False, available_use_times__gt=0) | Q(
+                sharded=True, counter_shards__remaining__gt=0
+            )
             return queryset.filter(
-                available_use_times__gt=0,
+                has_uses,
                 coupon_start__lte=now,
                 coupon_end__gte=now
-            )
+            ).distinct()
         return queryset
 
 class CategoryFilter(filters.FilterSet):
@@ -150,6 +99,21 @@ class PillFilter(filters.FilterSet):
         fields = ['status', 'user', 'pill_number']
 
 
+class PillSearchFilter(SearchFilter):
+    """
+    ``?search=`` over the pill's user and number; a gateway invoice
+    id/sequence/Fawry reference is matched exactly through ``PaymentReference``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if query:
+            pill_ids = PaymentReference.search(query)
+            if pill_ids:
+                return queryset.filter(pk__in=pill_ids)
+        return super().filter_queryset(request, queryset, view)
+
+
 class PurchasedBookFilter(filters.FilterSet):
     user_id = filters.NumberFilter(field_name='user__id')
     product_id = filters.NumberFilter(field_name='product__id')
@@ -0,0 +1,195 @@
+"""
+Gateway invoice creation, run as the ``create_invoice`` background job.
+
+The invoice views only validate the pill and enqueue this job, answering
+``202 Accepted`` with a status URL; a ``run_jobs`` worker calls EasyPay /
+Shake-out. A failed call or an unusable Fawry reference raises, and the job
+is retried with backoff (``products.jobs``) instead of sleeping in a web
+worker.
+
+While a gateway's circuit breaker is open the views fail over to the other
+configured gateway (``choose_gateway``) or answer 503 at once.
+"""
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from services.circuit_breaker import is_available
+
+from .jobs import lease_cutoff, register
+from .models import PaymentReference, Pill
+
+INVOICE_JOB = 'create_invoice'
+INVOICE_JOB_ATTEMPTS = 3
+INVOICE_RETRY_SECONDS = 10
+FAWRY_ERROR_INDICATORS = ['error', 'Error', 'ERROR', 'Invalid Merchant Code', 'statusCode', 'statusDescription']
+
+
+class InvoiceError(Exception):
+    pass
+
+
+def is_fawry_ref_error(fawry_ref):
+    """Check if fawry_ref contains an error"""
+    if not fawry_ref:
+        return True
+    fawry_ref_str = str(fawry_ref)
+    if any(indicator in fawry_ref_str for indicator in FAWRY_ERROR_INDICATORS):
+        return True
+    # Looks like a JSON error response
+    return fawry_ref_str.startswith('{') and 'error' in fawry_ref_str.lower()
+
+
+def serialize_easypay_invoice(pill, attempts=0):
+    data = pill.easypay_data or {}
+    payment_url = data.get('payment_url') or pill.easypay_payment_url
+    amount = data.get('amount') or pill.final_price()
+    invoice_details = data.get('invoice_details', {}) if isinstance(data, dict) else {}
+    fawry_ref = (
+        invoice_details.get('fawry_ref')
+        or data.get('fawry_ref')
+        or pill.easypay_fawry_ref
+    )
+
+    return {
+        'invoice_uid': pill.easypay_invoice_uid,
+        'invoice_sequence': pill.easypay_invoice_sequence,
+        'payment_url': payment_url,
+        'amount': str(amount) if amount is not None else None,
+        'pill_number': pill.pill_number,
+        'payment_method': data.get('payment_method', 'fawry'),
+        'payment_gateway': 'easypay',
+        'fawry_ref': fawry_ref,
+        'attempts': attempts
+    }
+
+
+def serialize_shakeout_invoice(pill, attempts=0):
+    data = pill.shakeout_data or {}
+    payment_url = data.get('payment_url') or data.get('url') or pill.shakeout_payment_url
+    total_amount = data.get('total_amount') or float(pill.final_price())
+
+    return {
+        'invoice_id': pill.shakeout_invoice_id,
+        'invoice_ref': pill.shakeout_invoice_ref,
+        'payment_url': payment_url,
+        'total_amount': total_amount,
+        'pill_number': pill.pill_number,
+        'currency': data.get('currency', 'EGP'),
+        'payment_gateway': 'shakeout',
+        'attempts': attempts
+    }
+
+
+def has_active_invoice(pill, gateway):
+    if gateway == 'easypay':
+        return bool(pill.easypay_invoice_uid) and not pill.is_easypay_invoice_expired()
+    return bool(pill.shakeout_invoice_id) and not pill.is_shakeout_invoice_expired()
+
+
+def serialize_invoice(pill, gateway, attempts=0):
+    if gateway == 'easypay':
+        return serialize_easypay_invoice(pill, attempts)
+    return serialize_shakeout_invoice(pill, attempts)
+
+
+def gateway_configured(gateway):
+    if gateway == 'easypay':
+        return bool(getattr(settings, 'EASYPAY_VENDOR_CODE', '') and getattr(settings, 'EASYPAY_SECRET_KEY', ''))
+    return bool(getattr(settings, 'SHAKEOUT_API_KEY', '') and getattr(settings, 'SHAKEOUT_SECRET_KEY', ''))
+
+
+def choose_gateway(preferred):
+    """
+    ``preferred`` unless its circuit is open; then the other gateway if it is
+    configured and up (and PAYMENT_GATEWAY_FAILOVER is on). ``None`` when
+    neither can take the invoice.
+    """
+    if is_available(preferred):
+        return preferred
+    fallback = 'shakeout' if preferred == 'easypay' else 'easypay'
+    if getattr(settings, 'PAYMENT_GATEWAY_FAILOVER', True) and gateway_configured(fallback) and is_available(fallback):
+        return fallback
+    return None
+
+
+def pending_invoice_job(pill, gateway):
+    """
+    The queued/running ``gateway`` invoice job of a pill, so repeated clicks
+    do not enqueue twice; a job for the other gateway (e.g. before a
+    failover) is not reused. A running job whose worker died (expired
+    lease) does not count.
+    """
+    from .models import BackgroundJob
+
+    return BackgroundJob.objects.filter(
+        Q(status='queued') | Q(status='running', heartbeat_at__gte=lease_cutoff()),
+        kind=INVOICE_JOB,
+        payload__pill_id=pill.pk,
+        payload__gateway=gateway,
+    ).order_by('-id').first()
+
+
+def _create_easypay_invoice(pill):
+    from services.easypay_service import easypay_service
+
+    result = easypay_service.create_payment_invoice(pill)
+    if not result['success']:
+        raise InvoiceError(result['error'])
+    data = result['data']
+    fawry_ref = data.get('invoice_details', {}).get('fawry_ref', '')
+    fawry_ref = str(fawry_ref) if fawry_ref else fawry_ref
+    if is_fawry_ref_error(fawry_ref):
+        raise InvoiceError(f'EasyPay invoice creation failed: Invalid Fawry reference {fawry_ref}')
+
+    pill.easypay_invoice_uid = data.get('invoice_uid', '')
+    pill.easypay_invoice_sequence = data.get('invoice_sequence', '')
+    pill.easypay_fawry_ref = fawry_ref
+    pill.easypay_data = data
+    pill.easypay_created_at = timezone.now()
+    pill.payment_gateway = 'easypay'
+    pill.status = 'w'
+    pill.save(update_fields=['easypay_invoice_uid', 'easypay_invoice_sequence', 'easypay_fawry_ref', 'easypay_data', 'easypay_created_at', 'payment_gateway', 'status'])
+    PaymentReference.record(
+        pill, 'easypay',
+        invoice_uid=pill.easypay_invoice_uid,
+        invoice_sequence=pill.easypay_invoice_sequence,
+        fawry_ref=pill.easypay_fawry_ref,
+    )
+
+
+def _create_shakeout_invoice(pill):
+    from services.shakeout_service import shakeout_service
+
+    result = shakeout_service.create_payment_invoice(pill)
+    if not result['success']:
+        raise InvoiceError(result['error'])
+    data = result['data']
+    fawry_ref = data.get('fawry_ref', '')
+    if fawry_ref and is_fawry_ref_error(str(fawry_ref)):
+        raise InvoiceError(f'Shake-out invoice creation failed: Invalid Fawry reference {fawry_ref}')
+
+    pill.shakeout_invoice_id = data['invoice_id']
+    pill.shakeout_invoice_ref = data['invoice_ref']
+    pill.shakeout_data = data
+    pill.shakeout_created_at = timezone.now()
+    pill.payment_gateway = 'shakeout'
+    pill.status = 'w'
+    pill.save(update_fields=['shakeout_invoice_id', 'shakeout_invoice_ref', 'shakeout_data', 'shakeout_created_at', 'payment_gateway', 'status'])
+    PaymentReference.record(
+        pill, 'shakeout', invoice_id=pill.shakeout_invoice_id, invoice_ref=pill.shakeout_invoice_ref
+    )
+
+
+@register(INVOICE_JOB, backoff_base=INVOICE_RETRY_SECONDS)
+def create_invoice(job):
+    pill = Pill.objects.get(pk=job.payload['pill_id'])
+    gateway = job.payload['gateway']
+    attempts = job.attempts + 1
+    # An earlier attempt (or another job) may already have created it
+    if not has_active_invoice(pill, gateway):
+        if gateway == 'easypay':
+            _create_easypay_invoice(pill)
+        else:
+            _create_shakeout_invoice(pill)
+    return serialize_invoice(pill, gateway, attempts)
@@ -0,0 +1,168 @@
+"""
+Database-backed background jobs.
+
+Work too large for a request (bulk book assignment, invoice creation) is
+stored as a ``BackgroundJob`` row and answered with ``202 Accepted``; the
+client polls the job for progress. ``manage.py run_jobs`` claims queued jobs
+and runs the handler registered for their ``kind``. A failing job is retried
+with exponential backoff until ``max_attempts`` is reached.
+
+A running job holds a lease: ``heartbeat_at`` is set when it is claimed and
+on every ``report_progress``. A job whose heartbeat is older than
+``JOB_LEASE_SECONDS`` belonged to a worker that died; the next
+``claim_next`` queues it again (or fails it once out of attempts).
+
+Handlers are plain functions taking the job::
+
+    @register('assign_books')
+    def assign_books(job):
+        ...
+        report_progress(job, processed, total)
+        return {'created': created}   # stored as job.result
+"""
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 60 * 60
+
+_handlers = {}
+_backoff_bases = {}
+
+
+def register(kind, backoff_base=BACKOFF_BASE_SECONDS):
+    def decorator(func):
+        _handlers[kind] = func
+        _backoff_bases[kind] = backoff_base
+        return func
+    return decorator
+
+
+def enqueue(kind, payload=None, user=None, max_attempts=3):
+    from .models import BackgroundJob
+
+    if kind not in _handlers:
+        raise ValueError(f'No job handler registered for "{kind}"')
+    return BackgroundJob.objects.create(
+        kind=kind,
+        payload=payload or {},
+        created_by=user if user is not None and user.is_authenticated else None,
+        max_attempts=max_attempts,
+    )
+
+
+def lease_cutoff():
+    """Running jobs with a heartbeat before this have lost their worker."""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'JOB_LEASE_SECONDS', 15 * 60))
+
+
+def report_progress(job, processed, total=None):
+    """Write progress straight to the row so pollers see it while the job runs; also renews the lease."""
+    from .models import BackgroundJob
+
+    job.processed = processed
+    job.heartbeat_at = timezone.now()
+    fields = {'processed': processed, 'heartbeat_at': job.heartbeat_at}
+    if total is not None:
+        job.total = fields['total'] = total
+    BackgroundJob.objects.filter(pk=job.pk).update(**fields)
+
+
+def backoff_delay(attempts, base=BACKOFF_BASE_SECONDS):
+    """Exponential backoff with jitter, capped at an hour."""
+    ceiling = min(BACKOFF_MAX_SECONDS, base * 2 ** max(0, attempts - 1))
+    return timedelta(seconds=random.uniform(ceiling / 2, ceiling))
+
+
+def release_expired():
+    """Queue again (or fail) running jobs whose lease expired. Returns how many."""
+    from .models import BackgroundJob
+
+    released = 0
+    expired = BackgroundJob.objects.filter(status='running', heartbeat_at__lt=lease_cutoff())
+    for job in expired.only('id', 'kind', 'attempts', 'max_attempts'):
+        attempts = job.attempts + 1
+        if attempts < job.max_attempts:
+            delay = backoff_delay(attempts, _backoff_bases.get(job.kind, BACKOFF_BASE_SECONDS))
+            changes = {'status': 'queued', 'run_after': timezone.now() + delay}
+        else:
+            changes = {'status': 'failed', 'finished_at': timezone.now()}
+        # Conditional, so a job that just finished (or was released by another worker) is left alone
+        released += BackgroundJob.objects.filter(pk=job.pk, status='running', heartbeat_at__lt=lease_cutoff()).update(
+            attempts=attempts, error='Worker stopped before the job finished', **changes
+        )
+    if released:
+        logger.warning("Released %s background jobs whose worker stopped", released)
+    return released
+
+
+def claim_next(kinds=None):
+    """
+    Claim the oldest due job. The claim is a conditional UPDATE, so several
+    workers can poll the same table without running a job twice.
+    """
+    from .models import BackgroundJob
+
+    release_expired()
+    candidates = BackgroundJob.objects.filter(status='queued', run_after__lte=timezone.now())
+    if kinds:
+        candidates = candidates.filter(kind__in=kinds)
+    for job_id in candidates.order_by('run_after', 'id').values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        claimed = BackgroundJob.objects.filter(pk=job_id, status='queued').update(
+            status='running', started_at=now, heartbeat_at=now
+        )
+        if claimed:
+            return BackgroundJob.objects.get(pk=job_id)
+    return None
+
+
+def run_job(job):
+    from .models import BackgroundJob
+
+    handler = _handlers.get(job.kind)
+    attempts = job.attempts + 1
+    try:
+        if handler is None:
+            raise LookupError(f'No job handler registered for "{job.kind}"')
+        result = handler(job)
+    except Exception as exc:
+        logger.exception("Job %s (%s) failed on attempt %s", job.pk, job.kind, attempts)
+        if handler is not None and attempts < job.max_attempts:
+            delay = backoff_delay(attempts, _backoff_bases.get(job.kind, BACKOFF_BASE_SECONDS))
+            changes = {'status': 'queued', 'run_after': timezone.now() + delay}
+        else:
+            changes = {'status': 'failed', 'finished_at': timezone.now()}
+        changes.update(attempts=attempts, error=str(exc))
+    else:
+        changes = {
+            'status': 'succeeded',
+            'attempts': attempts,
+            'result': result,
+            'error': '',
+            'finished_at': timezone.now(),
+        }
+    BackgroundJob.objects.filter(pk=job.pk).update(**changes)
+    for field, value in changes.items():
+        setattr(job, field, value)
+    return job
+
+
+def run_pending(kinds=None, limit=None):
+    """Run due jobs until none are left (or ``limit`` ran). Returns how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim_next(kinds)
+        if job is None:
+            break
+        close_old_connections()
+        run_job(job)
+        ran += 1
+    return ran
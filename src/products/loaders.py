@@ -0,0 +1,188 @@
+"""
+Request-scoped batch loading for product payloads.
+
+``ProductSerializer`` (and every serializer that nests it or renders product
+data) reads images, descriptions, the cover and the category/subject/teacher
+rows through a ``ProductBatchLoader`` kept in the serializer context. The
+loader is primed with every product reachable from the root serializer
+instance, so a whole page costs one grouped query per relation instead of a
+dozen per product. Only the relations behind the rendered fields are loaded
+(see ``products.fieldsets``). Pricing and rating aggregates live on the
+product row itself; discounts are only queried (once, for the whole page) for
+products whose materialized pricing has gone past a discount boundary.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, prefetch_related_objects
+from django.utils import timezone
+
+from .models import Discount, Product
+
+LOADER_CONTEXT_KEY = '_product_loader'
+
+
+class ProductBatchLoader:
+    """Load per-product relations for many products at once."""
+
+    prefetch_relations = (
+        'category', 'sub_category', 'subject', 'teacher', 'cover_image',
+        'images', 'descriptions',
+    )
+
+    def __init__(self, relations=None):
+        self.now = timezone.now()
+        if relations is not None:
+            relations = set(relations)
+            if 'cover_image' in relations and getattr(settings, 'PRODUCT_COVER_DAILY_ROTATION', False):
+                relations.add('images')  # main_image rotates over the images
+            self.prefetch_relations = tuple(
+                relation for relation in self.prefetch_relations if relation in relations
+            )
+        self._loaded_products = set()
+        self._unpriced_products = []
+        self._live_pricing = {}
+
+    def prime(self, products):
+        """Batch-load the configured relations for ``products`` not seen yet."""
+        products = [product for product in products if product is not None and product.pk]
+        if not products:
+            return
+
+        if self.prefetch_relations:
+            prefetch_related_objects(products, *self.prefetch_relations)
+
+        new_products = {
+            product.pk: product for product in products
+            if product.pk not in self._loaded_products
+        }
+        self._unpriced_products.extend(new_products.values())
+        self._loaded_products.update(new_products)
+
+    def _price_pending(self):
+        """Live-price every primed product whose stored pricing is stale, on first use."""
+        if not self._unpriced_products:
+            return
+        stale = [
+            product for product in self._unpriced_products
+            if not product.has_fresh_pricing(self.now)
+        ]
+        self._unpriced_products = []
+        if stale:
+            self._load_live_pricing(stale)
+
+    def _load_live_pricing(self, products):
+        """Price products whose stored pricing is past its boundary from one discount query."""
+        product_ids = [product.pk for product in products]
+        category_ids = {product.category_id for product in products if product.category_id}
+        by_product = defaultdict(list)
+        by_category = defaultdict(list)
+        discounts = Discount.objects.filter(
+            Q(product_id__in=product_ids) | Q(category_id__in=category_ids),
+            is_active=True,
+            discount_end__gte=self.now,
+        )
+        for discount in discounts:
+            if discount.product_id:
+                by_product[discount.product_id].append(discount)
+            else:
+                by_category[discount.category_id].append(discount)
+
+        for product in products:
+            self._live_pricing[product.pk] = product.pricing_from_discounts(
+                by_product[product.pk] + by_category[product.category_id], self.now
+            )
+
+    def ensure(self, product):
+        if product is not None and product.pk not in self._loaded_products:
+            self.prime([product])
+
+    def pricing(self, product):
+        """Stored pricing columns, or a live computation when they are stale."""
+        self.ensure(product)
+        self._price_pending()
+        live = self._live_pricing.get(product.pk)
+        if live is not None:
+            return live
+        return {
+            'effective_price': product.effective_price,
+            'active_discount_pct': product.active_discount_pct,
+            'discount_ends_at': product.discount_ends_at,
+        }
+
+    def current_discount_value(self, product):
+        return self.pricing(product)['active_discount_pct']
+
+    def discount_expiry(self, product):
+        return self.pricing(product)['discount_ends_at']
+
+    def discounted_price(self, product):
+        return self.pricing(product)['effective_price']
+
+    def has_discount(self, product):
+        return self.pricing(product)['active_discount_pct'] is not None
+
+    def number_of_ratings(self, product):
+        return product.number_of_ratings()
+
+    def average_rating(self, product):
+        return product.average_rating()
+
+    def main_image(self, product):
+        self.ensure(product)
+        return product.main_image()
+
+
+def collect_products(instance):
+    """
+    Yield the products reachable from a serializer instance without querying.
+
+    Handles products themselves, rows with an already-loaded ``product``
+    foreign key (pill items, purchased books, loved/special/best products) and
+    prefetched reverse relations such as ``pill.items``.
+    """
+    if instance is None:
+        return
+    if isinstance(instance, Product):
+        yield instance
+        return
+    if not hasattr(instance, '_meta'):
+        try:
+            iterator = iter(instance)
+        except TypeError:
+            return
+        for obj in iterator:
+            yield from collect_products(obj)
+        return
+
+    try:
+        product_field = instance._meta.get_field('product')
+    except FieldDoesNotExist:
+        product_field = None
+    if product_field is not None and getattr(product_field, 'many_to_one', False):
+        if product_field.is_cached(instance):
+            yield getattr(instance, 'product')
+
+    for related in getattr(instance, '_prefetched_objects_cache', {}).values():
+        for obj in related:
+            if obj is instance:
+                continue
+            if isinstance(obj, Product):
+                yield obj
+            else:
+                yield from collect_products(obj)
+
+
+def get_product_loader(serializer):
+    """Return the loader shared by every serializer bound to the same root."""
+    context = serializer.context
+    loader = context.get(LOADER_CONTEXT_KEY)
+    if loader is None:
+        relations = None
+        if hasattr(serializer, 'get_loader_relations'):
+            relations = serializer.get_loader_relations()
+        loader = ProductBatchLoader(relations)
+        context[LOADER_CONTEXT_KEY] = loader
+        loader.prime(list(collect_products(serializer.root.instance)))
+    return loader
@@ -0,0 +1,32 @@
+"""
+Give every product that has images but no stored cover its oldest image.
+Usage: python manage.py assign_cover_images [--batch-size 1000]
+"""
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Backfill Product.cover_image from existing product images in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Products per batch (default 1000)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        last_id = 0
+        assigned = 0
+
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id, cover_image__isnull=True)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not product_ids:
+                break
+            assigned += Product.assign_missing_covers(product_ids)
+            last_id = product_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Assigned cover images to {assigned} products'))
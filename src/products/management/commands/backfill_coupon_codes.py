@@ -0,0 +1,68 @@
+"""
+Fill CouponDiscount.code_normalized for coupons created before the column existed.
+A code that only differs from an earlier one in case, spaces or dashes cannot
+share its normalized form, so that coupon gets a fresh code (reported, so it
+can be handed out again) instead of becoming unreachable.
+Usage: python manage.py backfill_coupon_codes [--batch-size 1000]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products.coupons import forget_coupon
+from products.models import CouponDiscount, normalize_coupon_code
+
+
+class Command(BaseCommand):
+    help = 'Backfill the normalized, indexed coupon code column in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Coupons per batch (default 1000)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        last_id = 0
+        updated = 0
+        clashes = 0
+
+        while True:
+            coupons = list(
+                CouponDiscount.objects.filter(pk__gt=last_id, code_normalized__isnull=True, coupon__isnull=False)
+                .order_by('pk')
+                .only('id', 'coupon')[:batch_size]
+            )
+            if not coupons:
+                break
+
+            for coupon in coupons:
+                coupon.code_normalized = normalize_coupon_code(coupon.coupon)
+            taken = set(
+                CouponDiscount.objects.filter(code_normalized__in=[coupon.code_normalized for coupon in coupons])
+                .values_list('code_normalized', flat=True)
+            )
+            to_update, clashing, seen = [], [], set()
+            for coupon in coupons:
+                if coupon.code_normalized in taken or coupon.code_normalized in seen:
+                    # Two codes that differ only in case/dashes: the first one keeps it
+                    clashing.append(coupon)
+                    continue
+                seen.add(coupon.code_normalized)
+                to_update.append(coupon)
+
+            with transaction.atomic():
+                CouponDiscount.objects.bulk_update(to_update, ['code_normalized'])
+
+            for coupon in clashing:
+                old_code = coupon.coupon
+                coupon.coupon = None  # save() issues a fresh unique code
+                coupon.save(update_fields=['coupon', 'code_normalized'])
+                forget_coupon(old_code)
+                clashes += 1
+                self.stdout.write(self.style.WARNING(
+                    f'Coupon {coupon.pk} ({old_code}) clashes with an existing code, renamed to {coupon.coupon}'
+                ))
+
+            updated += len(to_update) + len(clashing)
+            last_id = coupons[-1].pk
+            self.stdout.write(f'Processed {updated} coupons (last id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Normalized {updated} coupon codes ({clashes} clashing coupons renamed)'))
@@ -0,0 +1,51 @@
+"""
+Create PaymentReference rows for invoices issued before the table existed.
+Run it once after migrating (the table is created by this release's migration); it is safe to
+re-run. Until it finishes, lookups fall back to the pill columns and record what they find.
+Usage: python manage.py backfill_payment_references [--batch-size 1000]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from products.models import PAYMENT_REFERENCE_FIELDS, PaymentReference, Pill
+
+
+class Command(BaseCommand):
+    help = 'Backfill the indexed payment reference table from the pill invoice columns in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Pills per batch (default 1000)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        fields = list(PAYMENT_REFERENCE_FIELDS.values())
+        has_reference = Q()
+        for field in fields:
+            has_reference |= Q(**{f'{field}__isnull': False}) & ~Q(**{field: ''})
+        pills = Pill.objects.filter(has_reference)
+
+        before = PaymentReference.objects.count()
+        last_id = 0
+        processed = 0
+        while True:
+            rows = list(pills.filter(pk__gt=last_id).order_by('pk').values('pk', *fields)[:batch_size])
+            if not rows:
+                break
+
+            references = [
+                PaymentReference(pill_id=row['pk'], gateway=gateway, kind=kind, value=str(row[field]))
+                for row in rows
+                for (gateway, kind), field in PAYMENT_REFERENCE_FIELDS.items()
+                if row[field]
+            ]
+            with transaction.atomic():
+                # An existing row wins: it was written when the invoice was created
+                PaymentReference.objects.bulk_create(references, ignore_conflicts=True)
+
+            processed += len(rows)
+            last_id = rows[-1]['pk']
+            self.stdout.write(f'Processed {processed} pills (last id {last_id})')
+
+        written = PaymentReference.objects.count() - before
+        self.stdout.write(self.style.SUCCESS(f'✅ Backfilled {written} payment references for {processed} pills'))
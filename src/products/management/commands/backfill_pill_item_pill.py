@@ -0,0 +1,66 @@
+"""
+Copy pill links from the old Pill.items many-to-many table onto PillItem.pill.
+Run it before the migration that drops the products_pill_items table.
+Usage: python manage.py backfill_pill_item_pill [--batch-size 1000]
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from products.models import PillItem
+
+M2M_TABLE = 'products_pill_items'
+
+
+class Command(BaseCommand):
+    help = 'Backfill PillItem.pill from the legacy Pill.items join table in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Join rows per batch (default 1000)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        with connection.cursor() as cursor:
+            if M2M_TABLE not in connection.introspection.table_names(cursor):
+                self.stdout.write(self.style.SUCCESS(f'✅ No {M2M_TABLE} table, nothing to backfill'))
+                return
+
+        table = connection.ops.quote_name(M2M_TABLE)
+        last_id = 0
+        updated = 0
+        conflicts = 0
+
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT id, pill_id, pillitem_id FROM {table} WHERE id > %s ORDER BY id LIMIT %s',
+                    [last_id, batch_size],
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            links = {pillitem_id: pill_id for _, pill_id, pillitem_id in rows}
+            items = PillItem.objects.filter(pk__in=links).only('id', 'pill_id')
+            to_update = []
+            for item in items:
+                pill_id = links[item.pk]
+                if item.pill_id is None:
+                    item.pill_id = pill_id
+                    to_update.append(item)
+                elif item.pill_id != pill_id:
+                    # The foreign key wins; report the disagreement for a manual look
+                    conflicts += 1
+                    self.stdout.write(self.style.WARNING(
+                        f'PillItem {item.pk} points to pill {item.pill_id} but is listed on pill {pill_id}'
+                    ))
+
+            with transaction.atomic():
+                PillItem.objects.bulk_update(to_update, ['pill'])
+
+            updated += len(to_update)
+            last_id = rows[-1][0]
+            self.stdout.write(f'Processed up to join row {last_id}, {updated} items linked')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Linked {updated} pill items to their pill ({conflicts} conflicts kept as-is)'
+        ))
@@ -147,7 +147,7 @@ class Command(BaseCommand):
                 )
                 
                 # Create pill item using the existing product
-                new_pill_item = PillItem.objects.create(
+                PillItem.objects.create(
                     pill=pill,
                     user=user,
                     product=product,
@@ -157,9 +157,6 @@ class Command(BaseCommand):
                     status='i',
                 )
                 
-                # Add item to pill
-                pill.items.add(new_pill_item)
-                
                 # Create pill address
                 pill_address = PillAddress.objects.create(
                     pill=pill,
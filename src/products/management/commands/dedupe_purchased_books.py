@@ -0,0 +1,56 @@
+"""
+Remove duplicate library rows so the (user, product) unique constraint can be applied.
+Run it before the migration that adds the constraint.
+Usage: python manage.py dedupe_purchased_books [--batch-size 500] [--dry-run]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from products.models import PurchasedBook
+
+
+class Command(BaseCommand):
+    help = 'Keep the earliest PurchasedBook of every (user, product) pair and delete the rest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Duplicate pairs per batch (default 500)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        dry_run = options['dry_run']
+        duplicates = (
+            PurchasedBook.objects.values('user_id', 'product_id')
+            .annotate(rows=Count('id'), keep_id=Min('id'))
+            .filter(rows__gt=1)
+            .order_by('keep_id')
+        )
+        last_keep_id = 0
+        pairs = 0
+        deleted = 0
+
+        while True:
+            batch = list(duplicates.filter(keep_id__gt=last_keep_id)[:batch_size])
+            if not batch:
+                break
+
+            to_delete = []
+            for pair in batch:
+                to_delete.extend(
+                    PurchasedBook.objects.filter(user_id=pair['user_id'], product_id=pair['product_id'])
+                    .exclude(pk=pair['keep_id'])
+                    .values_list('pk', flat=True)
+                )
+            if not dry_run:
+                # Deleting through the ORM fires the signal that versions each library
+                with transaction.atomic():
+                    PurchasedBook.objects.filter(pk__in=to_delete).delete()
+
+            pairs += len(batch)
+            deleted += len(to_delete)
+            last_keep_id = batch[-1]['keep_id']
+            self.stdout.write(f'Processed {pairs} duplicated pairs ({deleted} extra rows)')
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'✅ {verb} {deleted} duplicate library rows from {pairs} pairs'))
@@ -0,0 +1,34 @@
+"""
+Worker that applies stored payment webhooks to their pills (see products.webhook_inbox).
+Keep one running under the process manager, or drain the inbox from cron with --once.
+Usage: python manage.py drain_webhooks [--once] [--sleep 1]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from products import webhook_inbox
+
+
+class Command(BaseCommand):
+    help = 'Apply received payment webhooks in order per pill'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Apply the due webhooks, then exit')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait when the inbox is empty (default 1)')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            close_old_connections()
+            ran = webhook_inbox.drain()
+            total += ran
+            if ran:
+                self.stdout.write(f'Applied {ran} webhooks')
+            if options['once']:
+                break
+            if not ran:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Applied {total} webhooks'))
@@ -0,0 +1,44 @@
+"""
+Store subtotal/total on pills created before order totals were snapshotted.
+Usage: python manage.py freeze_pill_totals [--batch-size 500]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+
+from products.models import Pill, PillItem
+
+
+class Command(BaseCommand):
+    help = 'Backfill the stored order totals of pills that have none, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Pills per batch (default 500)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        last_id = 0
+        updated = 0
+
+        while True:
+            pills = list(
+                Pill.objects.filter(pk__gt=last_id, subtotal__isnull=True)
+                .order_by('pk')
+                .prefetch_related(Prefetch('items', queryset=PillItem.objects.select_related('product')))
+                [:batch_size]
+            )
+            if not pills:
+                break
+
+            for pill in pills:
+                # Paid/waiting pills keep their items' price_at_sale, initiated ones use current prices
+                pill.subtotal, pill.total = pill.compute_totals()
+
+            with transaction.atomic():
+                Pill.objects.bulk_update(pills, ['subtotal', 'total'])
+
+            updated += len(pills)
+            last_id = pills[-1].pk
+            self.stdout.write(f'Processed {updated} pills (last id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Stored totals for {updated} pills'))
@@ -0,0 +1,104 @@
+"""
+Delete (or archive, then delete) unpaid pills that were never paid.
+A pill is reaped when it is still 'initiated', older than --days (default STALE_PILL_DAYS),
+has no payment invoice newer than that and no library books attached. Coupon uses are given back.
+Run it from cron, e.g. nightly:
+    30 3 * * * python manage.py reap_initiated_pills --archive
+Usage: python manage.py reap_initiated_pills [--days 30] [--archive] [--batch-size 500] [--dry-run]
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from products.coupons import release_coupons
+from products.models import ArchivedPill, Pill, PillItem, PurchasedBook
+
+
+class Command(BaseCommand):
+    help = 'Remove stale initiated pills in keyset batches, optionally archiving them first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Minimum age in days (default STALE_PILL_DAYS)')
+        parser.add_argument('--archive', action='store_true', help='Copy each pill to ArchivedPill before deleting it')
+        parser.add_argument('--batch-size', type=int, default=500, help='Pills per batch (default 500)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the pills that would be removed')
+
+    def stale_pills(self, cutoff):
+        return Pill.objects.filter(
+            Q(shakeout_created_at__isnull=True) | Q(shakeout_created_at__lt=cutoff),
+            Q(easypay_created_at__isnull=True) | Q(easypay_created_at__lt=cutoff),
+            status='i',
+            date_added__lt=cutoff,
+        ).exclude(Exists(PurchasedBook.objects.filter(pill=OuterRef('pk'))))
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'STALE_PILL_DAYS', 30)
+        batch_size = max(1, options['batch_size'])
+        cutoff = timezone.now() - timedelta(days=max(1, days))
+        stale = self.stale_pills(cutoff)
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'✅ {stale.count()} pills older than {days} days would be removed'))
+            return
+
+        last_id = 0
+        removed = 0
+        released = 0
+        while True:
+            pill_ids = list(stale.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pill_ids:
+                break
+
+            # One short transaction per batch; the filter is re-applied inside it so
+            # a pill paid since the batch was read is left alone.
+            with transaction.atomic():
+                pills = stale.filter(pk__in=pill_ids)
+                if options['archive']:
+                    self.archive(pills)
+                batch_ids = list(pills.values_list('pk', flat=True))
+                released += release_coupons(batch_ids)
+                PillItem.objects.filter(pill_id__in=batch_ids).delete()
+                Pill.objects.filter(pk__in=batch_ids).delete()
+
+            removed += len(batch_ids)
+            last_id = pill_ids[-1]
+            self.stdout.write(f'Removed {removed} pills (last id {last_id})')
+
+        verb = 'Archived and removed' if options['archive'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ {verb} {removed} stale pills older than {days} days ({released} coupon uses released)'
+        ))
+
+    def archive(self, pills):
+        items = {}
+        for pill_id, product_id, price_at_sale in PillItem.objects.filter(pill__in=pills).values_list(
+            'pill_id', 'product_id', 'price_at_sale'
+        ):
+            items.setdefault(pill_id, []).append({'product_id': product_id, 'price_at_sale': price_at_sale})
+
+        ArchivedPill.objects.bulk_create(
+            [
+                ArchivedPill(
+                    pill_id=pill.pk,
+                    pill_number=pill.pill_number,
+                    user_id=pill.user_id,
+                    status=pill.status,
+                    date_added=pill.date_added,
+                    coupon_code=pill.coupon.coupon if pill.coupon else None,
+                    coupon_discount=pill.coupon_discount,
+                    subtotal=pill.subtotal,
+                    total=pill.total,
+                    payment_gateway=pill.payment_gateway,
+                    items=items.get(pill.pk, []),
+                )
+                for pill in pills.select_related('coupon').only(
+                    'id', 'pill_number', 'user_id', 'status', 'date_added', 'coupon__coupon',
+                    'coupon_discount', 'subtotal', 'total', 'payment_gateway',
+                )
+            ],
+            ignore_conflicts=True,
+        )
@@ -0,0 +1,62 @@
+"""
+Recompute the stored rating aggregates (ratings_count / ratings_sum / ratings_avg) on Product.
+Usage: python manage.py rebuild_rating_aggregates [--batch-size 500]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from products.caching import bump_catalog_version
+from products.models import Product, Rating
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized rating aggregates on every product in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Products per batch (default 500)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        last_id = 0
+        updated = 0
+
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not product_ids:
+                break
+
+            stats = {
+                row['product_id']: row
+                for row in Rating.objects.filter(product_id__in=product_ids)
+                .order_by()
+                .values('product_id')
+                .annotate(count=Count('id'), total=Sum('star_number'))
+            }
+
+            products = []
+            for product_id in product_ids:
+                row = stats.get(product_id)
+                count = row['count'] if row else 0
+                total = row['total'] if row else 0
+                products.append(Product(
+                    pk=product_id,
+                    ratings_count=count,
+                    ratings_sum=total,
+                    ratings_avg=(total / count) if count else 0.0,
+                ))
+
+            with transaction.atomic():
+                Product.objects.bulk_update(products, ['ratings_count', 'ratings_sum', 'ratings_avg'])
+
+            updated += len(products)
+            last_id = product_ids[-1]
+            self.stdout.write(f'Processed {updated} products (last id {last_id})')
+
+        # bulk_update sends no signals, so cached catalog responses are dropped here
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'✅ Rebuilt rating aggregates for {updated} products'))
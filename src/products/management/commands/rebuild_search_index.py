@@ -0,0 +1,39 @@
+"""
+Rebuild the product search index (normalized documents plus the FTS5 table / GIN index).
+Usage: python manage.py rebuild_search_index [--batch-size 500]
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products.models import Product
+from products.search import create_search_index, index_products
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search documents of every product in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Products per batch (default 500)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        create_search_index()
+        last_id = 0
+        indexed = 0
+
+        while True:
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_id)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not product_ids:
+                break
+
+            with transaction.atomic():
+                indexed += index_products(product_ids)
+
+            last_id = product_ids[-1]
+            self.stdout.write(f'Indexed {indexed} products (last id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Rebuilt the search index for {indexed} products'))
@@ -0,0 +1,30 @@
+"""
+Recompute the materialized product pricing (effective_price, active_discount_pct, discount_ends_at).
+Run it from cron every few minutes so discounts switch on/off when their start/end boundary passes:
+    */5 * * * * python manage.py refresh_product_prices
+Usage: python manage.py refresh_product_prices [--all] [--batch-size 500]
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Recompute product prices whose discount boundary has passed (or every product with --all)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every product, not only the due ones')
+        parser.add_argument('--batch-size', type=int, default=500, help='Products per batch (default 500)')
+
+    def handle(self, *args, **options):
+        filter_q = None
+        if not options['all']:
+            filter_q = (
+                Q(price_recompute_at__lte=timezone.now())
+                | Q(effective_price__isnull=True, price__isnull=False)
+            )
+
+        changed = Product.refresh_pricing(filter_q, batch_size=max(1, options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(f'✅ Refreshed pricing for {changed} products'))
@@ -0,0 +1,34 @@
+"""
+Worker for the database-backed background jobs (see products.jobs).
+Keep one or more running under the process manager, or drain the queue from cron with --once.
+Usage: python manage.py run_jobs [--once] [--kind assign_books] [--sleep 2]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from products import jobs
+
+
+class Command(BaseCommand):
+    help = 'Claim and run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due jobs, then exit')
+        parser.add_argument('--kind', action='append', dest='kinds', help='Only run jobs of this kind (repeatable)')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait when the queue is empty (default 2)')
+
+    def handle(self, *args, **options):
+        kinds = options['kinds']
+        total = 0
+        while True:
+            ran = jobs.run_pending(kinds)
+            total += ran
+            if ran:
+                self.stdout.write(f'Ran {ran} jobs')
+            if options['once']:
+                break
+            if not ran:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Ran {total} background jobs'))
@@ -1,9 +1,13 @@
-import random
-import string
-from django.db import models
+import secrets
+from collections import defaultdict
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast, Greatest
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from products.utils import send_whatsapp_message
+from products.caching import bump_catalog_version, forget_passed_price_boundaries, note_price_boundaries
+from products.numbering import pill_numbers
 from accounts.models import YEAR_CHOICES, User
 from core import settings
 from django.utils import timezone
@@ -53,16 +57,32 @@ PAYMENT_GATEWAY_CHOICES = [
     ('shakeout', 'Shake-out'),
 ]
 
+PRICING_FIELDS = ['effective_price', 'active_discount_pct', 'discount_ends_at', 'price_recompute_at']
+
 def generate_pill_number():
-    """Generate a unique 20-digit pill number."""
-    while True:
-        pill_number = ''.join(random.choices(string.digits, k=20))
-        if not Pill.objects.filter(pill_number=pill_number).exists():
-            return pill_number
+    """Generate a unique, time-ordered 20-digit pill number (see products.numbering)."""
+    return pill_numbers.next()
+
+COUPON_ALPHABET = '023456789'
+COUPON_LENGTH = 11
+COUPON_CREATE_ATTEMPTS = 5
+PILL_NUMBER_ATTEMPTS = 3
 
 def create_random_coupon():
-    nums = ['0', '2', '3', '4', '5', '6', '7', '8', '9']
-    return ''.join(random.choice(nums) for _ in range(11))
+    return ''.join(secrets.choice(COUPON_ALPHABET) for _ in range(COUPON_LENGTH))
+
+def normalize_coupon_code(code):
+    """Case-, space- and dash-insensitive form of a code, stored in ``code_normalized``."""
+    return ''.join(str(code or '').split()).replace('-', '').upper()
+
+def unique_coupon_codes(count, exclude=()):
+    """``count`` distinct random codes, none of them in ``exclude``."""
+    codes = set()
+    while len(codes) < count:
+        code = create_random_coupon()
+        if code not in exclude:
+            codes.add(code)
+    return codes
 
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -166,6 +186,32 @@ class Product(models.Model):
         default=True,
         help_text="Whether this digital book is available for purchase"
     )
+
+    # Stable cover picked from the product's images (see ProductImage.save)
+    cover_image = models.ForeignKey(
+        'ProductImage',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        help_text="Image shown as the product cover"
+    )
+
+    # Materialized pricing, recomputed on Discount changes and by refresh_product_prices
+    effective_price = models.FloatField(null=True, blank=True, db_index=True)
+    active_discount_pct = models.FloatField(null=True, blank=True)
+    discount_ends_at = models.DateTimeField(null=True, blank=True)
+    price_recompute_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Next discount start/end boundary after which the pricing columns are stale"
+    )
+
+    # Denormalized rating aggregates, kept in step by the rating views
+    ratings_count = models.PositiveIntegerField(default=0)
+    ratings_sum = models.PositiveIntegerField(default=0)
+    ratings_avg = models.FloatField(default=0.0, db_index=True)
     
     def get_current_discount(self):
         """Returns the best active discount (either product or category level)"""
@@ -202,33 +248,187 @@ class Product(models.Model):
         return self.price
 
     def discounted_price(self):
+        if self.has_fresh_pricing():
+            return self.effective_price
         discount = self.get_current_discount()
         if discount:
             return self.price * (1 - discount.discount / 100)
         return self.price
 
     def has_discount(self):
+        if self.has_fresh_pricing():
+            return self.active_discount_pct is not None
         return self.get_current_discount() is not None
 
+    def has_fresh_pricing(self, now=None):
+        """Whether the materialized pricing columns can be trusted right now."""
+        if self.price is not None and self.effective_price is None:
+            return False
+        if self.price_recompute_at is None:
+            return True
+        return self.price_recompute_at > (now or timezone.now())
+
+    def pricing_from_discounts(self, discounts, now):
+        """
+        Compute the pricing columns from this product's (and its category's)
+        active or upcoming discounts.
+        """
+        active = [d for d in discounts if d.discount_start <= now <= d.discount_end]
+        best = max(active, key=lambda d: d.discount) if active else None
+        boundaries = [d.discount_start for d in discounts if d.discount_start > now]
+        boundaries += [d.discount_end for d in active]
+
+        pct = best.discount if best else None
+        effective_price = self.price
+        if self.price is not None and pct is not None:
+            effective_price = self.price * (1 - pct / 100)
+        return {
+            'effective_price': effective_price,
+            'active_discount_pct': pct,
+            'discount_ends_at': best.discount_end if best else None,
+            'price_recompute_at': min(boundaries) if boundaries else None,
+        }
+
+    @classmethod
+    def refresh_pricing(cls, filter_q=None, batch_size=500):
+        """
+        Recompute the materialized pricing columns for the products matching
+        ``filter_q`` (all products when omitted), in keyset batches.
+        Returns the number of rows that changed.
+        """
+        now = timezone.now()
+        queryset = cls.objects.all()
+        if filter_q is not None:
+            queryset = queryset.filter(filter_q)
+        queryset = queryset.order_by('pk').only('pk', 'price', 'category_id', *PRICING_FIELDS)
+
+        changed_count = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+
+            product_ids = [product.pk for product in batch]
+            category_ids = {product.category_id for product in batch if product.category_id}
+            by_product = defaultdict(list)
+            by_category = defaultdict(list)
+            discounts = Discount.objects.filter(
+                models.Q(product_id__in=product_ids) | models.Q(category_id__in=category_ids),
+                is_active=True,
+                discount_end__gte=now,
+            )
+            for discount in discounts:
+                if discount.product_id:
+                    by_product[discount.product_id].append(discount)
+                else:
+                    by_category[discount.category_id].append(discount)
+
+            changed = []
+            for product in batch:
+                values = product.pricing_from_discounts(
+                    by_product[product.pk] + by_category[product.category_id], now
+                )
+                if any(getattr(product, field) != value for field, value in values.items()):
+                    for field, value in values.items():
+                        setattr(product, field, value)
+                    changed.append(product)
+
+            if changed:
+                cls.objects.bulk_update(changed, PRICING_FIELDS)
+                note_price_boundaries(product.price_recompute_at for product in changed)
+                changed_count += len(changed)
+        if changed_count:
+            forget_passed_price_boundaries()
+            bump_catalog_version()
+        return changed_count
+
+    def _current_pricing_discounts(self, now):
+        target = models.Q()
+        if self.pk:
+            target |= models.Q(product_id=self.pk)
+        if self.category_id:
+            target |= models.Q(category_id=self.category_id)
+        if not target:
+            return []
+        return list(Discount.objects.filter(target, is_active=True, discount_end__gte=now))
+
     def main_image(self):
-        """Get the main product image from ProductImage"""
-        images = self.images.all()
-        if images.exists():
-            return random.choice(images).image
+        """
+        Get the cover image file.
+
+        Uses the stored ``cover_image`` (one join when it is selected/prefetched).
+        With ``PRODUCT_COVER_DAILY_ROTATION`` the cover rotates over the product's
+        images once a day, seeded by the date so every request that day agrees.
+        """
+        if getattr(settings, 'PRODUCT_COVER_DAILY_ROTATION', False):
+            images = list(self.images.all())
+            if images:
+                seed = timezone.localdate().toordinal() + self.pk
+                return images[seed % len(images)].image
+        if self.cover_image_id:
+            return self.cover_image.image
         return None
 
+    def refresh_cover_image(self):
+        """Point ``cover_image`` at the oldest remaining image (or clear it)."""
+        self.cover_image = self.images.order_by('created_at', 'id').first()
+        Product.objects.filter(pk=self.pk).update(cover_image=self.cover_image)
+        bump_catalog_version()
+
+    @classmethod
+    def assign_missing_covers(cls, product_ids=None):
+        """Give every product that has images but no cover its oldest image."""
+        oldest_image = ProductImage.objects.filter(
+            product=models.OuterRef('pk')
+        ).order_by('created_at', 'id').values('id')[:1]
+        queryset = cls.objects.filter(
+            models.Exists(ProductImage.objects.filter(product=models.OuterRef('pk'))),
+            cover_image__isnull=True,
+        )
+        if product_ids is not None:
+            queryset = queryset.filter(pk__in=product_ids)
+        assigned = queryset.update(cover_image=models.Subquery(oldest_image))
+        # Also covers bulk-created images, which never send post_save
+        bump_catalog_version()
+        return assigned
+
     def images(self):
         return self.images.all()
 
     def number_of_ratings(self):
-        return self.ratings.count()
+        return self.ratings_count
 
     def average_rating(self):
-        ratings = self.ratings.all()
-        if ratings.exists():
-            return round(sum(rating.star_number for rating in ratings) / ratings.count(), 1)
+        if self.ratings_count:
+            return round(self.ratings_avg, 1)
         return 0.0
 
+    @classmethod
+    def apply_rating_change(cls, product_id, count_delta=0, sum_delta=0):
+        """Atomically shift the stored rating aggregates of one product."""
+        new_count = Greatest(F('ratings_count') + count_delta, Value(0))
+        new_sum = Greatest(F('ratings_sum') + sum_delta, Value(0))
+        cls.objects.filter(pk=product_id).update(
+            ratings_count=new_count,
+            ratings_sum=new_sum,
+            ratings_avg=Case(
+                When(ratings_count__gt=-count_delta, then=Cast(new_sum, FloatField()) / new_count),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
+        )
+
+    @classmethod
+    def refresh_rating_aggregates(cls, product_id):
+        """Recompute one product's stored rating aggregates from its ratings."""
+        stats = Rating.objects.filter(product_id=product_id).aggregate(count=Count('id'), total=Sum('star_number'))
+        count, total = stats['count'], stats['total'] or 0
+        cls.objects.filter(pk=product_id).update(
+            ratings_count=count, ratings_sum=total, ratings_avg=(total / count) if count else 0.0
+        )
+
     def __str__(self):
         return self.name
 
@@ -236,9 +436,18 @@ class Product(models.Model):
         # Validate unique product name per subject, teacher, and year
         self.validate_unique_product_name()
         
+        # Keep the materialized pricing columns in step with price/category edits
+        now = timezone.now()
+        for field, value in self.pricing_from_discounts(self._current_pricing_discounts(now), now).items():
+            setattr(self, field, value)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'price', 'category'} & set(update_fields):
+            kwargs['update_fields'] = list(update_fields) + PRICING_FIELDS
+
         # Save first to get the ID if this is a new product
         is_new = not self.pk
         super().save(*args, **kwargs)
+        note_price_boundaries([self.price_recompute_at])
         
         # Generate product_number after saving to ensure we have an ID
         if is_new and not self.product_number:
@@ -348,6 +557,19 @@ class ProductImage(models.Model):
     def __str__(self):
         return f"Image for {self.product.name}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # First image of a product becomes its cover
+        Product.objects.filter(pk=self.product_id, cover_image__isnull=True).update(cover_image=self)
+
+    def delete(self, *args, **kwargs):
+        product = self.product
+        was_cover = product.cover_image_id == self.pk
+        result = super().delete(*args, **kwargs)
+        if was_cover:
+            product.refresh_cover_image()
+        return result
+
 class ProductDescription(models.Model):
     product = models.ForeignKey(
         Product, 
@@ -368,8 +590,22 @@ class ProductDescription(models.Model):
     def __str__(self):
         return f"{self.title} - {self.product.name}"
 
+class ProductSearchDocument(models.Model):
+    """Normalized search text for one product, maintained by ``products.search``."""
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document'
+    )
+    content = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Search document for product {self.product_id}"
+
 class PillItem(models.Model):
-    pill = models.ForeignKey('Pill', on_delete=models.CASCADE, null=True, blank=True, related_name='pill_items')
+    pill = models.ForeignKey('Pill', on_delete=models.CASCADE, null=True, blank=True, related_name='items')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pill_items', null=True, blank=True)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='pill_items')
     status = models.CharField(choices=PILL_STATUS_CHOICES, max_length=2, null=True, blank=True)
@@ -399,12 +635,15 @@ class PillItem(models.Model):
 
 class Pill(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pills')
-    items = models.ManyToManyField(PillItem, related_name='pills')
     status = models.CharField(choices=PILL_STATUS_CHOICES, max_length=2, default='i')
     date_added = models.DateTimeField(auto_now_add=True)
     coupon = models.ForeignKey('CouponDiscount', on_delete=models.SET_NULL, null=True, blank=True, related_name='pills')
     coupon_discount = models.FloatField(default=0.0)  # Stores discount amount
     pill_number = models.CharField(max_length=20, editable=False, unique=True, default=generate_pill_number)
+    # Order totals snapshotted at checkout / coupon application and frozen once the
+    # pill leaves 'i' (initiated); see Pill.freeze_totals
+    subtotal = models.FloatField(null=True, blank=True, editable=False)
+    total = models.FloatField(null=True, blank=True, editable=False, db_index=True)
     
     # Shake-out fields (replacing Fawaterak)
     shakeout_invoice_id = models.CharField(max_length=255, null=True, blank=True, help_text="Shake-out invoice ID")
@@ -437,46 +676,126 @@ class Pill(models.Model):
         if not is_new:
             previous_status = Pill.objects.filter(pk=self.pk).values_list('status', flat=True).first()
 
-        super().save(*args, **kwargs)
+        # Prices stop following the catalog once the order leaves 'initiated'
+        if previous_status == 'i' and self.status != 'i':
+            self.freeze_totals()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'subtotal', 'total'}
 
-        # For new orders, sync status to items
         if is_new:
-            for item in self.items.all():
-                item.status = self.status
-                if self.status == 'p' and not item.date_sold:
-                    item.date_sold = timezone.now()
-                if self.status == 'p' and not item.price_at_sale:
-                    item.price_at_sale = item.product.discounted_price()
-                item.save()
-
-        # When pill status becomes 'p', update all pill items to 'p' as well
-        if self.status == 'p' and (is_new or previous_status != 'p'):
-            for item in self.items.all():
-                item.status = 'p'
-                if not item.date_sold:
-                    item.date_sold = timezone.now()
-                if not item.price_at_sale:
-                    item.price_at_sale = item.product.discounted_price()
-                item.save(update_fields=['status', 'date_sold', 'price_at_sale'])
+            self._insert_with_number(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
+        # A new pill has no items yet (they are attached after it is saved);
+        # when it becomes paid, mark every item paid and grant the books.
+        if not is_new and self.status == 'p' and previous_status != 'p':
+            self.mark_items_paid()
             self.grant_purchased_books()
 
-    def items_subtotal(self):
-        """Return the subtotal for the pill using current discounted product prices."""
-        total = 0.0
-        for item in self.items.select_related('product').all():
-            product = getattr(item, 'product', None)
-            if not product:
+    def _insert_with_number(self, *args, **kwargs):
+        # Two processes sharing a worker id can produce the same number; the
+        # unique index catches it and the pill retries with a new worker id.
+        for attempt in range(PILL_NUMBER_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == PILL_NUMBER_ATTEMPTS - 1 or not Pill.objects.filter(pill_number=self.pill_number).exists():
+                    raise
+                logger.warning("Pill number %s already taken, retrying with a new worker id", self.pill_number)
+                pill_numbers.renew_worker_id()
+                self.pill_number = generate_pill_number()
+
+    def mark_items_paid(self):
+        """Set-based: price every unpriced item from one batch and write them in one update."""
+        from .loaders import ProductBatchLoader
+
+        items = list(self.items.select_related('product'))
+        if not items:
+            return
+        loader = ProductBatchLoader(relations=())
+        loader.prime([item.product for item in items])
+        now = timezone.now()
+        for item in items:
+            item.status = 'p'
+            if not item.date_sold:
+                item.date_sold = now
+            if not item.price_at_sale:
+                item.price_at_sale = loader.discounted_price(item.product)
+        PillItem.objects.bulk_update(items, ['status', 'date_sold', 'price_at_sale'])
+
+    def _items_with_products(self):
+        if 'items' in getattr(self, '_prefetched_objects_cache', {}):
+            return list(self.items.all())
+        return list(self.items.select_related('product'))
+
+    def price_items(self, items=None, live=None):
+        """
+        Return ``[(item, unit_price)]``. Initiated pills (or ``live=True``) use
+        current discounted prices, one batch for all items; later statuses keep
+        ``price_at_sale``.
+        """
+        from .loaders import ProductBatchLoader
+
+        if live is None:
+            live = self.status == 'i'
+        items = self._items_with_products() if items is None else items
+        loader = ProductBatchLoader(relations=())
+        loader.prime([item.product for item in items if item.product_id])
+        priced = []
+        for item in items:
+            if not item.product_id:
                 continue
-            price = product.discounted_price()
-            if price is None:
-                price = product.price or 0.0
-            total += float(price)
-        return total
+            if not live and item.price_at_sale is not None:
+                price = item.price_at_sale
+            else:
+                price = loader.discounted_price(item.product)
+                if price is None:
+                    price = item.product.price or 0.0
+            priced.append((item, float(price)))
+        return priced
+
+    def compute_totals(self, items=None, live=None):
+        """``(subtotal, total)`` from the items and the applied coupon (``live`` as in ``price_items``)."""
+        subtotal = round(sum(price for _, price in self.price_items(items, live=live)), 2)
+        discount = float(self.coupon_discount or 0.0)
+        return subtotal, round(max(0.0, subtotal - discount), 2)
+
+    def snapshot_totals(self, save=True):
+        """Store the subtotal/total of the items' price snapshots (after items are added or removed)."""
+        self.subtotal, self.total = self.compute_totals(live=False)
+        if save and self.pk:
+            Pill.objects.filter(pk=self.pk).update(subtotal=self.subtotal, total=self.total)
+
+    def freeze_totals(self):
+        """
+        Store the totals from the prices snapshotted at checkout. Only items
+        without a snapshot (older rows) are priced now and get one written.
+        """
+        priced = self.price_items(live=False)
+        unpriced = []
+        for item, price in priced:
+            if item.price_at_sale is None:
+                item.price_at_sale = price
+                unpriced.append(item)
+        if unpriced:
+            PillItem.objects.bulk_update(unpriced, ['price_at_sale'])
+        subtotal = round(sum(price for _, price in priced), 2)
+        self.subtotal = subtotal
+        self.total = round(max(0.0, subtotal - float(self.coupon_discount or 0.0)), 2)
+
+    def items_subtotal(self):
+        """Subtotal: stored once the pill left 'i', otherwise current discounted prices."""
+        if self.status != 'i' and self.subtotal is not None:
+            return self.subtotal
+        return self.compute_totals()[0]
 
     def final_price(self):
-        subtotal = self.items_subtotal()
-        discount = float(self.coupon_discount or 0.0)
-        return round(max(0.0, float(subtotal) - discount), 2)
+        if self.status != 'i' and self.total is not None:
+            return self.total
+        return self.compute_totals()[1]
 
     def check_all_items_availability(self):
         """Digital products are always available, so mark everything as in stock."""
@@ -489,23 +808,34 @@ class Pill(models.Model):
         }
 
     def grant_purchased_books(self):
-        from .models import PurchasedBook
+        from .caching import bump_library_version
 
-        items = self.items.select_related('product').all()
-        for item in items:
-            product = getattr(item, 'product', None)
-            if not product:
-                continue
+        items = [item for item in self.items.select_related('product') if item.product_id]
+        if not items:
+            return
 
-            PurchasedBook.objects.update_or_create(
-                user=self.user,
+        # One upsert on (user, product): safe when the webhooks, the status
+        # check and Pill.save grant the same pill concurrently. Prices come
+        # from the items, frozen when the pill left 'initiated'.
+        books = [
+            PurchasedBook(
+                user_id=self.user_id,
                 pill=self,
-                product=product,
-                defaults={
-                    'product_name': product.name,
-                    'pill_item': item
-                }
+                product=item.product,
+                product_name=item.product.name,
+                pill_item=item,
+                price_at_sale=price,
             )
+            for item, price in self.price_items(items, live=False)
+        ]
+        PurchasedBook.objects.bulk_create(
+            books,
+            update_conflicts=True,
+            unique_fields=['user', 'product'],
+            update_fields=['pill', 'pill_item', 'product_name', 'price_at_sale'],
+        )
+        # bulk writes skip the post_save signal that versions the library
+        bump_library_version(self.user_id)
 
     def send_payment_notification(self):
         """Notify the user that payment succeeded. Currently sends WhatsApp if parent_phone exists."""
@@ -553,8 +883,89 @@ class Pill(models.Model):
     def __str__(self):
         return f"Pill ID: {self.id} - Status: {self.get_status_display()} - Date: {self.date_added}"
 
+
+PAYMENT_REFERENCE_KINDS = [
+    ('invoice_uid', 'Invoice UID'),
+    ('invoice_sequence', 'Invoice sequence'),
+    ('fawry_ref', 'Fawry reference'),
+    ('invoice_id', 'Invoice ID'),
+    ('invoice_ref', 'Invoice reference'),
+]
+
+# Pill column holding each (gateway, kind) reference, used by the backfill
+PAYMENT_REFERENCE_FIELDS = {
+    ('easypay', 'invoice_uid'): 'easypay_invoice_uid',
+    ('easypay', 'invoice_sequence'): 'easypay_invoice_sequence',
+    ('easypay', 'fawry_ref'): 'easypay_fawry_ref',
+    ('shakeout', 'invoice_id'): 'shakeout_invoice_id',
+    ('shakeout', 'invoice_ref'): 'shakeout_invoice_ref',
+}
+
+
+class PaymentReference(models.Model):
+    """
+    Gateway identifiers of a pill's invoices, so webhooks and admin search
+    find the pill with one probe of the unique index instead of scanning
+    the unindexed invoice columns on ``Pill``.
+    """
+    gateway = models.CharField(max_length=20, choices=PAYMENT_GATEWAY_CHOICES)
+    kind = models.CharField(max_length=20, choices=PAYMENT_REFERENCE_KINDS)
+    value = models.CharField(max_length=255)
+    pill = models.ForeignKey(Pill, on_delete=models.CASCADE, related_name='payment_references')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['gateway', 'kind', 'value']
+        indexes = [
+            models.Index(fields=['value']),  # Admin search across gateways
+        ]
+
+    def __str__(self):
+        return f"{self.gateway} {self.kind} {self.value}"
+
+    @classmethod
+    def record(cls, pill, gateway, **references):
+        """Point the given ``kind=value`` references at ``pill`` (a re-issued reference moves over)."""
+        rows = [
+            cls(pill=pill, gateway=gateway, kind=kind, value=str(value))
+            for kind, value in references.items() if value
+        ]
+        cls.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=['gateway', 'kind', 'value'],
+            update_fields=['pill'],
+        )
+
+    @classmethod
+    def find_pill(cls, gateway, kind, value):
+        """
+        The pill with this reference. Invoices issued before the table was
+        backfilled are found on the legacy ``Pill`` column (a scan, only on a
+        miss) and recorded, so the next lookup hits the index.
+        """
+        if not value:
+            return None
+        pill = Pill.objects.filter(
+            payment_references__gateway=gateway,
+            payment_references__kind=kind,
+            payment_references__value=str(value),
+        ).first()
+        if pill is None:
+            pill = Pill.objects.filter(**{PAYMENT_REFERENCE_FIELDS[(gateway, kind)]: str(value)}).order_by('-id').first()
+            if pill is not None:
+                cls.record(pill, gateway, **{kind: value})
+        return pill
+
+    @classmethod
+    def search(cls, value):
+        """Ids of the pills with any gateway reference equal to ``value``."""
+        return list(cls.objects.filter(value=value).values_list('pill_id', flat=True))
+
+
 class CouponDiscount(models.Model):
-    coupon = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    coupon = models.CharField(max_length=100, blank=True, null=True, editable=False, unique=True)
+    code_normalized = models.CharField(max_length=100, unique=True, null=True, blank=True, editable=False)
     discount_value = models.FloatField(null=True, blank=True)
     coupon_start = models.DateTimeField(null=True, blank=True)
     coupon_end = models.DateTimeField(null=True, blank=True)
@@ -562,11 +973,74 @@ class CouponDiscount(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     min_order_value = models.FloatField(null=True, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
+    sharded = models.BooleanField(
+        default=False, editable=False,
+        help_text="Remaining uses are counted in CouponCounterShard rows (see products.coupons)"
+    )
 
     def save(self, *args, **kwargs):
-        if not self.coupon:
+        # A new quota on a sharded coupon is spread over the shards again
+        reset_shards = bool(self.pk and self.sharded) and CouponDiscount.objects.filter(
+            pk=self.pk
+        ).exclude(available_use_times=self.available_use_times).exists()
+        self._save_with_code(*args, **kwargs)
+        if reset_shards:
+            from .coupons import build_shards
+            build_shards(self)
+
+    def _save_with_code(self, *args, **kwargs):
+        if self.coupon:
+            self.code_normalized = normalize_coupon_code(self.coupon)
+            return super().save(*args, **kwargs)
+        # Generated codes retry on the rare clash with the unique index
+        for attempt in range(COUPON_CREATE_ATTEMPTS):
             self.coupon = create_random_coupon()
-        super().save(*args, **kwargs)
+            self.code_normalized = normalize_coupon_code(self.coupon)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == COUPON_CREATE_ATTEMPTS - 1:
+                    raise
+
+    @property
+    def remaining_uses(self):
+        """Uses left: the shard total for sharded coupons, ``available_use_times`` otherwise."""
+        if not self.sharded:
+            return self.available_use_times
+        return sum(shard.remaining for shard in self.counter_shards.all())
+
+    @classmethod
+    def bulk_generate(cls, count, batch_size=1000, **fields):
+        """
+        Create ``count`` coupons sharing ``fields`` with one INSERT per batch.
+        Codes are unique within the run by construction; a batch is retried
+        (with fresh codes for the taken ones) only when it collides with
+        existing coupons.
+        """
+        created = []
+        issued = set()
+        while len(created) < count:
+            codes = unique_coupon_codes(min(batch_size, count - len(created)), exclude=issued)
+            for attempt in range(COUPON_CREATE_ATTEMPTS):
+                try:
+                    with transaction.atomic():
+                        batch = cls.objects.bulk_create([
+                            cls(coupon=code, code_normalized=normalize_coupon_code(code), **fields) for code in codes
+                        ])
+                    break
+                except IntegrityError:
+                    if attempt == COUPON_CREATE_ATTEMPTS - 1:
+                        raise
+                    taken = set(
+                        cls.objects.filter(models.Q(coupon__in=codes) | models.Q(code_normalized__in=codes))
+                        .values_list('coupon', flat=True)
+                    )
+                    issued |= taken
+                    codes = (codes - taken) | unique_coupon_codes(len(taken), exclude=issued | codes)
+            issued |= codes
+            created.extend(batch)
+        return created
 
     def __str__(self):
         return self.coupon
@@ -574,6 +1048,35 @@ class CouponDiscount(models.Model):
     class Meta:
         ordering = ['-created_at']
 
+
+class CouponCounterShard(models.Model):
+    """One slice of a high-use coupon's remaining uses, so redemptions spread their writes."""
+    coupon = models.ForeignKey(CouponDiscount, on_delete=models.CASCADE, related_name='counter_shards')
+    shard = models.PositiveSmallIntegerField()
+    remaining = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['coupon', 'shard']
+
+    def __str__(self):
+        return f"{self.coupon} shard {self.shard}: {self.remaining}"
+
+
+class CouponRedemption(models.Model):
+    """Ledger of coupon uses: one row per (coupon, pill), so a pill can never use a coupon twice."""
+    coupon = models.ForeignKey(CouponDiscount, on_delete=models.CASCADE, related_name='redemptions')
+    pill = models.ForeignKey('Pill', on_delete=models.CASCADE, related_name='coupon_redemptions')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='coupon_redemptions')
+    shard = models.PositiveSmallIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        unique_together = ['coupon', 'pill']
+
+    def __str__(self):
+        return f"{self.coupon} on {self.pill_id}"
+
 class Rating(models.Model):
     product = models.ForeignKey(
         Product,
@@ -622,7 +1125,27 @@ class Discount(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
+        previous = None
+        if self.pk:
+            previous = Discount.objects.filter(pk=self.pk).values('product_id', 'category_id').first()
         super().save(*args, **kwargs)
+        self.refresh_target_pricing(previous)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.refresh_target_pricing()
+        return result
+
+    def refresh_target_pricing(self, previous=None):
+        """Recompute the materialized prices of the products this discount touches."""
+        product_ids = {self.product_id}
+        category_ids = {self.category_id}
+        if previous:
+            product_ids.add(previous['product_id'])
+            category_ids.add(previous['category_id'])
+        product_ids.discard(None)
+        category_ids.discard(None)
+        Product.refresh_pricing(models.Q(pk__in=product_ids) | models.Q(category_id__in=category_ids))
 
     @property
     def is_currently_active(self):
@@ -661,6 +1184,7 @@ class PurchasedBook(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        unique_together = ['user', 'product']
 
     def save(self, *args, **kwargs):
         # Auto-fill product_name from product if not provided
@@ -682,6 +1206,112 @@ class PurchasedBook(models.Model):
         return f"{self.product_name} - {self.user}"
 
 
+class ArchivedPill(models.Model):
+    """Compact copy of an unpaid pill removed by ``manage.py reap_initiated_pills --archive``."""
+    pill_id = models.BigIntegerField(unique=True)
+    pill_number = models.CharField(max_length=20, db_index=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='archived_pills')
+    status = models.CharField(choices=PILL_STATUS_CHOICES, max_length=2)
+    date_added = models.DateTimeField()
+    coupon_code = models.CharField(max_length=100, null=True, blank=True)
+    coupon_discount = models.FloatField(default=0.0)
+    subtotal = models.FloatField(null=True, blank=True)
+    total = models.FloatField(null=True, blank=True)
+    payment_gateway = models.CharField(max_length=20, null=True, blank=True)
+    items = models.JSONField(default=list, help_text="[{product_id, price_at_sale}] of the pill's items")
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-date_added']
+
+    def __str__(self):
+        return f"Archived pill {self.pill_number}"
+
+
+JOB_STATUS_CHOICES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('succeeded', 'Succeeded'),
+    ('failed', 'Failed'),
+]
+
+
+class BackgroundJob(models.Model):
+    """A unit of work run outside the request by ``manage.py run_jobs`` (see ``products.jobs``)."""
+    kind = models.CharField(max_length=50, db_index=True)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default='queued')
+    total = models.PositiveIntegerField(null=True, blank=True)
+    processed = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='background_jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['status', 'heartbeat_at']),
+        ]
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 100 if self.status == 'succeeded' else 0
+        return min(100, round(self.processed * 100 / self.total))
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+
+WEBHOOK_STATUS_CHOICES = [
+    ('received', 'Received'),
+    ('processing', 'Processing'),
+    ('processed', 'Processed'),
+    ('failed', 'Failed'),
+]
+
+
+class WebhookInboxEntry(models.Model):
+    """
+    A verified gateway callback, stored before it is acknowledged and applied
+    later by ``manage.py drain_webhooks`` (see ``products.webhook_inbox``).
+    A redelivery of the same (gateway, reference, event status) is dropped.
+    """
+    gateway = models.CharField(max_length=20, choices=PAYMENT_GATEWAY_CHOICES)
+    reference = models.CharField(max_length=100, help_text='EasyPay sequence / Shake-out invoice id')
+    event_status = models.CharField(max_length=50)
+    body = models.TextField()
+    headers = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=12, choices=WEBHOOK_STATUS_CHOICES, default='received')
+    pill = models.ForeignKey(Pill, on_delete=models.SET_NULL, null=True, blank=True, related_name='webhook_entries')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        unique_together = ['gateway', 'reference', 'event_status']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['gateway', 'reference', 'status']),
+        ]
+        verbose_name_plural = 'Webhook inbox'
+
+    def __str__(self):
+        return f"{self.gateway} {self.reference} {self.event_status} ({self.status})"
+
+
 def prepare_whatsapp_message(phone_number, pill):
     print(f"Preparing WhatsApp message for phone number: {phone_number}")
     message = (
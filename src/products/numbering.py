@@ -0,0 +1,112 @@
+"""
+Time-ordered pill numbers that are unique by construction.
+
+A pill number is 20 digits: 13 for the millisecond timestamp, 3 for the
+worker id and 4 for a per-worker sequence within the millisecond. Numbers
+from one worker never repeat and, because they start with the time, sort in
+creation order and append to the ``pill_number`` index instead of landing on
+random pages. No database lookup is needed.
+
+Worker ids must differ between live processes. Set ``PILL_NUMBER_WORKER_ID``
+per process, or, when the default cache is Redis/Memcached, each process
+leases the next id from a counter there (``cache.add`` + ``incr`` are atomic
+on those). A process-local cache (LocMem) would hand every process the same
+id, so without a shared cache the id is derived from the host name and
+process id. A clash is caught by the unique index and ``Pill.save`` retries;
+a derived id that clashed is replaced by a random one.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID_DIGITS = 3
+SEQUENCE_DIGITS = 4
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS - 1
+WORKER_REGISTRY_KEY = 'pill_number:worker_ids'
+SHARED_CACHE_BACKENDS = ('redis', 'memcached')
+
+
+def cache_is_shared():
+    """Whether the default cache is seen by every process (so a counter there is global)."""
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '').lower()
+    return any(name in backend for name in SHARED_CACHE_BACKENDS)
+
+
+def lease_worker_id():
+    """The next id from the shared registry counter, or ``None`` when the cache fails."""
+    try:
+        cache.add(WORKER_REGISTRY_KEY, -1, None)
+        return cache.incr(WORKER_REGISTRY_KEY) % 10 ** WORKER_ID_DIGITS
+    except Exception:
+        logger.warning("Could not lease a pill number worker id from the cache", exc_info=True)
+        return None
+
+
+def default_worker_id(clashed=False):
+    """
+    ``PILL_NUMBER_WORKER_ID`` when configured, otherwise leased from a shared
+    cache; derived from the host name and process id when there is none (or
+    it fails), and random once that derived id ``clashed``.
+    """
+    configured = getattr(settings, 'PILL_NUMBER_WORKER_ID', None)
+    if configured not in (None, ''):
+        return int(configured) % 10 ** WORKER_ID_DIGITS
+    if cache_is_shared():
+        leased = lease_worker_id()
+        if leased is not None:
+            return leased
+    if clashed:
+        return random.randrange(10 ** WORKER_ID_DIGITS)
+    seed = zlib.crc32(socket.gethostname().encode('utf-8')) + os.getpid()
+    return seed % 10 ** WORKER_ID_DIGITS
+
+
+class PillNumberGenerator:
+    def __init__(self, worker_id=None, clock=None):
+        self._worker_id = worker_id
+        self._pid = None
+        self._clashed = False
+        self._clock = clock or (lambda: int(time.time() * 1000))
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    @property
+    def worker_id(self):
+        # Re-derive after a fork so pre-forked workers do not share an id
+        if self._worker_id is None or (self._pid is not None and self._pid != os.getpid()):
+            self._worker_id = default_worker_id(clashed=self._clashed)
+            self._pid = os.getpid()
+            self._last_ms, self._sequence = -1, 0
+        return self._worker_id
+
+    def renew_worker_id(self):
+        """Forget the current id (its numbers clashed); the next number gets a new one."""
+        with self._lock:
+            self._worker_id = None
+            self._clashed = True
+
+    def next(self):
+        with self._lock:
+            worker_id = self.worker_id
+            now = max(self._clock(), self._last_ms)  # never step back if the clock does
+            if now == self._last_ms:
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    now, self._sequence = now + 1, 0  # borrow the next millisecond
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return f'{now:013d}{worker_id:0{WORKER_ID_DIGITS}d}{self._sequence:0{SEQUENCE_DIGITS}d}'
+
+
+pill_numbers = PillNumberGenerator()
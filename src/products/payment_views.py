@@ -9,80 +9,19 @@ from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import redirect
-from django.utils import timezone
+from django.urls import reverse
 import json
 import logging
-import time
 
-from products.models import Pill
+from products import invoices, jobs
+from products.models import BackgroundJob, Pill
+from services.circuit_breaker import is_available
 from services.fawaterak_service import fawaterak_service
-from services.shakeout_service import shakeout_service  # Add Shake-out service import
 from services.easypay_service import easypay_service  # Add EasyPay service import
 
 logger = logging.getLogger(__name__)
 
 
-def _serialize_easypay_invoice(pill, attempts=0):
-    data = pill.easypay_data or {}
-    payment_url = data.get('payment_url') or pill.easypay_payment_url
-    amount = data.get('amount') or pill.final_price()
-    invoice_details = data.get('invoice_details', {}) if isinstance(data, dict) else {}
-    fawry_ref = (
-        invoice_details.get('fawry_ref')
-        or data.get('fawry_ref')
-        or pill.easypay_fawry_ref
-    )
-
-    return {
-        'invoice_uid': pill.easypay_invoice_uid,
-        'invoice_sequence': pill.easypay_invoice_sequence,
-        'payment_url': payment_url,
-        'amount': str(amount) if amount is not None else None,
-        'pill_number': pill.pill_number,
-        'payment_method': data.get('payment_method', 'fawry'),
-        'payment_gateway': 'easypay',
-        'fawry_ref': fawry_ref,
-        'attempts': attempts
-    }
-
-
-def _serialize_shakeout_invoice(pill):
-    data = pill.shakeout_data or {}
-    payment_url = data.get('payment_url') or data.get('url') or pill.shakeout_payment_url
-    total_amount = data.get('total_amount') or float(pill.final_price())
-
-    return {
-        'invoice_id': pill.shakeout_invoice_id,
-        'invoice_ref': pill.shakeout_invoice_ref,
-        'payment_url': payment_url,
-        'total_amount': total_amount,
-        'payment_gateway': 'shakeout'
-    }
-
-def is_fawry_ref_error(fawry_ref):
-    """Check if fawry_ref contains an error"""
-    if not fawry_ref:
-        return True
-    
-    # Convert to string if it's not already
-    fawry_ref_str = str(fawry_ref)
-    
-    # Check if it contains error indicators
-    error_indicators = ['error', 'Error', 'ERROR', 'Invalid Merchant Code', 'statusCode', 'statusDescription']
-    
-    for indicator in error_indicators:
-        if indicator in fawry_ref_str:
-            return True
-    
-    # Check if it looks like a JSON error response
-    try:
-        if fawry_ref_str.startswith('{') and 'error' in fawry_ref_str.lower():
-            return True
-    except:
-        pass
-    
-    return False
-
 class CustomJWTAuthentication(JWTAuthentication):
     """Custom JWT authentication that checks both 'Authorization' and 'auth' headers"""
     
@@ -385,157 +324,104 @@ class PaymentPendingView(APIView):
             frontend_url = f"https://bookefay.com?pill_number={pill_number}&payment_status=error"
             return redirect(frontend_url)
 
+def _stock_unavailable_response(pill):
+    """The 400 answered when an item of the pill is out of stock, or ``None``."""
+    logger.info(f"Checking stock availability for pill {pill.id}")
+    availability_check = pill.check_all_items_availability()
+    if availability_check['all_available']:
+        return None
+
+    logger.warning(f"Stock problems found for pill {pill.id}: {availability_check['problem_items_count']} items")
+
+    # Create detailed error message for each problem item
+    problem_details = []
+    for item in availability_check['problem_items']:
+        if item['reason'] == 'out_of_stock':
+            problem_details.append(f"{item['product_name']} غير متاح حالياً")
+        elif item['reason'] == 'insufficient_quantity':
+            problem_details.append(f"{item['product_name']} متاح فقط {item['available_quantity']} قطعة من أصل {item['required_quantity']} مطلوبة")
+        else:
+            problem_details.append(f"{item['product_name']} غير متاح")
+
+    return Response({
+        'success': False,
+        'error_code': 'STOCK_UNAVAILABLE',
+        'error': 'هذا المنتج لم يعد متاحا الان , يمكنك حذفه من الفاتورة والاستكمال بباقى المنتجات او الذهاب للصفحة الرئيسية لانشاء فاتورة جديدة',
+        'details': {
+            'problem_items': availability_check['problem_items'],
+            'problem_details': problem_details,
+            'total_items': availability_check['total_items'],
+            'problem_items_count': availability_check['problem_items_count']
+        }
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _gateway_unavailable_response(pill, gateway):
+    """Answered at once while the gateway's circuit breaker is open, instead of waiting for its timeout."""
+    logger.warning(f"{gateway} circuit is open, not creating an invoice for pill {pill.id}")
+    return Response({
+        'success': False,
+        'error_code': 'GATEWAY_UNAVAILABLE',
+        'error': 'بوابة الدفع غير متاحة حاليا , برجاء المحاولة مرة اخرى بعد قليل',
+        'payment_gateway': gateway,
+        'pill_number': pill.pill_number
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def _invoice_job_response(request, pill, gateway):
+    """
+    Queue the gateway call for a ``run_jobs`` worker (or reuse the pill's
+    pending job) and answer 202 with the URL to poll for the invoice.
+    """
+    job = invoices.pending_invoice_job(pill, gateway)
+    if job is None:
+        job = jobs.enqueue(
+            invoices.INVOICE_JOB,
+            {'pill_id': pill.id, 'gateway': gateway},
+            user=request.user,
+            max_attempts=invoices.INVOICE_JOB_ATTEMPTS,
+        )
+        logger.info(f"Queued {gateway} invoice job {job.id} for pill {pill.id}")
+
+    return Response({
+        'success': True,
+        'message': 'Invoice creation queued',
+        'job_id': job.id,
+        'status': job.status,
+        'payment_gateway': job.payload['gateway'],
+        'pill_number': pill.pill_number,
+        'status_url': reverse('products:invoice_job_status', kwargs={'pill_id': pill.id, 'job_id': job.id}),
+    }, status=status.HTTP_202_ACCEPTED)
+
+
 class CreateShakeoutInvoiceView(APIView):
     authentication_classes = [CustomJWTAuthentication]
     permission_classes = [IsAuthenticated]
     
     def post(self, request, pill_id):
-        """Create a Shake-out invoice for a pill"""
+        """Queue a Shake-out invoice for a pill"""
         try:
             logger.info(f"Starting Shake-out invoice creation for pill {pill_id}, user: {request.user}")
             
             pill = get_object_or_404(Pill, id=pill_id, user=request.user)
             logger.info(f"Pill found: {pill.pill_number}")
             
-            # Check if pill already has a Shake-out invoice
-            if pill.shakeout_invoice_id:
-                # Check if the existing invoice is expired or invalid
-                if pill.is_shakeout_invoice_expired():
-                    logger.info(f"Existing Shake-out invoice {pill.shakeout_invoice_id} for pill {pill_id} is expired/invalid - creating new one")
-                    
-                    # Clear old invoice data to create a new one
-                    pill.shakeout_invoice_id = None
-                    pill.shakeout_invoice_ref = None
-                    pill.shakeout_data = None
-                    pill.shakeout_created_at = None
-                    pill.save(update_fields=['shakeout_invoice_id', 'shakeout_invoice_ref', 'shakeout_data', 'shakeout_created_at'])
-                else:
-                    logger.warning(f"Pill {pill_id} already has active Shake-out invoice: {pill.shakeout_invoice_id}")
-                    return Response({
-                        'success': True,
-                        'message': 'Shakeout invoice already exists',
-                        'data': _serialize_shakeout_invoice(pill)
-                    }, status=status.HTTP_200_OK)
-            
-            # Check stock availability before creating invoice
-            logger.info(f"Checking stock availability for pill {pill_id}")
-            availability_check = pill.check_all_items_availability()
-            
-            if not availability_check['all_available']:
-                logger.warning(f"Stock problems found for pill {pill_id}: {availability_check['problem_items_count']} items")
-                
-                # Create detailed error message for each problem item
-                problem_details = []
-                for item in availability_check['problem_items']:
-                    if item['reason'] == 'out_of_stock':
-                        problem_details.append(f"{item['product_name']} غير متاح حالياً")
-                    elif item['reason'] == 'insufficient_quantity':
-                        problem_details.append(f"{item['product_name']} متاح فقط {item['available_quantity']} قطعة من أصل {item['required_quantity']} مطلوبة")
-                    else:
-                        problem_details.append(f"{item['product_name']} غير متاح")
-                
+            if invoices.has_active_invoice(pill, 'shakeout'):
+                logger.warning(f"Pill {pill_id} already has active Shake-out invoice: {pill.shakeout_invoice_id}")
                 return Response({
-                    'success': False,
-                    'error_code': 'STOCK_UNAVAILABLE',
-                    'error': 'هذا المنتج لم يعد متاحا الان , يمكنك حذفه من الفاتورة والاستكمال بباقى المنتجات او الذهاب للصفحة الرئيسية لانشاء فاتورة جديدة',
-                    'details': {
-                        'problem_items': availability_check['problem_items'],
-                        'problem_details': problem_details,
-                        'total_items': availability_check['total_items'],
-                        'problem_items_count': availability_check['problem_items_count']
-                    }
-                }, status=status.HTTP_400_BAD_REQUEST)
+                    'success': True,
+                    'message': 'Shakeout invoice already exists',
+                    'data': invoices.serialize_shakeout_invoice(pill)
+                }, status=status.HTTP_200_OK)
             
-            logger.info(f"All items available for pill {pill_id}, proceeding with Shake-out invoice creation")
+            unavailable = _stock_unavailable_response(pill)
+            if unavailable is not None:
+                return unavailable
             
-            # Try creating the invoice with retry logic for fawry_ref errors
-            max_retries = 2  # Initial attempt + 1 retry
-            retry_delay = 10  # 10 seconds
+            if not is_available('shakeout'):
+                return _gateway_unavailable_response(pill, 'shakeout')
             
-            for attempt in range(max_retries):
-                logger.info(f"Shake-out invoice creation attempt {attempt + 1} for pill {pill_id}")
-                
-                result = shakeout_service.create_payment_invoice(pill)
-                logger.info(f"shakeout_service.create_payment_invoice returned: {result}")
-                
-                if result['success']:
-                    # Extract invoice data from successful response
-                    invoice_id = result['data'].get('invoice_id', '')
-                    invoice_ref = result['data'].get('invoice_ref', '')
-                    
-                    # Check if there's a fawry_ref in the response that might contain an error
-                    fawry_ref = result['data'].get('fawry_ref', '')
-                    if fawry_ref:
-                        fawry_ref = str(fawry_ref)
-                        
-                        # Check if fawry_ref contains an error
-                        if is_fawry_ref_error(fawry_ref):
-                            logger.warning(f"Shake-out fawry_ref contains error on attempt {attempt + 1}: {fawry_ref}")
-                            
-                            if attempt < max_retries - 1:  # Not the last attempt
-                                logger.info(f"Waiting {retry_delay} seconds before retry...")
-                                time.sleep(retry_delay)
-                                continue  # Retry
-                            else:
-                                # Last attempt failed, return error
-                                logger.error(f"Shake-out fawry_ref still contains error after {max_retries} attempts")
-                                return Response({
-                                    'success': False,
-                                    'error': f'Shake-out invoice creation failed: Invalid Fawry reference after {max_retries} attempts',
-                                    'details': {
-                                        'fawry_ref_error': fawry_ref,
-                                        'attempts': max_retries
-                                    },
-                                    'pill_number': pill.pill_number
-                                }, status=status.HTTP_400_BAD_REQUEST)
-                    
-                    # Invoice created successfully, proceed with saving
-                    logger.info(f"Shake-out invoice created successfully on attempt {attempt + 1}")
-                    
-                    # Update pill with invoice data from successful response
-                    pill.shakeout_invoice_id = result['data']['invoice_id']
-                    pill.shakeout_invoice_ref = result['data']['invoice_ref']
-                    pill.shakeout_data = result['data']
-                    pill.shakeout_created_at = timezone.now()
-                    pill.payment_gateway = 'shakeout'
-                    pill.status = 'w'
-                    pill.save(update_fields=['shakeout_invoice_id', 'shakeout_invoice_ref', 'shakeout_data', 'shakeout_created_at', 'payment_gateway', 'status'])
-                    
-                    return Response({
-                        'success': True,
-                        'message': result.get('message', 'Shake-out invoice created successfully'),
-                        'data': {
-                            'invoice_id': result['data']['invoice_id'],
-                            'invoice_ref': result['data']['invoice_ref'],
-                            'payment_url': result['data']['url'],
-                            'total_amount': result['data']['total_amount'],
-                            'pill_number': pill.pill_number,
-                            'currency': result['data']['currency'],
-                            'attempts': attempt + 1
-                        }
-                    }, status=status.HTTP_201_CREATED)
-                else:
-                    # Shake-out service returned an error
-                    logger.error(f"Shake-out service error on attempt {attempt + 1}: {result['error']}")
-                    
-                    if attempt < max_retries - 1:  # Not the last attempt
-                        logger.info(f"Waiting {retry_delay} seconds before retry...")
-                        time.sleep(retry_delay)
-                        continue  # Retry
-                    else:
-                        # Last attempt failed, return the service error
-                        response_data = {
-                            'success': False,
-                            'error': result['error'],
-                            'pill_number': pill.pill_number,
-                            'attempts': max_retries
-                        }
-                        
-                        # Include additional data if available (like existing invoice info)
-                        if result.get('data'):
-                            response_data['data'] = result['data']
-                        
-                        return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+            return _invoice_job_response(request, pill, 'shakeout')
                 
         except Exception as e:
             logger.error(f"Exception creating Shake-out invoice for pill {pill_id}: {str(e)}")
@@ -557,150 +443,29 @@ class CreateEasyPayInvoiceView(APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request, pill_id):
-        """Create an EasyPay invoice for a pill"""
+        """Queue an EasyPay invoice for a pill"""
         try:
             logger.info(f"Starting EasyPay invoice creation for pill {pill_id}, user: {request.user}")
             
             pill = get_object_or_404(Pill, id=pill_id, user=request.user)
             logger.info(f"Pill found: {pill.pill_number}")
             
-            # Check if pill already has an EasyPay invoice
-            if pill.easypay_invoice_uid:
-                # Check if the existing invoice is expired or invalid
-                if pill.is_easypay_invoice_expired():
-                    logger.info(f"Existing EasyPay invoice {pill.easypay_invoice_uid} for pill {pill_id} is expired/invalid - creating new one")
-                    
-                    # Clear old invoice data to create a new one
-                    pill.easypay_invoice_uid = None
-                    pill.easypay_invoice_sequence = None
-                    pill.easypay_fawry_ref = None
-                    pill.easypay_data = None
-                    pill.easypay_created_at = None
-                    pill.save(update_fields=['easypay_invoice_uid', 'easypay_invoice_sequence', 'easypay_fawry_ref', 'easypay_data', 'easypay_created_at'])
-                else:
-                    logger.warning(f"Pill {pill_id} already has active EasyPay invoice: {pill.easypay_invoice_uid}")
-                    return Response({
-                        'success': True,
-                        'message': 'EasyPay invoice already exists',
-                        'data': _serialize_easypay_invoice(pill, attempts=0)
-                    }, status=status.HTTP_200_OK)
-            
-            # Check stock availability before creating invoice
-            logger.info(f"Checking stock availability for pill {pill_id}")
-            availability_check = pill.check_all_items_availability()
-            
-            if not availability_check['all_available']:
-                logger.warning(f"Stock problems found for pill {pill_id}: {availability_check['problem_items_count']} items")
-                
-                # Create detailed error message for each problem item
-                problem_details = []
-                for item in availability_check['problem_items']:
-                    if item['reason'] == 'out_of_stock':
-                        problem_details.append(f"{item['product_name']} غير متاح حالياً")
-                    elif item['reason'] == 'insufficient_quantity':
-                        problem_details.append(f"{item['product_name']} متاح فقط {item['available_quantity']} قطعة من أصل {item['required_quantity']} مطلوبة")
-                    else:
-                        problem_details.append(f"{item['product_name']} غير متاح")
-                
+            if invoices.has_active_invoice(pill, 'easypay'):
+                logger.warning(f"Pill {pill_id} already has active EasyPay invoice: {pill.easypay_invoice_uid}")
                 return Response({
-                    'success': False,
-                    'error_code': 'STOCK_UNAVAILABLE',
-                    'error': 'هذا المنتج لم يعد متاحا الان , يمكنك حذفه من الفاتورة والاستكمال بباقى المنتجات او الذهاب للصفحة الرئيسية لانشاء فاتورة جديدة',
-                    'details': {
-                        'problem_items': availability_check['problem_items'],
-                        'problem_details': problem_details,
-                        'total_items': availability_check['total_items'],
-                        'problem_items_count': availability_check['problem_items_count']
-                    }
-                }, status=status.HTTP_400_BAD_REQUEST)
+                    'success': True,
+                    'message': 'EasyPay invoice already exists',
+                    'data': invoices.serialize_easypay_invoice(pill, attempts=0)
+                }, status=status.HTTP_200_OK)
             
-            logger.info(f"All items available for pill {pill_id}, proceeding with EasyPay invoice creation")
+            unavailable = _stock_unavailable_response(pill)
+            if unavailable is not None:
+                return unavailable
             
-            # Try creating the invoice with retry logic for fawry_ref errors
-            max_retries = 2  # Initial attempt + 1 retry
-            retry_delay = 10  # 10 seconds
+            if not is_available('easypay'):
+                return _gateway_unavailable_response(pill, 'easypay')
             
-            for attempt in range(max_retries):
-                logger.info(f"EasyPay invoice creation attempt {attempt + 1} for pill {pill_id}")
-                
-                result = easypay_service.create_payment_invoice(pill)
-                logger.info(f"easypay_service.create_payment_invoice returned: {result}")
-                
-                if result['success']:
-                    # Extract invoice data from successful response
-                    invoice_uid = result['data'].get('invoice_uid', '')
-                    invoice_sequence = result['data'].get('invoice_sequence', '')
-                    
-                    # Safely extract fawry_ref from nested invoice_details
-                    invoice_details = result['data'].get('invoice_details', {})
-                    fawry_ref = invoice_details.get('fawry_ref', '')
-                    if fawry_ref:
-                        fawry_ref = str(fawry_ref)
-                    
-                    # Log field values for debugging
-                    logger.info(f"EasyPay fields - UID: {invoice_uid}, Sequence: {invoice_sequence}, Fawry: {fawry_ref}")
-                    
-                    # Check if fawry_ref contains an error
-                    if is_fawry_ref_error(fawry_ref):
-                        logger.warning(f"EasyPay fawry_ref contains error on attempt {attempt + 1}: {fawry_ref}")
-                        
-                        if attempt < max_retries - 1:  # Not the last attempt
-                            logger.info(f"Waiting {retry_delay} seconds before retry...")
-                            time.sleep(retry_delay)
-                            continue  # Retry
-                        else:
-                            # Last attempt failed, return error
-                            logger.error(f"EasyPay fawry_ref still contains error after {max_retries} attempts")
-                            return Response({
-                                'success': False,
-                                'error': f'EasyPay invoice creation failed: Invalid Fawry reference after {max_retries} attempts',
-                                'details': {
-                                    'fawry_ref_error': fawry_ref,
-                                    'attempts': max_retries
-                                },
-                                'pill_number': pill.pill_number
-                            }, status=status.HTTP_400_BAD_REQUEST)
-                    
-                    # fawry_ref is valid, proceed with saving
-                    logger.info(f"EasyPay invoice created successfully with valid fawry_ref on attempt {attempt + 1}")
-                    
-                    # Update pill fields
-                    pill.easypay_invoice_uid = invoice_uid
-                    pill.easypay_invoice_sequence = invoice_sequence
-                    pill.easypay_fawry_ref = fawry_ref
-                    pill.easypay_data = result['data']
-                    pill.easypay_created_at = timezone.now()
-                    pill.payment_gateway = 'easypay'
-                    pill.status = 'w'
-                    pill.save(update_fields=['easypay_invoice_uid', 'easypay_invoice_sequence', 'easypay_fawry_ref', 'easypay_data', 'easypay_created_at', 'payment_gateway', 'status'])
-
-                    return Response({
-                        'success': True,
-                        'message': 'EasyPay invoice created successfully',
-                        'data': _serialize_easypay_invoice(pill, attempts=attempt + 1)
-                    }, status=status.HTTP_201_CREATED)
-                else:
-                    # EasyPay service returned an error
-                    logger.error(f"EasyPay service error on attempt {attempt + 1}: {result['error']}")
-                    
-                    if attempt < max_retries - 1:  # Not the last attempt
-                        logger.info(f"Waiting {retry_delay} seconds before retry...")
-                        time.sleep(retry_delay)
-                        continue  # Retry
-                    else:
-                        # Last attempt failed, return the service error
-                        response_data = {
-                            'success': False,
-                            'error': result['error'],
-                            'pill_number': pill.pill_number,
-                            'attempts': max_retries
-                        }
-                        
-                        # Include additional data if available (like existing invoice info)
-                        if result.get('data'):
-                            response_data['data'] = result['data']
-                        
-                        return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+            return _invoice_job_response(request, pill, 'easypay')
                 
         except Exception as e:
             logger.error(f"Exception creating EasyPay invoice for pill {pill_id}: {str(e)}")
@@ -718,7 +483,7 @@ class CreatePaymentInvoiceView(APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request, pill_id):
-        """Create a payment invoice using the active payment gateway"""
+        """Queue a payment invoice using the active payment gateway"""
         try:
             from django.conf import settings
             
@@ -727,174 +492,33 @@ class CreatePaymentInvoiceView(APIView):
             pill = get_object_or_404(Pill, id=pill_id, user=request.user)
             logger.info(f"Pill found: {pill.pill_number}")
             
-            # Check stock availability before creating invoice
-            logger.info(f"Checking stock availability for pill {pill_id}")
-            availability_check = pill.check_all_items_availability()
-            
-            if not availability_check['all_available']:
-                logger.warning(f"Stock problems found for pill {pill_id}: {availability_check['problem_items_count']} items")
-                
-                # Create detailed error message for each problem item
-                problem_details = []
-                for item in availability_check['problem_items']:
-                    if item['reason'] == 'out_of_stock':
-                        problem_details.append(f"{item['product_name']} غير متاح حالياً")
-                    elif item['reason'] == 'insufficient_quantity':
-                        problem_details.append(f"{item['product_name']} متاح فقط {item['available_quantity']} قطعة من أصل {item['required_quantity']} مطلوبة")
-                    else:
-                        problem_details.append(f"{item['product_name']} غير متاح")
-                
-                return Response({
-                    'success': False,
-                    'error_code': 'STOCK_UNAVAILABLE',
-                    'error': 'هذا المنتج لم يعد متاحا الان , يمكنك حذفه من الفاتورة والاستكمال بباقى المنتجات او الذهاب للصفحة الرئيسية لانشاء فاتورة جديدة',
-                    'details': {
-                        'problem_items': availability_check['problem_items'],
-                        'problem_details': problem_details,
-                        'total_items': availability_check['total_items'],
-                        'problem_items_count': availability_check['problem_items_count']
-                    }
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            logger.info(f"All items available for pill {pill_id}, proceeding with invoice creation")
+            unavailable = _stock_unavailable_response(pill)
+            if unavailable is not None:
+                return unavailable
             
-            # Get active payment method from settings
+            # Get active payment method from settings; anything else defaults to shakeout
             active_method = getattr(settings, 'ACTIVE_PAYMENT_METHOD', 'easypay').lower()
+            preferred = 'easypay' if active_method == 'easypay' else 'shakeout'
             logger.info(f"Active payment method: {active_method}")
             
-            if active_method == 'easypay':
-                # Use EasyPay
-                if pill.easypay_invoice_uid and not pill.is_easypay_invoice_expired():
-                    logger.warning(f"Pill {pill_id} already has active EasyPay invoice")
-                    return Response({
-                        'success': True,
-                        'message': 'EasyPay invoice already exists',
-                        'data': _serialize_easypay_invoice(pill, attempts=0)
-                    }, status=status.HTTP_200_OK)
-                
-                # Try creating the invoice with retry logic for fawry_ref errors
-                max_retries = 2  # Initial attempt + 1 retry
-                retry_delay = 10  # 10 seconds
-                
-                for attempt in range(max_retries):
-                    logger.info(f"EasyPay invoice creation attempt {attempt + 1} for pill {pill_id}")
-                    
-                    result = easypay_service.create_payment_invoice(pill)
-                    
-                    if result['success']:
-                        # Extract invoice data from successful response
-                        invoice_uid = result['data'].get('invoice_uid', '')
-                        invoice_sequence = result['data'].get('invoice_sequence', '')
-                        
-                        # Safely extract fawry_ref from nested invoice_details
-                        invoice_details = result['data'].get('invoice_details', {})
-                        fawry_ref = invoice_details.get('fawry_ref', '')
-                        if fawry_ref:
-                            fawry_ref = str(fawry_ref)
-                        
-                        # Log field values for debugging
-                        logger.info(f"EasyPay fields - UID: {invoice_uid}, Sequence: {invoice_sequence}, Fawry: {fawry_ref}")
-                        
-                        # Check if fawry_ref contains an error
-                        if is_fawry_ref_error(fawry_ref):
-                            logger.warning(f"EasyPay fawry_ref contains error on attempt {attempt + 1}: {fawry_ref}")
-                            
-                            if attempt < max_retries - 1:  # Not the last attempt
-                                logger.info(f"Waiting {retry_delay} seconds before retry...")
-                                time.sleep(retry_delay)
-                                continue  # Retry
-                            else:
-                                # Last attempt failed, return error
-                                logger.error(f"EasyPay fawry_ref still contains error after {max_retries} attempts")
-                                return Response({
-                                    'success': False,
-                                    'error': f'EasyPay invoice creation failed: Invalid Fawry reference after {max_retries} attempts',
-                                    'details': {
-                                        'fawry_ref_error': fawry_ref,
-                                        'attempts': max_retries
-                                    },
-                                    'payment_gateway': 'easypay'
-                                }, status=status.HTTP_400_BAD_REQUEST)
-                        
-                        # fawry_ref is valid, proceed with saving
-                        logger.info(f"EasyPay invoice created successfully with valid fawry_ref on attempt {attempt + 1}")
-                        
-                        # Update pill fields
-                        pill.easypay_invoice_uid = invoice_uid
-                        pill.easypay_invoice_sequence = invoice_sequence
-                        pill.easypay_fawry_ref = fawry_ref
-                        pill.easypay_data = result['data']
-                        pill.easypay_created_at = timezone.now()
-                        pill.payment_gateway = 'easypay'
-                        pill.status = 'w'
-                        pill.save(update_fields=['easypay_invoice_uid', 'easypay_invoice_sequence', 'easypay_fawry_ref', 'easypay_data', 'easypay_created_at', 'payment_gateway', 'status'])
-
-                        return Response({
-                            'success': True,
-                            'message': 'EasyPay invoice created successfully',
-                            'data': _serialize_easypay_invoice(pill, attempts=attempt + 1)
-                        }, status=status.HTTP_201_CREATED)
-                    else:
-                        # EasyPay service returned an error
-                        logger.error(f"EasyPay service error on attempt {attempt + 1}: {result['error']}")
-                        
-                        if attempt < max_retries - 1:  # Not the last attempt
-                            logger.info(f"Waiting {retry_delay} seconds before retry...")
-                            time.sleep(retry_delay)
-                            continue  # Retry
-                        else:
-                            # Last attempt failed, return the service error
-                            return Response({
-                                'success': False,
-                                'error': result['error'],
-                                'payment_gateway': 'easypay',
-                                'attempts': max_retries
-                            }, status=status.HTTP_400_BAD_REQUEST)
-                else:
-                    return Response({
-                        'success': False,
-                        'error': result['error'],
-                        'payment_gateway': 'easypay'
-                    }, status=status.HTTP_400_BAD_REQUEST)
-            
-            else:  # Default to shakeout
-                # Use Shakeout
-                if pill.shakeout_invoice_id and not pill.is_shakeout_invoice_expired():
-                    logger.warning(f"Pill {pill_id} already has active Shakeout invoice")
-                    return Response({
-                        'success': True,
-                        'message': 'Shakeout invoice already exists',
-                        'data': _serialize_shakeout_invoice(pill)
-                    }, status=status.HTTP_200_OK)
-                
-                result = shakeout_service.create_payment_invoice(pill)
-                
-                if result['success']:
-                    pill.shakeout_invoice_id = result['data']['invoice_id']
-                    pill.shakeout_invoice_ref = result['data']['invoice_ref']
-                    pill.shakeout_data = result['data']
-                    pill.shakeout_created_at = timezone.now()
-                    pill.payment_gateway = 'shakeout'
-                    pill.status = 'w'
-                    pill.save(update_fields=['shakeout_invoice_id', 'shakeout_invoice_ref', 'shakeout_data', 'shakeout_created_at', 'payment_gateway', 'status'])
-                    
-                    return Response({
-                        'success': True,
-                        'message': 'Shakeout invoice created successfully',
-                        'data': {
-                            'invoice_id': result['data']['invoice_id'],
-                            'invoice_ref': result['data']['invoice_ref'],
-                            'payment_url': result['data']['url'],
-                            'total_amount': result['data']['total_amount'],
-                            'payment_gateway': 'shakeout'
-                        }
-                    }, status=status.HTTP_201_CREATED)
-                else:
-                    return Response({
-                        'success': False,
-                        'error': result['error'],
-                        'payment_gateway': 'shakeout'
-                    }, status=status.HTTP_400_BAD_REQUEST)
+            gateway = preferred
+            if not invoices.has_active_invoice(pill, preferred):
+                # Fail over to the other gateway while this one's circuit is open
+                gateway = invoices.choose_gateway(preferred)
+                if gateway is None:
+                    return _gateway_unavailable_response(pill, preferred)
+                if gateway != preferred:
+                    logger.warning(f"{preferred} circuit is open, failing over to {gateway} for pill {pill_id}")
+            
+            if invoices.has_active_invoice(pill, gateway):
+                logger.warning(f"Pill {pill_id} already has active {gateway} invoice")
+                return Response({
+                    'success': True,
+                    'message': f"{'EasyPay' if gateway == 'easypay' else 'Shakeout'} invoice already exists",
+                    'data': invoices.serialize_invoice(pill, gateway)
+                }, status=status.HTTP_200_OK)
+            
+            return _invoice_job_response(request, pill, gateway)
                 
         except Exception as e:
             logger.error(f"Exception creating payment invoice for pill {pill_id}: {str(e)}")
@@ -906,6 +530,38 @@ class CreatePaymentInvoiceView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class InvoiceJobStatusView(APIView):
+    """
+    Poll a queued invoice job
+    GET /products/pills/<pill_id>/invoice-jobs/<job_id>/
+    """
+    authentication_classes = [CustomJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pill_id, job_id):
+        pill = get_object_or_404(Pill, id=pill_id, user=request.user)
+        job = get_object_or_404(
+            BackgroundJob, id=job_id, kind=invoices.INVOICE_JOB, created_by=request.user, payload__pill_id=pill.id
+        )
+        response_data = {
+            'success': job.status != 'failed',
+            'job_id': job.id,
+            'status': job.status,
+            'attempts': job.attempts,
+            'payment_gateway': job.payload.get('gateway'),
+            'pill_number': pill.pill_number,
+        }
+        if job.status == 'succeeded':
+            response_data['data'] = job.result
+        elif job.status == 'failed':
+            response_data['error'] = job.error
+        elif job.error:
+            # Queued again after a failed gateway call
+            response_data['last_error'] = job.error
+            response_data['retry_at'] = job.run_after
+        return Response(response_data, status=status.HTTP_200_OK)
+
+
 class CheckEasyPayInvoiceStatusView(APIView):
     # authentication_classes = [CustomJWTAuthentication]
     # permission_classes = [IsAuthenticated]
@@ -996,3 +652,4 @@ payment_failed_view = PaymentFailedView.as_view()
 payment_pending_view = PaymentPendingView.as_view()
 check_payment_status_view = CheckPaymentStatusView.as_view()
 check_easypay_invoice_status_view = CheckEasyPayInvoiceStatusView.as_view()
+invoice_job_status_view = InvoiceJobStatusView.as_view()
@@ -0,0 +1,172 @@
+"""
+Product search index.
+
+Every product has a ``ProductSearchDocument`` holding its name, category,
+subject, teacher and description as normalized text (Arabic letter variants
+folded, tashkeel and tatweel removed, lower-cased). The documents are indexed
+per database backend:
+
+* SQLite: an FTS5 table (``products_search_fts``, rowid = product id),
+  ranked with ``bm25()``.
+* PostgreSQL: a GIN index on ``to_tsvector('simple', content)``, ranked with
+  ``ts_rank``.
+
+Documents are refreshed from ``products.signals`` when a product, teacher,
+subject or category is saved; ``manage.py rebuild_search_index`` rebuilds
+them all.
+"""
+import re
+
+from django.db import connection
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import BaseFilterBackend
+
+FTS_TABLE = 'products_search_fts'
+PG_INDEX = 'products_search_document_tsv'
+
+# Harakat, Quranic marks, superscript alef and tatweel
+TASHKEEL_RE = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_FOLDING = str.maketrans({
+    '\u0623': '\u0627',  # alef with hamza above -> alef
+    '\u0625': '\u0627',  # alef with hamza below -> alef
+    '\u0622': '\u0627',  # alef with madda -> alef
+    '\u0671': '\u0627',  # alef wasla -> alef
+    '\u0629': '\u0647',  # teh marbuta -> heh
+    '\u0649': '\u064a',  # alef maksura -> yeh
+})
+TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """Fold Arabic spelling variants and strip diacritics so variants match."""
+    if not text:
+        return ''
+    text = TASHKEEL_RE.sub('', str(text)).translate(ARABIC_FOLDING)
+    return ' '.join(TOKEN_RE.findall(text.lower()))
+
+
+def search_tokens(query):
+    return normalize_text(query).split()
+
+
+def build_document(product):
+    parts = [
+        product.name,
+        product.category.name if product.category else None,
+        product.subject.name if product.subject else None,
+        product.teacher.name if product.teacher else None,
+        product.description,
+    ]
+    return normalize_text(' '.join(part for part in parts if part))
+
+
+def _vendor():
+    return connection.vendor
+
+
+def create_search_index(**kwargs):
+    """Create the backend-specific index structures (idempotent, run after migrate)."""
+    with connection.cursor() as cursor:
+        if _vendor() == 'sqlite':
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(content)')
+        elif _vendor() == 'postgresql':
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON products_productsearchdocument "
+                f"USING gin (to_tsvector('simple'::regconfig, COALESCE(content, '')))"
+            )
+
+
+def index_products(product_ids):
+    """(Re)build the search documents of the given products."""
+    from .models import Product, ProductSearchDocument
+
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    products = Product.objects.filter(pk__in=product_ids).select_related('category', 'subject', 'teacher')
+    documents = [
+        ProductSearchDocument(product_id=product.pk, content=build_document(product))
+        for product in products
+    ]
+    ProductSearchDocument.objects.bulk_create(
+        documents,
+        update_conflicts=True,
+        unique_fields=['product'],
+        update_fields=['content', 'updated_at'],
+    )
+    if _vendor() == 'sqlite':
+        _delete_fts_rows(product_ids)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, content) VALUES (%s, %s)',
+                [(document.product_id, document.content) for document in documents],
+            )
+    return len(documents)
+
+
+def _delete_fts_rows(product_ids):
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', list(product_ids))
+
+
+def remove_products(product_ids):
+    """Drop index rows of deleted products (documents cascade with the product)."""
+    product_ids = list(product_ids)
+    if product_ids and _vendor() == 'sqlite':
+        _delete_fts_rows(product_ids)
+
+
+def search_products(queryset, query):
+    """
+    Filter a product queryset to the matches of ``query`` and annotate
+    ``search_rank`` (higher is better). Returns the queryset unchanged when the
+    query has no searchable words.
+    """
+    tokens = search_tokens(query)
+    if not tokens:
+        return queryset
+
+    if _vendor() == 'sqlite':
+        # Every word must match, each as a prefix ("كيم" finds "كيمياء")
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        matches = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match])
+        rank = RawSQL(
+            f'SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = products_product.id',
+            [match],
+        )
+        return queryset.filter(pk__in=matches).annotate(search_rank=rank)
+
+    if _vendor() == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        search_query = SearchQuery(
+            ' & '.join(f'{token}:*' for token in tokens), config='simple', search_type='raw'
+        )
+        vector = SearchVector('search_document__content', config='simple')
+        return (
+            queryset.annotate(search_vector=vector)
+            .filter(search_vector=search_query)
+            .annotate(search_rank=SearchRank(F('search_vector'), search_query))
+        )
+
+    # Other backends: match every word against the normalized document
+    for token in tokens:
+        queryset = queryset.filter(search_document__content__contains=token)
+    return queryset
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """``?search=`` over the product search index, best matches first unless ``?ordering=`` is given."""
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        searched = search_products(queryset, query)
+        if searched is queryset or 'ordering' in request.query_params:
+            return searched
+        if 'search_rank' in searched.query.annotations:
+            return searched.order_by(F('search_rank').desc(nulls_last=True), '-date_added')
+        return searched
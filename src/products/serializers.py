@@ -3,7 +3,7 @@ from rest_framework.exceptions import ValidationError
 from collections import defaultdict
 from urllib.parse import urljoin
 from django.utils import timezone
-from django.db.models import Sum, F
+from django.db.models import Sum, Prefetch, Q, prefetch_related_objects
 from django.db import transaction
 from django.conf import settings
 from accounts.models import User
@@ -12,8 +12,12 @@ from .models import (
     PillItem, ProductDescription,
     SpecialProduct,
     SubCategory, Product, ProductImage, Rating, Pill, Subject, Teacher,
-    PurchasedBook
+    PurchasedBook, BackgroundJob, PRICING_FIELDS
 )
+from .caching import bump_catalog_version
+from .coupons import get_coupon_by_code, redeem_coupon
+from .fieldsets import SparseFieldsetMixin
+from .loaders import get_product_loader
 
 
 def get_full_file_url(file_field, request=None):
@@ -125,7 +129,9 @@ class ProductDescriptionCreateSerializer(serializers.ModelSerializer):
 class BulkProductDescriptionSerializer(serializers.ListSerializer):
     def create(self, validated_data):
         descriptions = [ProductDescription(**item) for item in validated_data]
-        return ProductDescription.objects.bulk_create(descriptions)
+        created = ProductDescription.objects.bulk_create(descriptions)
+        bump_catalog_version()
+        return created
 
 class ProductImageSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
@@ -203,7 +209,10 @@ class ProductS3UploadSerializer(serializers.Serializer):
         return instance
 
 
-class ProductSerializer(serializers.ModelSerializer):
+PRODUCT_PRICING_COLUMNS = ('price', 'category', *PRICING_FIELDS)
+
+
+class ProductSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     discounted_price = serializers.SerializerMethodField()
     has_discount = serializers.SerializerMethodField()
@@ -233,7 +242,7 @@ class ProductSerializer(serializers.ModelSerializer):
             'id', 'product_number','name','year','category','sub_category','subject' ,'teacher', 
             'category_id', 'category_name', 'subject_id' ,'subject_name', 'teacher_id','teacher_name','teacher_image', 
             'sub_category_id', 'sub_category_name', 'price', 'description', 'date_added', 'discounted_price',
-            'has_discount', 'current_discount', 'discount_expiry', 'main_image', 'images', 'number_of_ratings',
+            'has_discount', 'current_discount', 'discount_expiry', 'main_image', 'cover_image', 'images', 'number_of_ratings',
             'average_rating', 'descriptions', 'pdf_file', 'base_image',
             'page_count', 'file_size_mb', 'language', 'is_available'
         ]
@@ -241,43 +250,70 @@ class ProductSerializer(serializers.ModelSerializer):
             'product_number', 'date_added'
         ]
 
+    # field -> (Product columns, loader relations) for ?fields= / ?omit=
+    field_sources = {
+        **{name: ((name,), ()) for name in (
+            'id', 'product_number', 'name', 'year', 'price', 'description', 'date_added',
+            'pdf_file', 'base_image', 'page_count', 'file_size_mb', 'language', 'is_available',
+            'category', 'sub_category', 'subject', 'teacher', 'cover_image',
+        )},
+        'category_id': (('category',), ()),
+        'category_name': (('category',), ('category',)),
+        'sub_category_id': (('sub_category',), ()),
+        'sub_category_name': (('sub_category',), ('sub_category',)),
+        'subject_id': (('subject',), ()),
+        'subject_name': (('subject',), ('subject',)),
+        'teacher_id': (('teacher',), ()),
+        'teacher_name': (('teacher',), ('teacher',)),
+        'teacher_image': (('teacher',), ('teacher',)),
+        'discounted_price': (PRODUCT_PRICING_COLUMNS, ()),
+        'has_discount': (PRODUCT_PRICING_COLUMNS, ()),
+        'current_discount': (PRODUCT_PRICING_COLUMNS, ()),
+        'discount_expiry': (PRODUCT_PRICING_COLUMNS, ()),
+        'main_image': (('cover_image',), ('cover_image',)),
+        'images': ((), ('images',)),
+        'descriptions': ((), ('descriptions',)),
+        'number_of_ratings': (('ratings_count',), ()),
+        'average_rating': (('ratings_count', 'ratings_avg'), ()),
+    }
+
     def to_representation(self, instance):
         """Override to return full URLs for file fields"""
+        self._loader().ensure(instance)
         ret = super().to_representation(instance)
         request = self.context.get('request')
         
         # Convert pdf_file to full URL
-        if instance.pdf_file:
-            ret['pdf_file'] = get_full_file_url(instance.pdf_file, request)
-        else:
-            ret['pdf_file'] = None
+        if 'pdf_file' in ret:
+            ret['pdf_file'] = get_full_file_url(instance.pdf_file, request) if instance.pdf_file else None
             
         # Convert base_image to full URL
-        if instance.base_image:
-            ret['base_image'] = get_full_file_url(instance.base_image, request)
-        else:
-            ret['base_image'] = None
+        if 'base_image' in ret:
+            ret['base_image'] = get_full_file_url(instance.base_image, request) if instance.base_image else None
             
         return ret
 
+    def _loader(self):
+        return get_product_loader(self)
+
     def get_category_id(self, obj):
-        return obj.category.id if obj.category else None
+        return obj.category_id
 
     def get_category_name(self, obj):
         return obj.category.name if obj.category else None
 
     def get_sub_category_id(self, obj):
-        return obj.sub_category.id if obj.sub_category else None
+        return obj.sub_category_id
 
     def get_sub_category_name(self, obj):
         return obj.sub_category.name if obj.sub_category else None
 
     def get_subject_id(self, obj):
-        return obj.subject.id if obj.subject else None
+        return obj.subject_id
     def get_subject_name(self, obj):
         return obj.subject.name if obj.subject else None
     def get_teacher_id(self, obj):
-        return obj.teacher.id if obj.teacher else None
+        return obj.teacher_id
     def get_teacher_name(self, obj):
         return obj.teacher.name if obj.teacher else None
     def get_teacher_image(self, obj):
@@ -286,58 +322,32 @@ class ProductSerializer(serializers.ModelSerializer):
         return None
 
     def get_discounted_price(self, obj):
-        return obj.discounted_price()
+        return self._loader().discounted_price(obj)
 
     def get_current_discount(self, obj):
-        now = timezone.now()
-        product_discount = obj.discounts.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now
-        ).order_by('-discount').first()
-        category_discount = None
-        if obj.category:
-            category_discount = obj.category.discounts.filter(
-                is_active=True,
-                discount_start__lte=now,
-                discount_end__gte=now
-            ).order_by('-discount').first()
-        if product_discount and category_discount:
-            return max(product_discount.discount, category_discount.discount)
-        elif product_discount:
-            return product_discount.discount
-        elif category_discount:
-            return category_discount.discount
-        return None
+        return self._loader().current_discount_value(obj)
 
     def get_discount_expiry(self, obj):
-        now = timezone.now()
-        discount = obj.discounts.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now
-        ).order_by('-discount_end').first()
-        if not discount and obj.category:
-            discount = obj.category.discounts.filter(
-                is_active=True,
-                discount_start__lte=now,
-                discount_end__gte=now
-            ).order_by('-discount_end').first()
-        return discount.discount_end if discount else None
+        return self._loader().discount_expiry(obj)
     
     def get_has_discount(self, obj):
-        return obj.has_discount()
+        return self._loader().has_discount(obj)
 
     def get_main_image(self, obj):
-        main_image = obj.main_image()
+        main_image = self._loader().main_image(obj)
         return get_full_file_url(main_image, self.context.get('request'))
 
     def get_number_of_ratings(self, obj):
-        return obj.number_of_ratings()
+        return self._loader().number_of_ratings(obj)
 
     def get_average_rating(self, obj):
-        return obj.average_rating()
+        return self._loader().average_rating(obj)
     
+    def validate_cover_image(self, value):
+        if value is not None and (self.instance is None or value.product_id != self.instance.pk):
+            raise serializers.ValidationError('Cover image must be one of this product\'s images.')
+        return value
+
     def validate(self, data):
         """Validate that product name is unique per subject, teacher, and year"""
         name = data.get('name')
@@ -416,10 +426,10 @@ class ProductBreifedSerializer(serializers.ModelSerializer):
 
 class CouponCodeField(serializers.Field):
     def to_internal_value(self, data):
-        try:
-            return CouponDiscount.objects.get(coupon=data)
-        except CouponDiscount.DoesNotExist:
+        coupon = get_coupon_by_code(data)
+        if coupon is None:
             raise serializers.ValidationError("Coupon does not exist.")
+        return coupon
 
     def to_representation(self, value):
         return value.coupon
@@ -530,6 +540,7 @@ class ProductImageBulkS3UploadSerializer(serializers.Serializer):
             product_images.append(product_image)
         
         created_images = ProductImage.objects.bulk_create(product_images)
+        Product.assign_missing_covers([product.pk])
         return created_images
 
 
@@ -600,8 +611,47 @@ class PillItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'status', 'date_added']
 
 
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField that can resolve many pks up front with one query."""
+
+    def preload(self, pks):
+        keys = set()
+        for pk in pks:
+            try:
+                keys.add(int(pk))
+            except (TypeError, ValueError):
+                continue
+        self._preloaded = self.get_queryset().in_bulk(keys) if keys else {}
+
+    def to_internal_value(self, data):
+        preloaded = getattr(self, '_preloaded', None)
+        if preloaded:
+            try:
+                obj = preloaded.get(int(data))
+            except (TypeError, ValueError):
+                obj = None
+            if obj is not None:
+                return obj
+        # Unknown pks fall through to the usual lookup and error message
+        return super().to_internal_value(data)
+
+
+class PillItemInputListSerializer(serializers.ListSerializer):
+    """Resolve the products of every cart item in one query."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self.child.fields['product'].preload(
+                item.get('product') for item in data if isinstance(item, dict)
+            )
+        return super().to_internal_value(data)
+
+
 class PillItemInputSerializer(serializers.Serializer):
-    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.filter(is_available=True))
+    product = PreloadedPrimaryKeyRelatedField(queryset=Product.objects.filter(is_available=True))
+
+    class Meta:
+        list_serializer_class = PillItemInputListSerializer
 
 
 class AdminPillItemSerializer(PillItemCreateUpdateSerializer):
@@ -690,12 +740,7 @@ class AdminLovedProductSerializer(serializers.ModelSerializer):
         product = obj.product
         request = self.context.get('request')
         
-        main_image = None
-        if product.main_image():
-            if request:
-                main_image = request.build_absolute_uri(product.main_image())
-            else:
-                main_image = product.main_image()
+        main_image = get_full_file_url(product.main_image(), request)
         
         return {
             'id': product.id,
@@ -804,26 +849,30 @@ class PillCreateSerializer(serializers.ModelSerializer):
         if not filtered_items:
             raise ValidationError({'items': ['All selected products are already owned']})
 
-        with transaction.atomic():
-            pill = Pill.objects.create(**validated_data)
-
-            pill_items = []
-            for item_data in filtered_items:
-                product = item_data['product']
-
-                if not product.is_available:
-                    raise ValidationError({'items': [f'Product "{product.name}" is not available for purchase']})
+        for item_data in filtered_items:
+            product = item_data['product']
+            if not product.is_available:
+                raise ValidationError({'items': [f'Product "{product.name}" is not available for purchase']})
 
-                pill_item = PillItem.objects.create(
-                    user=user,
-                    product=product,
-                    status=status_value,
-                    pill=pill,
-                )
-                pill_items.append(pill_item)
+        pill = Pill(**validated_data)
+        pill_items = [
+            PillItem(user=user, product=item_data['product'], status=status_value)
+            for item_data in filtered_items
+        ]
+        # Snapshot item prices and the order totals at checkout
+        for pill_item, price in pill.price_items(pill_items, live=True):
+            pill_item.price_at_sale = price
+        pill.subtotal, pill.total = pill.compute_totals(pill_items)
 
-            pill.items.set(pill_items)
+        # Set-based: one insert for the items however many books are in the cart
+        with transaction.atomic():
+            pill.save()
+            for pill_item in pill_items:
+                pill_item.pill = pill
+            PillItem.objects.bulk_create(pill_items)
 
+        # Render the response from one batch instead of a lookup per item
+        prefetch_related_objects([pill], Prefetch('items', queryset=PillItem.objects.select_related('product')))
         return pill
 
     def to_representation(self, instance):
@@ -834,12 +883,13 @@ class PillCreateSerializer(serializers.ModelSerializer):
 class CouponDiscountSerializer(serializers.ModelSerializer):
     is_active = serializers.SerializerMethodField()
     is_available = serializers.SerializerMethodField()
+    remaining_uses = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = CouponDiscount
         fields = [
             'id', 'coupon', 'discount_value', 'coupon_start', 'coupon_end',
-            'available_use_times', 'user', 'min_order_value', 'is_active',
+            'available_use_times', 'remaining_uses', 'user', 'min_order_value', 'is_active',
             'is_available'
         ]
 
@@ -848,12 +898,17 @@ class CouponDiscountSerializer(serializers.ModelSerializer):
         return obj.coupon_start <= now <= obj.coupon_end
 
     def get_is_available(self, obj):
-        return obj.available_use_times > 0 and self.get_is_active(obj)
+        return obj.remaining_uses > 0 and self.get_is_active(obj)
+
+
+MAX_BULK_COUPONS = 50000
 
 
 class BulkCouponDiscountSerializer(serializers.Serializer):
     """Serializer for bulk coupon creation"""
-    number_of_coupons = serializers.IntegerField(min_value=1, max_value=1000, help_text="Number of coupons to create (1-1000)")
+    number_of_coupons = serializers.IntegerField(
+        min_value=1, max_value=MAX_BULK_COUPONS, help_text=f"Number of coupons to create (1-{MAX_BULK_COUPONS})"
+    )
     discount_value = serializers.FloatField(required=False, allow_null=True)
     coupon_start = serializers.DateTimeField(required=False, allow_null=True)
     coupon_end = serializers.DateTimeField(required=False, allow_null=True)
@@ -863,13 +918,7 @@ class BulkCouponDiscountSerializer(serializers.Serializer):
 
     def create(self, validated_data):
         number_of_coupons = validated_data.pop('number_of_coupons')
-        coupons = []
-        
-        for _ in range(number_of_coupons):
-            coupon = CouponDiscount.objects.create(**validated_data)
-            coupons.append(coupon)
-        
-        return coupons
+        return CouponDiscount.bulk_generate(number_of_coupons, **validated_data)
 
 
 class PillDetailSerializer(serializers.ModelSerializer):
@@ -1100,13 +1149,13 @@ class AdminLovedProductSerializer(LovedProductSerializer):
         return LovedProduct.objects.create(user=user, **validated_data)
 
 
-class PurchasedBookSerializer(serializers.ModelSerializer):
+class PurchasedBookSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     # Read fields
     id = serializers.IntegerField(read_only=True)
-    product_id = serializers.IntegerField(source='product.id', read_only=True)
-    pill_id = serializers.IntegerField(source='pill.id', read_only=True, allow_null=True)
+    product_id = serializers.IntegerField(read_only=True)
+    pill_id = serializers.IntegerField(read_only=True, allow_null=True)
     pill_number = serializers.CharField(source='pill.pill_number', read_only=True, allow_null=True)
-    user_id = serializers.IntegerField(source='user.id', read_only=True)
+    user_id = serializers.IntegerField(read_only=True)
     username = serializers.CharField(source='user.username', read_only=True)
     user_name = serializers.CharField(source='user.name', read_only=True)
     
@@ -1150,6 +1199,37 @@ class PurchasedBookSerializer(serializers.ModelSerializer):
     read_only_fields = ['id', 'created_at', 'product_id', 'pill_id', 'pill_number',
                            'user_id', 'username', 'user_name']
 
+    # field -> (PurchasedBook columns, loader relations) for ?fields= / ?omit=
+    field_sources = {
+        **{name: ((), ()) for name in ('user', 'product', 'pill', 'pill_item')},  # write-only
+        **{name: ((name,), ()) for name in ('id', 'product_name', 'created_at')},
+        **{name: ((f'product__{name}',), ()) for name in (
+            'product_number', 'name', 'year', 'pdf_file', 'page_count', 'file_size_mb', 'language',
+        )},
+        'user_id': (('user',), ()),
+        'username': (('user__username',), ()),
+        'user_name': (('user__name',), ()),
+        'product_id': (('product',), ()),
+        'pill_id': (('pill',), ()),
+        'pill_number': (('pill__pill_number',), ()),
+        'category_id': (('product__category',), ()),
+        'category_name': (('product__category',), ('category',)),
+        'subject_id': (('product__subject',), ()),
+        'subject_name': (('product__subject',), ('subject',)),
+        'teacher_id': (('product__teacher',), ()),
+        'teacher_name': (('product__teacher',), ('teacher',)),
+        'sub_category_id': (('product__sub_category',), ()),
+        'sub_category_name': (('product__sub_category',), ('sub_category',)),
+        'main_image': (('product__cover_image', 'product__base_image'), ('cover_image',)),
+        'number_of_ratings': (('product__ratings_count',), ()),
+        'average_rating': (('product__ratings_count', 'product__ratings_avg'), ()),
+    }
+
+    def to_representation(self, instance):
+        if PurchasedBook._meta.get_field('product').is_cached(instance):
+            get_product_loader(self).ensure(instance.product)
+        return super().to_representation(instance)
+
     def _product(self, obj):
         return getattr(obj, 'product', None)
 
@@ -1209,7 +1289,7 @@ class PurchasedBookSerializer(serializers.ModelSerializer):
         product = self._product(obj)
         if not product:
             return None
-        image = product.main_image()
+        image = get_product_loader(self).main_image(product)
         if image and hasattr(image, 'url'):
             return self._build_absolute_uri(image.url)
         if product.base_image:
@@ -1218,11 +1298,11 @@ class PurchasedBookSerializer(serializers.ModelSerializer):
 
     def get_number_of_ratings(self, obj):
         product = self._product(obj)
-        return product.number_of_ratings() if product else 0
+        return get_product_loader(self).number_of_ratings(product) if product else 0
 
     def get_average_rating(self, obj):
         product = self._product(obj)
-        return product.average_rating() if product else 0
+        return get_product_loader(self).average_rating(product) if product else 0
 
     def get_pdf_file(self, obj):
         product = self._product(obj)
@@ -1267,9 +1347,9 @@ class PillCouponApplySerializer(serializers.ModelSerializer):
         coupon_code = coupon_code.strip()
         pill = self.instance
 
-        try:
-            coupon = CouponDiscount.objects.get(coupon__iexact=coupon_code)
-        except CouponDiscount.DoesNotExist:
+        # Indexed, cached lookup: unknown, expired or foreign codes are answered without the DB
+        coupon = get_coupon_by_code(coupon_code)
+        if coupon is None:
             raise serializers.ValidationError({'coupon_code': 'Coupon does not exist.'})
 
         now = timezone.now()
@@ -1277,14 +1357,12 @@ class PillCouponApplySerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({'coupon_code': 'Coupon is not yet active.'})
         if coupon.coupon_end and coupon.coupon_end < now:
             raise serializers.ValidationError({'coupon_code': 'Coupon has expired.'})
-        if coupon.available_use_times <= 0 and pill.coupon_id != coupon.id:
-            raise serializers.ValidationError({'coupon_code': 'This coupon has been fully used.'})
         if coupon.user_id and pill.user_id != coupon.user_id:
             raise serializers.ValidationError({'coupon_code': 'Coupon is not valid for this user.'})
         if not coupon.discount_value or coupon.discount_value <= 0:
             raise serializers.ValidationError({'coupon_code': 'Coupon does not have a valid discount value.'})
 
-        subtotal = self._calculate_subtotal(pill)
+        subtotal = pill.compute_totals()[0]
         if subtotal <= 0:
             raise serializers.ValidationError({'coupon_code': 'Order total must be greater than zero to apply coupon.'})
         if coupon.min_order_value and subtotal < coupon.min_order_value:
@@ -1294,6 +1372,7 @@ class PillCouponApplySerializer(serializers.ModelSerializer):
         discount_amount = min(subtotal, discount_amount)
 
         self._coupon = coupon
+        self._subtotal = subtotal
         self._discount_amount = round(float(discount_amount), 2)
         return attrs
 
@@ -1305,52 +1384,37 @@ class PillCouponApplySerializer(serializers.ModelSerializer):
         if coupon is None or discount_amount is None:
             raise serializers.ValidationError({'coupon_code': 'Coupon validation failed.'})
 
-        with transaction.atomic():
-            try:
-                coupon_for_update = CouponDiscount.objects.select_for_update().get(pk=coupon.pk)
-            except CouponDiscount.DoesNotExist:  # pragma: no cover - defensive
-                raise serializers.ValidationError({'coupon_code': 'Coupon does not exist.'})
-
-            if coupon_for_update.available_use_times <= 0 and instance.coupon_id != coupon_for_update.pk:
-                raise serializers.ValidationError({'coupon_code': 'This coupon has been fully used.'})
+        if instance.coupon_id and instance.coupon_id != coupon.pk:
+            raise serializers.ValidationError({'coupon_code': 'A different coupon has already been applied to this order.'})
 
-            if instance.coupon_id and instance.coupon_id != coupon_for_update.pk:
-                raise serializers.ValidationError({'coupon_code': 'A different coupon has already been applied to this order.'})
-
-            is_new_coupon = instance.coupon_id != coupon_for_update.pk
+        # No lock on the coupon row: the (coupon, pill) ledger stops double use
+        # and the remaining uses are taken with a conditional update.
+        with transaction.atomic():
+            is_new_coupon = instance.coupon_id != coupon.pk
 
             if is_new_coupon:
-                updated = CouponDiscount.objects.filter(
-                    pk=coupon_for_update.pk,
-                    available_use_times__gt=0
-                ).update(available_use_times=F('available_use_times') - 1)
-                if not updated:
-                    raise serializers.ValidationError({'coupon_code': 'This coupon has reached its usage limit.'})
-                instance.coupon = coupon_for_update
+                if not redeem_coupon(coupon, instance):
+                    raise serializers.ValidationError({'coupon_code': 'This coupon has been fully used.'})
+                # Another request may have put a different coupon on the pill meanwhile
+                claimed = Pill.objects.filter(pk=instance.pk).filter(
+                    Q(coupon__isnull=True) | Q(coupon=coupon)
+                ).update(coupon=coupon)
+                if not claimed:
+                    raise serializers.ValidationError({'coupon_code': 'A different coupon has already been applied to this order.'})
+                # The cached coupon does not know about the use just taken
+                coupon.refresh_from_db(fields=['available_use_times', 'sharded'])
+                instance.coupon = coupon
 
             instance.coupon_discount = discount_amount
-            update_fields = ['coupon_discount']
-            if is_new_coupon:
-                update_fields.append('coupon')
-            instance.save(update_fields=update_fields)
+            instance.subtotal = self._subtotal
+            instance.total = round(max(0.0, self._subtotal - discount_amount), 2)
+            instance.save(update_fields=['coupon_discount', 'subtotal', 'total'])
 
         return instance
 
     def get_final_price(self, obj):
         return obj.final_price()
 
-    def _calculate_subtotal(self, pill):
-        total = 0.0
-        for item in pill.items.select_related('product').all():
-            product = getattr(item, 'product', None)
-            if not product:
-                continue
-            price = product.discounted_price()
-            if price is None:
-                price = product.price or 0.0
-            total += float(price)
-        return total
-
 
 class UserCartSerializer(serializers.Serializer):
     id = serializers.IntegerField()
@@ -1363,6 +1427,79 @@ class UserCartSerializer(serializers.Serializer):
         return ret
 
 
+class CohortAssignmentSerializer(serializers.Serializer):
+    """
+    Books to grant and the students who get them: any of a user filter,
+    ``user_ids``, ``phones`` or an uploaded ``file`` with one id or phone per
+    line (or per CSV cell). Listed users are narrowed by the filter when both
+    are given.
+    """
+    product_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    year = serializers.ChoiceField(choices=User._meta.get_field('year').choices, required=False)
+    division = serializers.ChoiceField(choices=User._meta.get_field('division').choices, required=False)
+    government = serializers.ChoiceField(choices=User._meta.get_field('government').choices, required=False)
+    user_type = serializers.ChoiceField(choices=User._meta.get_field('user_type').choices, required=False)
+    user_ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    phones = serializers.ListField(child=serializers.CharField(max_length=20), required=False)
+    file = serializers.FileField(required=False, write_only=True)
+
+    def validate_product_ids(self, value):
+        product_ids = list(dict.fromkeys(value))
+        found = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+        missing = [product_id for product_id in product_ids if product_id not in found]
+        if missing:
+            raise ValidationError(f'Products not found: {missing}')
+        return product_ids
+
+    def _read_file(self, upload):
+        user_ids, phones = [], []
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValidationError({'file': 'The file must be UTF-8 text or CSV.'})
+        for token in text.replace(',', '\n').replace(';', '\n').split():
+            token = token.strip().strip('"\'')
+            if not token:
+                continue
+            # Phone numbers keep their leading 0 / +, user ids never have one
+            if token.startswith(('0', '+')):
+                phones.append(token)
+            elif token.isdigit():
+                user_ids.append(int(token))
+            else:
+                raise ValidationError({'file': f'"{token}" is neither a user id nor a phone number.'})
+        return user_ids, phones
+
+    def validate(self, attrs):
+        user_ids = list(attrs.get('user_ids', []))
+        phones = list(attrs.get('phones', []))
+        if attrs.get('file'):
+            file_ids, file_phones = self._read_file(attrs['file'])
+            user_ids += file_ids
+            phones += file_phones
+        user_filter = {field: attrs[field] for field in ('year', 'division', 'government', 'user_type') if field in attrs}
+        if not (user_ids or phones or user_filter):
+            raise ValidationError('Select the students with a filter, user_ids, phones or a file.')
+        return {
+            'product_ids': attrs['product_ids'],
+            'user_filter': user_filter,
+            'user_ids': list(dict.fromkeys(user_ids)),
+            'phones': list(dict.fromkeys(phones)),
+        }
+
+
+class BackgroundJobSerializer(serializers.ModelSerializer):
+    progress = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = BackgroundJob
+        fields = [
+            'id', 'kind', 'status', 'total', 'processed', 'progress', 'result', 'error',
+            'attempts', 'created_at', 'started_at', 'finished_at',
+        ]
+        read_only_fields = fields
+
+
 
 
 
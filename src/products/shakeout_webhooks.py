@@ -5,7 +5,8 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
-from products.models import Pill
+from products.models import PaymentReference, Pill
+from products.webhook_inbox import record_webhook
 from django.utils import timezone
 from services.shakeout_service import shakeout_service
 
@@ -87,41 +88,19 @@ def handle_shakeout_webhook_post(request):
         else:
             logger.warning("⚠️ No signature provided in webhook")
         
-        # Find the pill associated with this invoice
-        pill = find_pill_from_shakeout_data(invoice_id, invoice_ref)
+        # Store it and acknowledge at once; drain_webhooks applies it to the pill
+        _, created = record_webhook(request, 'shakeout', invoice_id, invoice_status)
         
-        if not pill:
-            logger.warning(f"No pill found for Shake-out invoice: {invoice_id}, ref: {invoice_ref}")
-            # Return success to prevent webhook retries, but log the issue
-            return JsonResponse({
-                'success': True,
-                'message': 'Invoice not found in system',
-                'invoice_id': invoice_id,
-                'invoice_ref': invoice_ref
-            }, status=200)
-        
-        # Update pill payment status based on Shake-out status
-        payment_updated = update_pill_payment_status(pill, invoice_status, data)
-        
-        # Log the status update
-        logger.info(f"Processing webhook for Pill #{pill.pill_number}")
-        logger.info(f"Shake-out Status: {invoice_status}")
-        logger.info(f"Payment Status Updated: {payment_updated}")
-        
-        # Store webhook data for audit trail
-        store_shakeout_webhook_data(pill, payload)
-        
-        # Send success response
         response_data = {
             'success': True,
-            'pill_id': pill.id,
-            'pill_number': pill.pill_number,
-            'payment_updated': payment_updated,
-            'current_status': pill.status,
-            'shakeout_status': invoice_status
+            'message': 'Webhook received',
+            'invoice_id': invoice_id,
+            'invoice_ref': invoice_ref,
+            'shakeout_status': invoice_status,
+            'duplicate': not created
         }
         
-        logger.info(f"Webhook processed successfully: {response_data}")
+        logger.info(f"Webhook stored: {response_data}")
         return JsonResponse(response_data, status=200)
         
     except Exception as e:
@@ -130,6 +109,33 @@ def handle_shakeout_webhook_post(request):
         logger.error(f"Traceback: {traceback.format_exc()}")
         return JsonResponse({'error': 'Internal server error'}, status=500)
 
+def apply_shakeout_webhook(payload):
+    """
+    Apply a stored Shake-out callback to its pill (run by drain_webhooks).
+    Returns the pill.
+    """
+    data = payload.get('data', {})
+    invoice_id = data.get('invoice_id')
+    invoice_ref = data.get('invoice_ref')
+    invoice_status = data.get('invoice_status')
+    
+    # Find the pill associated with this invoice
+    pill = find_pill_from_shakeout_data(invoice_id, invoice_ref)
+    if not pill:
+        raise Pill.DoesNotExist(f"No pill for Shake-out invoice {invoice_id} (ref {invoice_ref})")
+    
+    # Update pill payment status based on Shake-out status
+    payment_updated = update_pill_payment_status(pill, invoice_status, data)
+    
+    logger.info(f"Processing webhook for Pill #{pill.pill_number}")
+    logger.info(f"Shake-out Status: {invoice_status}")
+    logger.info(f"Payment Status Updated: {payment_updated}")
+    
+    # Store webhook data for audit trail
+    store_shakeout_webhook_data(pill, payload)
+    return pill
+
+
 def find_pill_from_shakeout_data(invoice_id, invoice_ref):
     """
     Find pill from Shake-out webhook data
@@ -138,14 +144,14 @@ def find_pill_from_shakeout_data(invoice_id, invoice_ref):
     
     # Method 1: Try to find by Shake-out invoice ID
     if invoice_id:
-        pill = Pill.objects.filter(shakeout_invoice_id=invoice_id).first()
+        pill = PaymentReference.find_pill('shakeout', 'invoice_id', invoice_id)
         if pill:
             logger.info(f"Found pill by shakeout_invoice_id: {invoice_id}")
             return pill
     
     # Method 2: Try to find by Shake-out invoice reference
     if invoice_ref:
-        pill = Pill.objects.filter(shakeout_invoice_ref=invoice_ref).first()
+        pill = PaymentReference.find_pill('shakeout', 'invoice_ref', invoice_ref)
         if pill:
             logger.info(f"Found pill by shakeout_invoice_ref: {invoice_ref}")
             return pill
@@ -155,74 +161,63 @@ def find_pill_from_shakeout_data(invoice_id, invoice_ref):
 
 def update_pill_payment_status(pill, shakeout_status, webhook_data):
     """
-    Update pill payment status based on Shake-out invoice status
+    Update pill payment status based on Shake-out invoice status.
+    Errors propagate so the inbox entry is retried instead of marked processed.
     """
-    try:
-        old_status = pill.status
-        new_status = old_status
+    old_status = pill.status
+    new_status = old_status
+    
+    # Map Shake-out statuses to our payment statuses
+    if shakeout_status in ["paid"]:
+        new_status = 'p'
+    elif shakeout_status in ["failed", "cancelled", "expired"] and pill.status == 'p':
+        new_status = 'i'
+    # For "pending" status, we don't change the payment status
+    
+    if new_status != old_status:
+        pill.status = new_status
+        pill.save(update_fields=['status'])
         
-        # Map Shake-out statuses to our payment statuses
-        if shakeout_status in ["paid"]:
-            new_status = 'p'
-        elif shakeout_status in ["failed", "cancelled", "expired"] and pill.status == 'p':
-            new_status = 'i'
-        # For "pending" status, we don't change the payment status
+        logger.info(f"Updated Pill #{pill.pill_number} status from {old_status} to {new_status}")
         
-        if new_status != old_status:
-            pill.status = new_status
-            pill.save(update_fields=['status'])
-            
-            logger.info(f"Updated Pill #{pill.pill_number} status from {old_status} to {new_status}")
-            
-            # Grant purchased books if payment is confirmed
-            if new_status == 'p':
-                try:
-                    pill.grant_purchased_books()
-                    logger.info(f"✓ Purchased books granted for pill {pill.pill_number}")
-                except Exception as e:
-                    logger.error(f"Failed to grant purchased books for pill {pill.pill_number}: {str(e)}")
-            
-            return True
-        else:
-            logger.info(f"No status change needed for Pill #{pill.pill_number} (current: {old_status})")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Error updating pill payment status: {e}")
+        # Grant purchased books if payment is confirmed - a failure here retries the whole entry
+        if new_status == 'p':
+            pill.grant_purchased_books()
+            logger.info(f"✓ Purchased books granted for pill {pill.pill_number}")
+        
+        return True
+    else:
+        logger.info(f"No status change needed for Pill #{pill.pill_number} (current: {old_status})")
         return False
 
 def store_shakeout_webhook_data(pill, payload):
     """
     Store webhook data in pill's shakeout_data for audit trail
     """
-    try:
-        # Get existing data or create new
-        existing_data = pill.shakeout_data or {}
-        
-        # Add webhook data
-        if 'webhooks' not in existing_data:
-            existing_data['webhooks'] = []
-        
-        webhook_entry = {
-            'timestamp': timezone.now().isoformat(),
-            'type': payload.get('type'),
-            'invoice_status': payload.get('data', {}).get('invoice_status'),
-            'amount': payload.get('data', {}).get('amount'),
-            'payment_method': payload.get('data', {}).get('payment_method'),
-            'payload': payload
-        }
-        
-        existing_data['webhooks'].append(webhook_entry)
-        
-        # Keep only last 20 webhooks to avoid bloating
-        if len(existing_data['webhooks']) > 20:
-            existing_data['webhooks'] = existing_data['webhooks'][-20:]
-        
-        # Update the pill
-        pill.shakeout_data = existing_data
-        pill.save(update_fields=['shakeout_data'])
-        
-        logger.info(f"Stored webhook data for Pill #{pill.pill_number}")
-        
-    except Exception as e:
-        logger.error(f"Error storing webhook data: {e}")
\ No newline at end of file
+    # Get existing data or create new
+    existing_data = pill.shakeout_data or {}
+    
+    # Add webhook data
+    if 'webhooks' not in existing_data:
+        existing_data['webhooks'] = []
+    
+    webhook_entry = {
+        'timestamp': timezone.now().isoformat(),
+        'type': payload.get('type'),
+        'invoice_status': payload.get('data', {}).get('invoice_status'),
+        'amount': payload.get('data', {}).get('amount'),
+        'payment_method': payload.get('data', {}).get('payment_method'),
+        'payload': payload
+    }
+    
+    existing_data['webhooks'].append(webhook_entry)
+    
+    # Keep only last 20 webhooks to avoid bloating
+    if len(existing_data['webhooks']) > 20:
+        existing_data['webhooks'] = existing_data['webhooks'][-20:]
+    
+    # Update the pill
+    pill.shakeout_data = existing_data
+    pill.save(update_fields=['shakeout_data'])
+    
+    logger.info(f"Stored webhook data for Pill #{pill.pill_number}")
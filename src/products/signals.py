@@ -0,0 +1,87 @@
+from django.db.models.signals import post_delete, post_save
+
+from .caching import bump_autocomplete_version, bump_catalog_version, bump_library_version
+from .coupons import forget_coupon
+from .search import index_products, remove_products
+from .models import (
+    BestProduct, Category, CouponDiscount, Discount, Product, ProductDescription, ProductImage,
+    PurchasedBook, Rating, SpecialProduct, SubCategory, Subject, Teacher,
+)
+
+CATALOG_MODELS = (
+    Product, Discount, SpecialProduct, BestProduct, ProductImage, Rating,
+    Category, SubCategory, Subject, Teacher, ProductDescription,
+)
+
+
+def catalog_changed(sender, **kwargs):
+    bump_catalog_version()
+
+
+def library_changed(sender, instance, **kwargs):
+    bump_library_version(instance.user_id)
+
+
+def coupon_changed(sender, instance, **kwargs):
+    forget_coupon(instance.coupon)
+
+
+SEARCH_FIELDS = {'name', 'description', 'category', 'subject', 'teacher'}
+
+
+def product_search_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    index_products([instance.pk])
+
+
+def product_search_deleted(sender, instance, **kwargs):
+    remove_products([instance.pk])
+
+
+AUTOCOMPLETE_FIELDS = {'name', 'is_available', 'subject', 'teacher'}
+
+
+def product_autocomplete_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not AUTOCOMPLETE_FIELDS.intersection(update_fields):
+        return
+    bump_autocomplete_version()
+
+
+def autocomplete_changed(sender, **kwargs):
+    bump_autocomplete_version()
+
+
+def rating_deleted(sender, instance, **kwargs):
+    # Also covers queryset and cascade deletes (user or product removed),
+    # which never go through the rating views' incremental updates
+    Product.refresh_rating_aggregates(instance.product_id)
+
+
+def related_search_changed(sender, instance, created=False, **kwargs):
+    # Teacher/subject/category names are part of their products' documents
+    if created:
+        return
+    field = sender._meta.model_name  # 'teacher', 'subject' or 'category'
+    product_ids = Product.objects.filter(**{field: instance}).values_list('pk', flat=True)
+    index_products(product_ids)
+
+
+def connect_catalog_signals():
+    for model in CATALOG_MODELS:
+        post_save.connect(catalog_changed, sender=model, dispatch_uid=f'catalog_save_{model.__name__}')
+        post_delete.connect(catalog_changed, sender=model, dispatch_uid=f'catalog_delete_{model.__name__}')
+    post_delete.connect(rating_deleted, sender=Rating, dispatch_uid='rating_aggregates_delete')
+    post_save.connect(library_changed, sender=PurchasedBook, dispatch_uid='library_save')
+    post_delete.connect(library_changed, sender=PurchasedBook, dispatch_uid='library_delete')
+    post_save.connect(coupon_changed, sender=CouponDiscount, dispatch_uid='coupon_save')
+    post_delete.connect(coupon_changed, sender=CouponDiscount, dispatch_uid='coupon_delete')
+    post_save.connect(product_search_changed, sender=Product, dispatch_uid='search_product_save')
+    post_delete.connect(product_search_deleted, sender=Product, dispatch_uid='search_product_delete')
+    post_save.connect(product_autocomplete_changed, sender=Product, dispatch_uid='autocomplete_product_save')
+    post_delete.connect(autocomplete_changed, sender=Product, dispatch_uid='autocomplete_product_delete')
+    for model in (Teacher, Subject):
+        post_save.connect(autocomplete_changed, sender=model, dispatch_uid=f'autocomplete_{model.__name__}_save')
+        post_delete.connect(autocomplete_changed, sender=model, dispatch_uid=f'autocomplete_{model.__name__}_delete')
+    for model in (Teacher, Subject, Category):
+        post_save.connect(related_search_changed, sender=model, dispatch_uid=f'search_{model.__name__}_save')
@@ -1,9 +1,35 @@
+import csv
+import json
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+import requests
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from accounts.models import User
-from .models import Category, Subject, Teacher, Product, Pill, PillItem, PurchasedBook, Rating
+from services import http_client
+from services.circuit_breaker import CircuitOpenError, get_breaker
+from . import jobs, webhook_inbox
+from .assignments import assign_books
+from .caching import get_catalog_version, get_or_build_catalog_response
+from .coupons import get_coupon_by_code, redeem_coupon, release_coupon
+from .numbering import PillNumberGenerator
+from .models import (
+	ArchivedPill, BackgroundJob, PaymentReference, BestProduct, Category, CouponDiscount, CouponRedemption, Discount, Pill, PillItem, Product, ProductDescription, ProductImage, ProductSearchDocument,
+	PurchasedBook, Rating, SpecialProduct, Subject, Teacher, WebhookInboxEntry,
+)
 class PurchasedBookTests(APITestCase):
 	def setUp(self):
 		self.user = User.objects.create_user(
@@ -271,6 +297,53 @@ class RatingTests(APITestCase):
 		self.assertEqual(delete.status_code, status.HTTP_204_NO_CONTENT)
 		self.assertFalse(Rating.objects.filter(id=rating_id).exists())
 
+	def test_rating_writes_keep_product_aggregates_in_step(self):
+		create = self.client.post(self.list_url, {'star_number': 2, 'review': 'Bad'}, format='json')
+		self.client.force_authenticate(user=self.other_user)
+		self.client.post(self.list_url, {'star_number': 5, 'review': 'Great'}, format='json')
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.ratings_count, 2)
+		self.assertEqual(self.product.ratings_sum, 7)
+		self.assertEqual(self.product.average_rating(), 3.5)
+
+		self.client.force_authenticate(user=self.user)
+		detail_url = reverse('products:rating-detail-by-id', args=[create.data['id']])
+		self.client.patch(detail_url, {'star_number': 4}, format='json')
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.ratings_sum, 9)
+		self.assertEqual(self.product.average_rating(), 4.5)
+
+		self.client.delete(detail_url)
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.ratings_count, 1)
+		self.assertEqual(self.product.average_rating(), 5.0)
+
+	def test_rebuild_rating_aggregates_command(self):
+		Rating.objects.create(product=self.product, user=self.user, star_number=3)
+		Rating.objects.create(product=self.product, user=self.other_user, star_number=4)
+		call_command('rebuild_rating_aggregates', batch_size=1, stdout=StringIO())
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.ratings_count, 2)
+		self.assertEqual(self.product.ratings_sum, 7)
+		self.assertEqual(self.product.ratings_avg, 3.5)
+
+	def test_rebuild_rating_aggregates_bumps_catalog_version(self):
+		version = get_catalog_version()
+		call_command('rebuild_rating_aggregates', stdout=StringIO())
+		self.assertNotEqual(get_catalog_version(), version)
+
+	def test_bulk_and_cascade_rating_deletes_update_aggregates(self):
+		self.client.post(self.list_url, {'star_number': 3, 'review': 'Mine'}, format='json')
+		Product.apply_rating_change(self.product.pk, 1, 4)
+		Rating.objects.create(product=self.product, user=self.other_user, star_number=4)
+		Rating.objects.filter(user=self.user).delete()
+		self.product.refresh_from_db()
+		self.assertEqual((self.product.ratings_count, self.product.ratings_sum), (1, 4))
+
+		self.other_user.delete()
+		self.product.refresh_from_db()
+		self.assertEqual((self.product.ratings_count, self.product.ratings_avg), (0, 0.0))
+
 	def test_rating_list_pagination_controls(self):
 		self.client.post(self.list_url, {'star_number': 3, 'review': 'My review'}, format='json')
 		# Create additional ratings from distinct users
@@ -295,3 +368,1194 @@ class RatingTests(APITestCase):
 		self.assertEqual(response.data['pagination']['total_pages'], 3)
 		self.assertEqual(response.data['pagination']['page_size'], 5)
 		self.assertEqual(len(response.data['ratings']), 5)
+
+
+class ProductBatchLoaderTests(APITestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username='loader',
+			password='pass1234',
+			name='Loader User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.category = Category.objects.create(name='Languages')
+		self.subject = Subject.objects.create(name='Arabic')
+		self.teacher = Teacher.objects.create(name='Ms. Huda', subject=self.subject)
+		self.url = reverse('products:product-list')
+
+	def _create_products(self, count, offset=0):
+		now = timezone.now()
+		for index in range(offset, offset + count):
+			product = Product.objects.create(
+				name=f'Book {index}',
+				price=100,
+				category=self.category,
+				subject=self.subject,
+				teacher=self.teacher
+			)
+			ProductImage.objects.create(product=product, image=f'product_images/{index}.jpg')
+			ProductDescription.objects.create(product=product, title='Intro', description='Text')
+			Discount.objects.create(
+				product=product,
+				discount=10,
+				discount_start=now - timedelta(days=1),
+				discount_end=now + timedelta(days=1)
+			)
+			self.client.post(
+				reverse('products:product-rating-list-create', args=[product.id]),
+				{'star_number': 4, 'review': 'Good'},
+				format='json'
+			)
+
+	def test_product_list_query_count_does_not_grow_with_page_size(self):
+		self._create_products(1)
+		with CaptureQueriesContext(connection) as single:
+			response = self.client.get(self.url)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+		self._create_products(5, offset=1)
+		with CaptureQueriesContext(connection) as many:
+			response = self.client.get(self.url)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(len(response.data['results']), 6)
+		self.assertEqual(len(single.captured_queries), len(many.captured_queries))
+
+	def test_product_payload_values_come_from_loader(self):
+		now = timezone.now()
+		self._create_products(1)
+		Discount.objects.create(
+			category=self.category,
+			discount=25,
+			discount_start=now - timedelta(days=1),
+			discount_end=now + timedelta(days=2)
+		)
+
+		response = self.client.get(self.url)
+		payload = response.data['results'][0]
+		self.assertEqual(payload['current_discount'], 25)
+		self.assertEqual(payload['discounted_price'], 75)
+		self.assertTrue(payload['has_discount'])
+		self.assertEqual(payload['number_of_ratings'], 1)
+		self.assertEqual(payload['average_rating'], 4.0)
+		self.assertEqual(payload['category_name'], self.category.name)
+		self.assertEqual(len(payload['images']), 1)
+		self.assertEqual(len(payload['descriptions']), 1)
+		self.assertTrue(payload['main_image'].endswith('product_images/0.jpg'))
+
+	def test_cover_image_is_stable_and_follows_image_changes(self):
+		product = Product.objects.create(name='Covered', price=50)
+		first = ProductImage.objects.create(product=product, image='product_images/first.jpg')
+		ProductImage.objects.create(product=product, image='product_images/second.jpg')
+		product.refresh_from_db()
+		self.assertEqual(product.cover_image, first)
+		self.assertEqual({product.main_image().name for _ in range(5)}, {'product_images/first.jpg'})
+
+		first.delete()
+		product.refresh_from_db()
+		self.assertEqual(product.main_image().name, 'product_images/second.jpg')
+
+	def test_assign_cover_images_command_backfills_missing_covers(self):
+		product = Product.objects.create(name='Legacy', price=50)
+		ProductImage.objects.bulk_create([ProductImage(product=product, image='product_images/legacy.jpg')])
+		Product.objects.filter(pk=product.pk).update(cover_image=None)
+
+		call_command('assign_cover_images', stdout=StringIO())
+		product.refresh_from_db()
+		self.assertEqual(product.main_image().name, 'product_images/legacy.jpg')
+
+
+class MaterializedPricingTests(APITestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username='pricing',
+			password='pass1234',
+			name='Pricing User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.category = Category.objects.create(name='Physics')
+		self.cheap = Product.objects.create(name='Cheap', price=50, category=self.category)
+		self.pricey = Product.objects.create(name='Pricey', price=200)
+		self.url = reverse('products:product-list')
+
+	def test_discount_changes_refresh_effective_price(self):
+		now = timezone.now()
+		discount = Discount.objects.create(
+			product=self.pricey,
+			discount=50,
+			discount_start=now - timedelta(hours=1),
+			discount_end=now + timedelta(days=1)
+		)
+		self.pricey.refresh_from_db()
+		self.assertEqual(self.pricey.effective_price, 100)
+		self.assertEqual(self.pricey.active_discount_pct, 50)
+		self.assertEqual(self.pricey.discount_ends_at, discount.discount_end)
+
+		discount.delete()
+		self.pricey.refresh_from_db()
+		self.assertEqual(self.pricey.effective_price, 200)
+		self.assertIsNone(self.pricey.active_discount_pct)
+
+	def test_scheduled_refresh_activates_discount_after_its_start(self):
+		now = timezone.now()
+		Discount.objects.create(
+			category=self.category,
+			discount=20,
+			discount_start=now + timedelta(hours=1),
+			discount_end=now + timedelta(days=1)
+		)
+		self.cheap.refresh_from_db()
+		self.assertEqual(self.cheap.effective_price, 50)
+		self.assertIsNotNone(self.cheap.price_recompute_at)
+
+		Discount.objects.update(discount_start=now - timedelta(minutes=1))
+		Product.objects.filter(pk=self.cheap.pk).update(price_recompute_at=now - timedelta(minutes=1))
+		call_command('refresh_product_prices', stdout=StringIO())
+		self.cheap.refresh_from_db()
+		self.assertEqual(self.cheap.effective_price, 40)
+		self.assertEqual(self.cheap.active_discount_pct, 20)
+
+	def test_price_filter_and_ordering_use_effective_price(self):
+		now = timezone.now()
+		Discount.objects.create(
+			product=self.pricey,
+			discount=90,
+			discount_start=now - timedelta(hours=1),
+			discount_end=now + timedelta(days=1)
+		)
+
+		response = self.client.get(self.url, {'ordering': 'price'})
+		self.assertEqual([p['name'] for p in response.data['results']], ['Pricey', 'Cheap'])
+
+		response = self.client.get(self.url, {'price_max': 30})
+		self.assertEqual([p['name'] for p in response.data['results']], ['Pricey'])
+		self.assertAlmostEqual(response.data['results'][0]['discounted_price'], 20)
+
+
+class CatalogResponseCacheTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='home',
+			password='pass1234',
+			name='Home User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.product = Product.objects.create(name='Home Book', price=80, year='first-secondary')
+		BestProduct.objects.create(product=self.product, order=1)
+		SpecialProduct.objects.create(product=self.product, order=1)
+
+	def test_combined_products_served_from_cache_until_catalog_changes(self):
+		url = reverse('products:combined-products')
+		first = self.client.get(url)
+		self.assertEqual(len(first.data['first_year_products']), 1)
+
+		with self.assertNumQueries(0):
+			cached = self.client.get(url)
+		self.assertEqual(cached.data, first.data)
+
+		Product.objects.create(name='Second Home Book', price=90, year='first-secondary')
+		refreshed = self.client.get(url)
+		self.assertEqual(len(refreshed.data['first_year_products']), 2)
+
+	def test_special_best_products_are_cached(self):
+		url = reverse('products:special-best-products')
+		first = self.client.get(url)
+		self.assertEqual(first.data['best_products'][0]['id'], self.product.id)
+		self.assertEqual(first.data['special_products'][0]['order'], 1)
+
+		with self.assertNumQueries(0):
+			self.client.get(url)
+
+	def test_stale_copy_served_while_another_worker_rebuilds(self):
+		key = 'catalog:response:test'
+		cache.set(key, {'version': get_catalog_version() - 1, 'data': 'stale'})
+		cache.add(f'{key}:lock', 1)
+
+		self.assertEqual(get_or_build_catalog_response(key, lambda: 'fresh'), 'stale')
+
+		cache.delete(f'{key}:lock')
+		self.assertEqual(get_or_build_catalog_response(key, lambda: 'fresh'), 'fresh')
+
+
+
+class CatalogETagTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='etag',
+			password='pass1234',
+			name='ETag User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.category = Category.objects.create(name='Physics')
+		self.product = Product.objects.create(name='Physics 101', price=100, category=self.category)
+
+	def test_matching_etag_returns_304_without_queries(self):
+		for url in (
+			reverse('products:product-list'),
+			reverse('products:product-detail', args=[self.product.id]),
+			reverse('products:category-list'),
+			reverse('products:teacher-list'),
+		):
+			first = self.client.get(url)
+			self.assertEqual(first.status_code, status.HTTP_200_OK)
+			self.assertTrue(first['ETag'].startswith('W/"'))
+
+			with self.assertNumQueries(0):
+				response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+			self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+			self.assertEqual(response['ETag'], first['ETag'])
+
+	def test_conditional_get_of_missing_product_is_404(self):
+		etag = self.client.get(reverse('products:product-detail', args=[self.product.id]))['ETag']
+		missing = reverse('products:product-detail', args=[self.product.id + 1000])
+		for if_none_match in (etag, '*'):
+			response = self.client.get(missing, HTTP_IF_NONE_MATCH=if_none_match)
+			self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+	def test_etag_changes_when_a_discount_boundary_passes(self):
+		starts = timezone.now() + timedelta(hours=1)
+		Discount.objects.create(product=self.product, discount=20, discount_start=starts, discount_end=starts + timedelta(days=1))
+		url = reverse('products:product-detail', args=[self.product.id])
+		etag = self.client.get(url)['ETag']
+		self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+		# The refresh_product_prices cron has not run yet
+		with patch('products.caching.time.time', return_value=starts.timestamp() + 1):
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(response['ETag'], etag)
+
+	@override_settings(PRODUCT_COVER_DAILY_ROTATION=True)
+	def test_etag_follows_the_daily_cover_rotation(self):
+		url = reverse('products:product-list')
+		etag = self.client.get(url)['ETag']
+		with patch('products.caching.timezone.localdate', return_value=timezone.localdate() + timedelta(days=1)):
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+	def test_etag_changes_when_catalog_changes(self):
+		url = reverse('products:category-list')
+		etag = self.client.get(url)['ETag']
+
+		Category.objects.create(name='Biology')
+		response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(response['ETag'], etag)
+
+	def test_library_etag_changes_with_purchases(self):
+		url = reverse('products:purchased-books')
+		first = self.client.get(url)
+		self.assertIn('Authorization', first['Vary'])
+
+		with self.assertNumQueries(0):
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+		self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+		PurchasedBook.objects.create(user=self.user, product=self.product)
+		response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(response.data['count'], 1)
+
+
+class SparseFieldsetTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='sparse',
+			password='pass1234',
+			name='Sparse User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.category = Category.objects.create(name='Maths')
+		self.subject = Subject.objects.create(name='Algebra')
+		self.teacher = Teacher.objects.create(name='Mr. Sparse', subject=self.subject)
+		for index in range(4):
+			product = Product.objects.create(
+				name=f'Sparse {index}',
+				price=100 + index,
+				category=self.category,
+				subject=self.subject,
+				teacher=self.teacher,
+			)
+			ProductImage.objects.create(product=product, image=f'products/sparse-{index}.jpg')
+			ProductDescription.objects.create(product=product, title='About', description='Text')
+			PurchasedBook.objects.create(user=self.user, product=product, product_name=product.name)
+		self.url = reverse('products:product-list')
+
+	def test_fields_param_limits_payload_and_queries(self):
+		with CaptureQueriesContext(connection) as full:
+			self.client.get(self.url)
+		with CaptureQueriesContext(connection) as sparse:
+			response = self.client.get(self.url, {'fields': 'id,name,main_image,discounted_price'})
+
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		item = response.data['results'][0]
+		self.assertEqual(set(item), {'id', 'name', 'main_image', 'discounted_price'})
+		self.assertTrue(item['main_image'].endswith('.jpg'))
+		self.assertLess(len(sparse), len(full))
+		product_query = next(
+			query['sql'] for query in sparse.captured_queries
+			if query['sql'].startswith('SELECT "products_product"."id"')
+		)
+		self.assertNotIn('"description"', product_query)
+
+	def test_omit_param_drops_fields(self):
+		response = self.client.get(self.url, {'omit': 'images,descriptions'})
+		item = response.data['results'][0]
+		self.assertNotIn('images', item)
+		self.assertNotIn('descriptions', item)
+		self.assertIn('teacher_name', item)
+
+	def test_purchased_books_sparse_fields(self):
+		url = reverse('products:purchased-books')
+		# count, the trimmed rows, then one batch each for teachers and covers
+		with self.assertNumQueries(4):
+			response = self.client.get(url, {'fields': 'id,name,main_image,teacher_name'})
+		item = response.data['results'][0]
+		self.assertEqual(set(item), {'id', 'name', 'main_image', 'teacher_name'})
+		self.assertEqual(item['teacher_name'], 'Mr. Sparse')
+
+
+class ProductSearchTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='searcher',
+			password='pass1234',
+			name='Search User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.subject = Subject.objects.create(name='الكيمياء')
+		self.teacher = Teacher.objects.create(name='أحمد مصطفى', subject=self.subject)
+		self.chemistry = Product.objects.create(
+			name='مراجعة الكيمياء',
+			price=100,
+			subject=self.subject,
+			teacher=self.teacher,
+		)
+		self.school = Product.objects.create(name='مَدْرَسَة الفيزياء', price=90, description='كتاب الفيزياء')
+		self.url = reverse('products:product-list')
+
+	def search(self, query, **params):
+		response = self.client.get(self.url, {'search': query, **params})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		return [item['id'] for item in response.data['results']]
+
+	def test_search_matches_arabic_spelling_variants(self):
+		self.assertEqual(self.search('احمد'), [self.chemistry.id])
+		self.assertEqual(self.search('مدرسه'), [self.school.id])
+		self.assertEqual(self.search('مصطفي الكيم'), [self.chemistry.id])
+		self.assertEqual(self.search('تاريخ'), [])
+
+	def test_results_are_ranked(self):
+		self.assertEqual(self.search('الفيزياء'), [self.school.id])
+		third = Product.objects.create(name='ملخص', price=50, description='الفيزياء')
+		self.assertEqual(self.search('الفيزياء'), [self.school.id, third.id])
+
+	def test_index_follows_product_and_teacher_changes(self):
+		self.teacher.name = 'محمود'
+		self.teacher.save()
+		self.assertEqual(self.search('محمود'), [self.chemistry.id])
+		self.assertEqual(self.search('احمد'), [])
+
+		self.school.name = 'التاريخ'
+		self.school.save()
+		self.assertEqual(self.search('تاريخ'), [])
+		self.assertEqual(self.search('التاريخ'), [self.school.id])
+
+		self.school.delete()
+		self.assertEqual(self.search('التاريخ'), [])
+
+	def test_rebuild_search_index_command(self):
+		ProductSearchDocument.objects.all().delete()
+		out = StringIO()
+		call_command('rebuild_search_index', stdout=out)
+		self.assertIn('2 products', out.getvalue())
+		self.assertEqual(self.search('احمد'), [self.chemistry.id])
+
+
+class ProductAutocompleteTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='typer',
+			password='pass1234',
+			name='Typing User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.subject = Subject.objects.create(name='الكيمياء')
+		self.teacher = Teacher.objects.create(name='أحمد مصطفى', subject=self.subject)
+		self.popular = Product.objects.create(name='كيمياء عضوية', price=100, subject=self.subject, teacher=self.teacher)
+		self.quiet = Product.objects.create(name='كيمياء حيوية', price=100, subject=self.subject)
+		Product.objects.filter(pk=self.popular.pk).update(ratings_count=5)
+		Product.objects.create(name='كيمياء مخفية', price=100, is_available=False)
+		self.url = reverse('products:product-autocomplete')
+
+	def test_suggestions_are_ranked_and_served_without_queries(self):
+		self.client.get(self.url, {'q': 'x'})  # warm the worker's index
+		with self.assertNumQueries(0):
+			response = self.client.get(self.url, {'q': 'كيم'})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		names = [(item['type'], item['id']) for item in response.data['results']]
+		# 5 ratings, then the subject's 2 products, then 0 ratings; hidden products are skipped
+		self.assertEqual(names, [
+			('product', self.popular.id), ('subject', self.subject.id), ('product', self.quiet.id),
+		])
+
+	def test_normalized_multi_word_prefix(self):
+		response = self.client.get(self.url, {'q': 'احمد مص'})
+		self.assertEqual(response.data['results'], [
+			{'type': 'teacher', 'id': self.teacher.id, 'name': 'أحمد مصطفى'},
+		])
+
+	def test_index_rebuilt_when_catalog_changes(self):
+		self.client.get(self.url, {'q': 'فيز'})
+		physics = Product.objects.create(name='فيزياء', price=80)
+		response = self.client.get(self.url, {'q': 'فيز', 'limit': 1})
+		self.assertEqual(response.data['results'], [{'type': 'product', 'id': physics.id, 'name': 'فيزياء'}])
+
+	def test_rating_and_cover_writes_keep_the_index(self):
+		self.client.get(self.url, {'q': 'x'})
+		Rating.objects.create(user=self.user, product=self.quiet, star_number=4)
+		self.quiet.refresh_cover_image()
+		with self.assertNumQueries(0):
+			self.client.get(self.url, {'q': 'كيم'})
+
+
+class PillCheckoutTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='buyer',
+			password='pass1234',
+			name='Buyer'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.products = [Product.objects.create(name=f'Cart Book {index}', price=50 + index) for index in range(10)]
+		self.url = reverse('products:pill-create')
+
+	def checkout(self, products):
+		payload = {'items': [{'product': product.id} for product in products]}
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(self.url, payload, format='json')
+		self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+		return response, len(queries)
+
+	def test_checkout_queries_do_not_grow_with_cart_size(self):
+		_, small = self.checkout(self.products[:2])
+		response, large = self.checkout(self.products[2:])
+		self.assertEqual(small, large)
+
+		pill = Pill.objects.get(pk=response.data['id'])
+		self.assertEqual(pill.items.count(), 8)
+		self.assertEqual(pill.items.filter(status='i').count(), 8)
+
+	def test_paying_pill_prices_items_and_grants_books_in_bulk(self):
+		Discount.objects.create(
+			product=self.products[0],
+			discount=50,
+			discount_start=timezone.now() - timedelta(days=1),
+			discount_end=timezone.now() + timedelta(days=1),
+		)
+		response, _ = self.checkout(self.products[:3])
+		pill = Pill.objects.get(pk=response.data['id'])
+
+		pill.status = 'p'
+		# status read, freeze (items; snapshots already taken at checkout), pill update,
+		# items, item update, items, books upsert
+		with self.assertNumQueries(7):
+			pill.save()
+
+		items = {item.product_id: item for item in pill.items.all()}
+		self.assertEqual({item.status for item in items.values()}, {'p'})
+		self.assertAlmostEqual(items[self.products[0].id].price_at_sale, 25)
+		self.assertEqual(items[self.products[1].id].price_at_sale, 51)
+		books = PurchasedBook.objects.filter(user=self.user, pill=pill)
+		self.assertEqual(books.count(), 3)
+		self.assertAlmostEqual(books.get(product=self.products[0]).price_at_sale, 25)
+
+	def test_granting_twice_keeps_one_library_row_per_book(self):
+		response, _ = self.checkout(self.products[:2])
+		pill = Pill.objects.get(pk=response.data['id'])
+		pill.status = 'p'
+		pill.save()
+		pill.items.filter(product=self.products[0]).update(price_at_sale=40)
+
+		# A second webhook for the same pill upserts instead of duplicating
+		with self.assertNumQueries(2):
+			pill.grant_purchased_books()
+
+		books = PurchasedBook.objects.filter(user=self.user)
+		self.assertEqual(books.count(), 2)
+		self.assertEqual(books.get(product=self.products[0]).price_at_sale, 40)
+
+	def test_backfill_links_items_listed_in_legacy_join_table(self):
+		pill = Pill.objects.create(user=self.user)
+		other = Pill.objects.create(user=self.user)
+		orphan = PillItem.objects.create(user=self.user, product=self.products[0])
+		linked = PillItem.objects.create(user=self.user, product=self.products[1], pill=other)
+		with connection.cursor() as cursor:
+			cursor.execute(
+				'CREATE TABLE products_pill_items '
+				'(id integer PRIMARY KEY, pill_id integer NOT NULL, pillitem_id integer NOT NULL)'
+			)
+			cursor.executemany(
+				'INSERT INTO products_pill_items (pill_id, pillitem_id) VALUES (%s, %s)',
+				[(pill.pk, orphan.pk), (pill.pk, linked.pk)],
+			)
+
+		out = StringIO()
+		call_command('backfill_pill_item_pill', batch_size=1, stdout=out)
+
+		orphan.refresh_from_db()
+		linked.refresh_from_db()
+		self.assertEqual(orphan.pill_id, pill.pk)
+		self.assertEqual(linked.pill_id, other.pk)
+		self.assertIn('1 conflicts', out.getvalue())
+
+
+class PillNumberTests(APITestCase):
+	def test_numbers_are_unique_sortable_and_twenty_digits(self):
+		generator = PillNumberGenerator(worker_id=7, clock=lambda: 1700000000000)
+		numbers = [generator.next() for _ in range(12000)]  # overflows the per-ms sequence
+		self.assertEqual(len(set(numbers)), len(numbers))
+		self.assertEqual(numbers, sorted(numbers))
+		self.assertTrue(all(len(number) == 20 and number.isdigit() for number in numbers))
+		self.assertEqual(numbers[0], '17000000000000070000')
+
+	def test_clock_going_backwards_keeps_order(self):
+		ticks = iter([1700000000005, 1700000000001, 1700000000006])
+		generator = PillNumberGenerator(worker_id=1, clock=lambda: next(ticks))
+		numbers = [generator.next() for _ in range(3)]
+		self.assertEqual(numbers, sorted(numbers))
+		self.assertEqual(len(set(numbers)), 3)
+
+	def test_pill_creation_does_not_query_for_number(self):
+		user = User.objects.create_user(username='numbered', password='pass1234', name='Numbered')
+		with CaptureQueriesContext(connection) as queries:
+			pill = Pill.objects.create(user=user)
+		self.assertEqual(len(pill.pill_number), 20)
+		self.assertFalse(any('pill_number" =' in query['sql'] for query in queries.captured_queries))
+
+	def test_workers_lease_distinct_ids_from_a_shared_cache(self):
+		cache.clear()
+		with patch('products.numbering.cache_is_shared', return_value=True):
+			first, second = PillNumberGenerator(), PillNumberGenerator()
+			self.assertNotEqual(first.worker_id, second.worker_id)
+
+	def test_process_local_cache_falls_back_to_host_and_pid(self):
+		cache.clear()
+		first, second = PillNumberGenerator(), PillNumberGenerator()
+		self.assertEqual(first.worker_id, second.worker_id)
+		self.assertIsNone(cache.get('pill_number:worker_ids'))
+
+	def test_clashing_number_is_regenerated_on_save(self):
+		user = User.objects.create_user(username='clash', password='pass1234', name='Clash')
+		existing = Pill.objects.create(user=user)
+		pill = Pill(user=user, pill_number=existing.pill_number)
+		pill.save()
+		self.assertNotEqual(pill.pill_number, existing.pill_number)
+		self.assertEqual(Pill.objects.filter(user=user).count(), 2)
+
+
+
+class PillTotalsTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(
+			username='totals',
+			password='pass1234',
+			name='Totals User'
+		)
+		self.client.force_authenticate(user=self.user)
+		self.first = Product.objects.create(name='Totals One', price=100)
+		self.second = Product.objects.create(name='Totals Two', price=60)
+		response = self.client.post(
+			reverse('products:pill-create'),
+			{'items': [{'product': self.first.id}, {'product': self.second.id}]},
+			format='json'
+		)
+		self.pill = Pill.objects.get(pk=response.data['id'])
+
+	def test_checkout_snapshots_item_prices_and_totals(self):
+		self.assertEqual(self.pill.subtotal, 160)
+		self.assertEqual(self.pill.total, 160)
+		self.assertEqual(
+			sorted(self.pill.items.values_list('price_at_sale', flat=True)), [60, 100]
+		)
+
+	def test_initiated_pill_follows_price_changes(self):
+		self.first.price = 80
+		self.first.save()
+		self.assertEqual(Pill.objects.get(pk=self.pill.pk).final_price(), 140)
+
+	def test_totals_freeze_when_pill_leaves_initiated(self):
+		self.pill.status = 'w'
+		self.pill.save(update_fields=['status'])
+
+		self.first.price = 10
+		self.first.save()
+		pill = Pill.objects.get(pk=self.pill.pk)
+		with self.assertNumQueries(0):
+			self.assertEqual(pill.final_price(), 160)
+			self.assertEqual(pill.items_subtotal(), 160)
+
+		pill.status = 'p'
+		pill.save()
+		self.assertEqual(
+			sorted(PurchasedBook.objects.filter(pill=pill).values_list('price_at_sale', flat=True)), [60, 100]
+		)
+
+	def test_freezing_keeps_the_checkout_prices(self):
+		self.first.price = 80
+		self.first.save()
+		self.pill.status = 'w'
+		self.pill.save(update_fields=['status'])
+		pill = Pill.objects.get(pk=self.pill.pk)
+		self.assertEqual((pill.subtotal, pill.total), (160, 160))
+		self.assertEqual(sorted(pill.items.values_list('price_at_sale', flat=True)), [60, 100])
+
+	def test_removing_an_item_updates_stored_totals(self):
+		item = self.pill.items.get(product=self.second)
+		response = self.client.delete(reverse('products:remove-pill-item', args=[self.pill.id, item.id]))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		pill = Pill.objects.get(pk=self.pill.pk)
+		self.assertEqual((pill.subtotal, pill.total), (100, 100))
+
+	def test_freeze_pill_totals_command(self):
+		Pill.objects.filter(pk=self.pill.pk).update(subtotal=None, total=None, status='w')
+		out = StringIO()
+		call_command('freeze_pill_totals', stdout=out)
+		pill = Pill.objects.get(pk=self.pill.pk)
+		self.assertEqual((pill.subtotal, pill.total), (160, 160))
+		self.assertIn('1 pills', out.getvalue())
+
+
+class CohortAssignmentTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.admin = User.objects.create_superuser(username='admin', password='pass1234', name='Admin')
+		self.client.force_authenticate(user=self.admin)
+		self.books = [Product.objects.create(name=f'Gift Book {index}', price=80) for index in range(2)]
+		self.cohort = [
+			User.objects.create_user(username=f'0101000000{index}', password='pass1234', name=f'Student {index}', year='third-secondary')
+			for index in range(5)
+		]
+		self.other_year = User.objects.create_user(
+			username='01020000000', password='pass1234', name='Other', year='first-secondary'
+		)
+		self.url = reverse('products:admin-cohort-assignment')
+
+	def test_assigns_books_to_filtered_cohort_in_chunks(self):
+		PurchasedBook.objects.create(user=self.cohort[0], product=self.books[0])
+		response = self.client.post(
+			self.url, {'product_ids': [book.id for book in self.books], 'year': 'third-secondary'}, format='json'
+		)
+		self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+		self.assertEqual(response.data['status'], 'queued')
+
+		job = BackgroundJob.objects.get(pk=response.data['id'])
+		with CaptureQueriesContext(connection) as small:
+			assign_books(job, chunk_size=2)
+		job.refresh_from_db()
+		self.assertEqual((job.processed, job.total), (5, 5))
+		self.assertEqual(PurchasedBook.objects.filter(user__in=self.cohort).count(), 10)
+		self.assertFalse(PurchasedBook.objects.filter(user=self.other_year).exists())
+
+		# Set-wise: queries depend on the number of chunks, not on the rows per chunk
+		more = [
+			User.objects.create_user(username=f'0103000000{index}', password='pass1234', name='Late', year='first-secondary')
+			for index in range(5)
+		]
+		job.payload['user_filter'] = {'year': 'first-secondary'}
+		with CaptureQueriesContext(connection) as large:
+			result = assign_books(job, chunk_size=2)
+		self.assertEqual(len(small), len(large))
+		self.assertEqual(result['created'], 12)
+		self.assertEqual(PurchasedBook.objects.filter(user__in=more).count(), 10)
+
+	def test_rerun_reports_only_new_grants(self):
+		job = BackgroundJob.objects.create(
+			kind='assign_books',
+			payload={'product_ids': [book.id for book in self.books], 'user_filter': {'year': 'third-secondary'}},
+		)
+		self.assertEqual(assign_books(job)['created'], 10)
+		again = assign_books(job)
+		self.assertEqual((again['created'], again['skipped']), (0, 10))
+
+	def test_uploaded_list_is_run_by_the_worker(self):
+		upload = SimpleUploadedFile('students.csv', f'{self.cohort[1].username},{self.other_year.pk}\n01099999999\n'.encode())
+		response = self.client.post(
+			self.url, {'product_ids': [self.books[0].id], 'file': upload}, format='multipart'
+		)
+		self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+		call_command('run_jobs', once=True, stdout=StringIO())
+
+		response = self.client.get(reverse('products:admin-job-detail', args=[response.data['id']]))
+		self.assertEqual(response.data['status'], 'succeeded')
+		self.assertEqual(response.data['progress'], 100)
+		self.assertEqual(response.data['result']['created'], 2)
+		self.assertEqual(response.data['result']['unmatched'], ['01099999999'])
+		self.assertEqual(
+			set(PurchasedBook.objects.values_list('user_id', flat=True)), {self.cohort[1].pk, self.other_year.pk}
+		)
+
+	def test_requires_a_student_selection(self):
+		response = self.client.post(self.url, {'product_ids': [self.books[0].id]}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_failed_job_is_retried_with_backoff(self):
+		job = BackgroundJob.objects.create(kind='assign_books', payload={'product_ids': []})
+		with patch('products.assignments.Product.objects.filter', side_effect=RuntimeError('db down')):
+			with self.assertLogs('products.jobs', level='ERROR'):
+				jobs.run_job(jobs.claim_next())
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.attempts, job.error), ('queued', 1, 'db down'))
+		self.assertGreater(job.run_after, timezone.now())
+		self.assertIsNone(jobs.claim_next())
+
+
+class BulkCouponTests(APITestCase):
+	def setUp(self):
+		self.admin = User.objects.create_superuser(username='admin', password='pass1234', name='Admin')
+		self.client.force_authenticate(user=self.admin)
+		self.url = reverse('products:admin-coupon-bulk-create')
+
+	def test_bulk_coupons_stream_back_as_csv(self):
+		payload = {'number_of_coupons': 25, 'discount_value': 15, 'available_use_times': 2}
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(self.url, payload, format='json')
+		self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+		self.assertEqual(response['X-Coupons-Created'], '25')
+		self.assertLessEqual(len(queries), 5)
+
+		rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+		self.assertEqual(rows[0][:2], ['id', 'coupon'])
+		codes = [row[1] for row in rows[1:]]
+		self.assertEqual(len(set(codes)), 25)
+		self.assertEqual(set(CouponDiscount.objects.values_list('coupon', flat=True)), set(codes))
+
+	def test_generation_retries_codes_taken_by_existing_coupons(self):
+		CouponDiscount.objects.create(coupon='22222222222')
+		codes = iter(['22222222222', '33333333333', '44444444444', '55555555555'])
+		with patch('products.models.create_random_coupon', side_effect=lambda: next(codes)):
+			coupons = CouponDiscount.bulk_generate(2, batch_size=2, discount_value=10)
+		self.assertEqual(len(coupons), 2)
+		self.assertNotIn('22222222222', [coupon.coupon for coupon in coupons])
+		self.assertEqual(CouponDiscount.objects.count(), 3)
+
+
+@override_settings(COUPON_SHARDING_THRESHOLD=10, COUPON_COUNTER_SHARDS=4)
+class CouponRedemptionTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username='shopper', password='pass1234', name='Shopper')
+		self.client.force_authenticate(user=self.user)
+		self.product = Product.objects.create(name='Promo Book', price=100)
+		now = timezone.now()
+		self.window = {'coupon_start': now - timedelta(days=1), 'coupon_end': now + timedelta(days=1)}
+
+	def new_pill(self):
+		pill = Pill.objects.create(user=self.user)
+		PillItem.objects.create(pill=pill, user=self.user, product=self.product, status='i')
+		return pill
+
+	def apply(self, pill, coupon):
+		url = reverse('products:pill-coupon-apply', args=[pill.id])
+		return self.client.post(url, {'coupon_code': coupon.coupon}, format='json')
+
+	def test_small_coupon_is_used_once_per_pill(self):
+		coupon = CouponDiscount.objects.create(discount_value=10, available_use_times=2, **self.window)
+		pill = self.new_pill()
+		self.assertEqual(self.apply(pill, coupon).status_code, status.HTTP_200_OK)
+		self.assertEqual(self.apply(pill, coupon).status_code, status.HTTP_200_OK)
+
+		coupon.refresh_from_db()
+		self.assertEqual(coupon.available_use_times, 1)
+		self.assertEqual(CouponRedemption.objects.filter(coupon=coupon).count(), 1)
+
+		self.assertEqual(self.apply(self.new_pill(), coupon).status_code, status.HTTP_200_OK)
+		response = self.apply(self.new_pill(), coupon)
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_high_use_coupon_is_counted_in_shards(self):
+		coupon = CouponDiscount.objects.create(discount_value=20, available_use_times=11, **self.window)
+		for _ in range(11):
+			self.assertEqual(self.apply(self.new_pill(), coupon).status_code, status.HTTP_200_OK)
+
+		coupon.refresh_from_db()
+		self.assertTrue(coupon.sharded)
+		self.assertEqual(coupon.counter_shards.count(), 4)
+		self.assertEqual(coupon.remaining_uses, 0)
+		self.assertEqual(coupon.redemptions.count(), 11)
+		self.assertEqual(self.apply(self.new_pill(), coupon).status_code, status.HTTP_400_BAD_REQUEST)
+
+		# A released use goes back to the shard it came from
+		pill = coupon.redemptions.first().pill
+		self.assertTrue(release_coupon(pill))
+		self.assertEqual(coupon.remaining_uses, 1)
+
+	def test_new_quota_on_sharded_coupon_is_spread_again(self):
+		coupon = CouponDiscount.objects.create(discount_value=20, available_use_times=10, **self.window)
+		self.assertTrue(redeem_coupon(coupon, self.new_pill()))
+		coupon.refresh_from_db()
+		coupon.available_use_times = 30
+		coupon.save()
+		self.assertEqual(sorted(coupon.counter_shards.values_list('remaining', flat=True)), [7, 7, 8, 8])
+
+	def test_codes_are_matched_normalized_and_cached_both_ways(self):
+		coupon = CouponDiscount.objects.create(coupon='Spring-24 ab', discount_value=10, **self.window)
+		self.assertEqual(coupon.code_normalized, 'SPRING24AB')
+		with self.assertNumQueries(1):
+			self.assertEqual(get_coupon_by_code(' spring24-AB').pk, coupon.pk)
+			self.assertEqual(get_coupon_by_code('SPRING24AB').pk, coupon.pk)
+
+		# Unknown codes are cached too, so retries never reach the coupons table
+		pill = self.new_pill()
+		url = reverse('products:pill-coupon-apply', args=[pill.id])
+		with CaptureQueriesContext(connection) as first:
+			response = self.client.post(url, {'coupon_code': 'NOPE'}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+		with CaptureQueriesContext(connection) as second:
+			self.client.post(url, {'coupon_code': 'nope'}, format='json')
+		self.assertEqual(len(second), len(first) - 1)
+
+		# Editing the coupon drops its cached entry
+		coupon.discount_value = 30
+		coupon.save()
+		self.assertEqual(get_coupon_by_code('spring24ab').discount_value, 30)
+
+	def test_backfill_renames_clashing_codes_instead_of_hiding_them(self):
+		first = CouponDiscount.objects.create(coupon='AB-12', discount_value=10, **self.window)
+		second = CouponDiscount.objects.create(coupon='ab12x', discount_value=15, **self.window)
+		CouponDiscount.objects.filter(pk=first.pk).update(code_normalized=None)
+		CouponDiscount.objects.filter(pk=second.pk).update(coupon='ab12', code_normalized=None)
+
+		out = StringIO()
+		call_command('backfill_coupon_codes', batch_size=1, stdout=out)
+		self.assertIn('renamed', out.getvalue())
+		self.assertFalse(CouponDiscount.objects.filter(code_normalized__isnull=True).exists())
+		self.assertEqual(get_coupon_by_code('ab-12').pk, first.pk)
+		second.refresh_from_db()
+		self.assertNotEqual(second.coupon, 'ab12')
+		self.assertEqual(get_coupon_by_code(second.coupon).pk, second.pk)
+
+
+class ReapInitiatedPillsTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username='idle', password='pass1234', name='Idle')
+		self.product = Product.objects.create(name='Forgotten Book', price=100)
+		now = timezone.now()
+		self.coupon = CouponDiscount.objects.create(
+			discount_value=10, available_use_times=5,
+			coupon_start=now - timedelta(days=90), coupon_end=now + timedelta(days=1),
+		)
+
+	def make_pill(self, days_old, status='i', **fields):
+		pill = Pill.objects.create(user=self.user, status=status, **fields)
+		PillItem.objects.create(pill=pill, user=self.user, product=self.product, status=status, price_at_sale=100)
+		Pill.objects.filter(pk=pill.pk).update(date_added=timezone.now() - timedelta(days=days_old))
+		return pill
+
+	def test_reaps_stale_unpaid_pills_and_returns_coupon_uses(self):
+		stale = [self.make_pill(40) for _ in range(3)]
+		for pill in stale[:2]:
+			self.assertTrue(redeem_coupon(self.coupon, pill))
+		Pill.objects.filter(pk__in=[pill.pk for pill in stale[:2]]).update(coupon=self.coupon)
+		recent = self.make_pill(2)
+		paid = self.make_pill(40, status='p')
+		invoiced = self.make_pill(40, easypay_created_at=timezone.now() - timedelta(days=1))
+
+		out = StringIO()
+		call_command('reap_initiated_pills', days=30, archive=True, batch_size=2, stdout=out)
+
+		remaining = set(Pill.objects.values_list('pk', flat=True))
+		self.assertEqual(remaining, {recent.pk, paid.pk, invoiced.pk})
+		self.assertFalse(PillItem.objects.filter(pill_id__in=[pill.pk for pill in stale]).exists())
+		self.coupon.refresh_from_db()
+		self.assertEqual(self.coupon.available_use_times, 5)
+		self.assertFalse(CouponRedemption.objects.exists())
+
+		archived = ArchivedPill.objects.get(pill_id=stale[0].pk)
+		self.assertEqual(archived.coupon_code, self.coupon.coupon)
+		self.assertEqual(archived.items, [{'product_id': self.product.pk, 'price_at_sale': 100.0}])
+		self.assertEqual(ArchivedPill.objects.count(), 3)
+		self.assertIn('3 stale pills', out.getvalue())
+
+
+class InvoiceJobTests(APITestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='payer', password='pass1234', name='Payer')
+		self.client.force_authenticate(user=self.user)
+		self.pill = Pill.objects.create(user=self.user)
+		PillItem.objects.create(pill=self.pill, user=self.user, product=Product.objects.create(name='Paid Book', price=120), price_at_sale=120)
+		self.url = reverse('products:create_easypay_invoice', args=[self.pill.id])
+		self.invoice = {
+			'success': True,
+			'data': {'invoice_uid': 'uid-1', 'invoice_sequence': 'seq-1', 'payment_url': 'https://pay.example/1', 'invoice_details': {'fawry_ref': '9876543'}},
+		}
+
+	def test_request_is_queued_and_worker_creates_the_invoice(self):
+		with patch('services.easypay_service.easypay_service.create_payment_invoice', return_value=self.invoice) as gateway:
+			response = self.client.post(self.url)
+			again = self.client.post(self.url)
+			self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+			self.assertEqual(again.data['job_id'], response.data['job_id'])
+			gateway.assert_not_called()
+
+			jobs.run_pending()
+		gateway.assert_called_once()
+
+		result = self.client.get(response.data['status_url'])
+		self.assertEqual(result.data['status'], 'succeeded')
+		self.assertEqual(result.data['data']['fawry_ref'], '9876543')
+		self.pill.refresh_from_db()
+		self.assertEqual((self.pill.status, self.pill.easypay_invoice_uid), ('w', 'uid-1'))
+		self.assertEqual(PaymentReference.find_pill('easypay', 'fawry_ref', '9876543'), self.pill)
+		self.assertEqual(self.client.post(self.url).status_code, status.HTTP_200_OK)
+
+	def test_job_of_a_crashed_worker_is_released(self):
+		response = self.client.post(self.url)
+		job = jobs.claim_next()
+		self.assertEqual(job.pk, response.data['job_id'])
+		# The worker dies without finishing; its lease runs out
+		BackgroundJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+
+		retry = self.client.post(self.url)
+		self.assertEqual(retry.status_code, status.HTTP_202_ACCEPTED)
+		self.assertNotEqual(retry.data['job_id'], job.pk)
+
+		with patch('services.easypay_service.easypay_service.create_payment_invoice', return_value=self.invoice) as gateway:
+			with self.assertLogs('products.jobs', 'WARNING'):
+				jobs.run_pending()
+		gateway.assert_called_once()
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.attempts), ('queued', 1))
+		self.assertIn('Worker stopped', job.error)
+		self.assertEqual(self.client.get(retry.data['status_url']).data['status'], 'succeeded')
+
+	def test_job_for_another_gateway_is_not_reused(self):
+		easypay = self.client.post(self.url)
+		shakeout = self.client.post(reverse('products:create_shakeout_invoice', args=[self.pill.id]))
+		self.assertEqual(shakeout.status_code, status.HTTP_202_ACCEPTED)
+		self.assertNotEqual(shakeout.data['job_id'], easypay.data['job_id'])
+		self.assertEqual(shakeout.data['payment_gateway'], 'shakeout')
+		self.assertEqual(BackgroundJob.objects.get(pk=shakeout.data['job_id']).payload['gateway'], 'shakeout')
+
+	def test_bad_fawry_reference_is_retried_with_backoff(self):
+		bad = {'success': True, 'data': {'invoice_uid': 'uid-0', 'invoice_details': {'fawry_ref': '{"statusCode": 9901}'}}}
+		response = self.client.post(self.url)
+		with patch('services.easypay_service.easypay_service.create_payment_invoice', side_effect=[bad, self.invoice]):
+			with self.assertLogs('products.jobs', 'ERROR'):
+				jobs.run_pending()
+			job = BackgroundJob.objects.get(pk=response.data['job_id'])
+			self.assertEqual((job.status, job.attempts), ('queued', 1))
+			self.assertGreater(job.run_after, timezone.now())
+			self.assertIn('Invalid Fawry reference', self.client.get(response.data['status_url']).data['last_error'])
+
+			BackgroundJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+			jobs.run_pending()
+		result = self.client.get(response.data['status_url'])
+		self.assertEqual((result.data['status'], result.data['attempts']), ('succeeded', 2))
+		self.assertEqual(result.data['data']['attempts'], 2)
+
+
+class HttpClientTests(APITestCase):
+	def tearDown(self):
+		http_client.reset_session()
+
+	def test_sessions_are_pooled_per_thread(self):
+		session = http_client.get_session()
+		self.assertIs(http_client.get_session(), session)
+
+		other = []
+		worker = threading.Thread(target=lambda: other.append(http_client.get_session()))
+		worker.start()
+		worker.join()
+		self.assertIsNot(other[0], session)
+
+		retry = session.get_adapter('https://example.com').max_retries
+		self.assertFalse(retry.is_retry('POST', 503))
+		self.assertTrue(retry.is_retry('GET', 503))
+		self.assertGreater(retry.backoff_jitter, 0)
+
+		single_shot = http_client.get_session(idempotent=False).get_adapter('https://example.com').max_retries
+		self.assertFalse(single_shot.is_retry('GET', 503, has_retry_after=True))
+		self.assertGreater(single_shot.connect, 0)
+
+	@override_settings(HTTP_CONNECT_TIMEOUT=2, HTTP_READ_TIMEOUT=20)
+	def test_whatsapp_message_uses_shared_session_with_split_timeouts(self):
+		from .utils import send_whatsapp_message
+
+		with patch.object(http_client.get_session(idempotent=False), 'request') as request:
+			request.return_value.json.return_value = {'status': 'sent'}
+			self.assertEqual(send_whatsapp_message('01012345678', 'hi'), {'status': 'sent'})
+		self.assertEqual(request.call_args.kwargs['timeout'], (2.0, 20.0))
+
+
+@override_settings(CIRCUIT_MIN_CALLS=3, CIRCUIT_FAILURE_RATE=0.5, CIRCUIT_COOLDOWN_SECONDS=30)
+class CircuitBreakerTests(APITestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username='checkout', password='pass1234', name='Checkout')
+		self.client.force_authenticate(user=self.user)
+		self.pill = Pill.objects.create(user=self.user)
+		self.url = reverse('products:create_payment_invoice', args=[self.pill.id])
+
+	def tearDown(self):
+		http_client.reset_session()
+
+	def test_open_circuit_fails_fast_then_lets_one_probe_through(self):
+		session = http_client.get_session()
+		with patch.object(session, 'request', side_effect=requests.ConnectTimeout('timed out')) as request:
+			for _ in range(3):
+				with self.assertRaises(requests.ConnectTimeout):
+					http_client.post('https://gateway.example/invoice', breaker='easypay')
+			with self.assertRaises(CircuitOpenError):
+				http_client.post('https://gateway.example/invoice', breaker='easypay')
+		self.assertEqual(request.call_count, 3)
+		self.assertEqual(get_breaker('easypay').state, 'open')
+
+		later = time.time() + 31
+		with patch('services.circuit_breaker.time.time', return_value=later), patch.object(session, 'request') as request:
+			request.return_value.status_code = 200
+			breaker = get_breaker('easypay')
+			self.assertEqual(breaker.state, 'half_open')
+			self.assertTrue(breaker.allow_request())
+			self.assertFalse(breaker.allow_request())
+			cache.delete(breaker.probe_key)
+			http_client.post('https://gateway.example/invoice', breaker='easypay')
+			self.assertEqual(breaker.state, 'closed')
+
+	@override_settings(ACTIVE_PAYMENT_METHOD='easypay', SHAKEOUT_API_KEY='key', SHAKEOUT_SECRET_KEY='secret')
+	def test_checkout_fails_over_while_active_gateway_is_down(self):
+		get_breaker('easypay').trip()
+		response = self.client.post(self.url)
+		self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+		self.assertEqual(response.data['payment_gateway'], 'shakeout')
+		self.assertEqual(BackgroundJob.objects.get(pk=response.data['job_id']).payload['gateway'], 'shakeout')
+
+	@override_settings(ACTIVE_PAYMENT_METHOD='easypay', PAYMENT_GATEWAY_FAILOVER=False)
+	def test_checkout_answers_503_without_a_fallback(self):
+		get_breaker('easypay').trip()
+		with patch('services.easypay_service.easypay_service.create_payment_invoice') as gateway:
+			response = self.client.post(self.url)
+		self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+		self.assertEqual(response.data['error_code'], 'GATEWAY_UNAVAILABLE')
+		self.assertFalse(BackgroundJob.objects.exists())
+		gateway.assert_not_called()
+
+
+class WebhookInboxTests(APITestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='buyer', password='pass1234', name='Buyer')
+		self.book = Product.objects.create(name='Webhook Book', price=90)
+		self.pill = Pill.objects.create(user=self.user, status='w', easypay_invoice_sequence='SEQ-1', shakeout_invoice_id='INV-1')
+		PillItem.objects.create(pill=self.pill, user=self.user, product=self.book, price_at_sale=90)
+		PaymentReference.record(self.pill, 'easypay', invoice_sequence='SEQ-1')
+		PaymentReference.record(self.pill, 'shakeout', invoice_id='INV-1')
+		self.paid = {
+			'easy_pay_sequence': 'SEQ-1', 'status': 'PAID', 'signature': 'sig',
+			'customer_phone': '01011111111', 'amount': '90.00',
+		}
+
+	@patch('services.easypay_service.easypay_service.verify_webhook_signature', return_value=True)
+	def test_webhook_is_stored_deduplicated_and_applied_by_the_worker(self, verify):
+		url = reverse('easypay_webhook_root')
+		response = self.client.post(url, self.paid, format='json')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertFalse(response.json()['duplicate'])
+		self.pill.refresh_from_db()
+		self.assertEqual(self.pill.status, 'w')
+
+		# The gateway retries the same callback
+		self.assertTrue(self.client.post(url, self.paid, format='json').json()['duplicate'])
+		self.assertEqual(WebhookInboxEntry.objects.count(), 1)
+
+		call_command('drain_webhooks', once=True, stdout=StringIO())
+		entry = WebhookInboxEntry.objects.get()
+		self.assertEqual((entry.status, entry.pill_id, entry.attempts), ('processed', self.pill.pk, 1))
+		self.pill.refresh_from_db()
+		self.assertEqual(self.pill.status, 'p')
+		self.assertTrue(PurchasedBook.objects.filter(user=self.user, product=self.book).exists())
+
+	def test_entry_abandoned_by_a_crashed_drainer_is_recovered(self):
+		crashed = WebhookInboxEntry.objects.create(
+			gateway='easypay', reference='SEQ-1', event_status='PAID', body=json.dumps(self.paid),
+		)
+		later = WebhookInboxEntry.objects.create(
+			gateway='easypay', reference='SEQ-1', event_status='REFUNDED', body=json.dumps({**self.paid, 'status': 'REFUNDED'}),
+		)
+		self.assertEqual(webhook_inbox.claim_next().pk, crashed.pk)
+		# The drainer dies here, before process_entry; the claim goes stale
+		WebhookInboxEntry.objects.filter(pk=crashed.pk).update(claimed_at=timezone.now() - timedelta(hours=1))
+
+		with self.assertLogs('products.webhook_inbox', 'WARNING'):
+			self.assertEqual(webhook_inbox.drain(), 2)
+		crashed.refresh_from_db()
+		self.assertEqual((crashed.status, crashed.attempts), ('processed', 2))
+		self.assertEqual(WebhookInboxEntry.objects.get(pk=later.pk).status, 'processed')
+		self.pill.refresh_from_db()
+		self.assertEqual(self.pill.status, 'p')
+
+	def test_failing_shakeout_update_is_retried_not_marked_processed(self):
+		body = {'type': 'invoice', 'data': {'invoice_id': 'INV-1', 'invoice_status': 'paid', 'amount': 90}}
+		entry = WebhookInboxEntry.objects.create(
+			gateway='shakeout', reference='INV-1', event_status='paid', body=json.dumps(body),
+		)
+		with patch.object(Pill, 'grant_purchased_books', side_effect=RuntimeError('db down')):
+			with self.assertLogs('products.webhook_inbox', 'ERROR'):
+				webhook_inbox.drain(limit=1)
+		entry.refresh_from_db()
+		self.assertEqual((entry.status, entry.attempts), ('received', 1))
+		self.pill.refresh_from_db()
+		self.assertEqual(self.pill.status, 'w')
+
+	def test_entries_of_one_invoice_are_applied_in_order(self):
+		retrying = WebhookInboxEntry.objects.create(
+			gateway='shakeout', reference='INV-1', event_status='pending', body='{}',
+			next_attempt_at=timezone.now() + timedelta(minutes=5),
+		)
+		later = WebhookInboxEntry.objects.create(gateway='shakeout', reference='INV-1', event_status='paid', body='{}')
+		other = WebhookInboxEntry.objects.create(gateway='easypay', reference='SEQ-1', event_status='PAID', body=json.dumps(self.paid))
+
+		self.assertEqual(webhook_inbox.drain(), 1)
+		self.assertEqual(WebhookInboxEntry.objects.get(pk=other.pk).status, 'processed')
+		self.assertEqual(WebhookInboxEntry.objects.get(pk=later.pk).status, 'received')
+
+		WebhookInboxEntry.objects.filter(pk=retrying.pk).update(status='processed')
+		self.assertEqual(webhook_inbox.claim_next().pk, later.pk)
+
+
+class PaymentReferenceTests(APITestCase):
+	def setUp(self):
+		self.admin = User.objects.create_superuser(username='admin', password='pass1234', name='Admin')
+		self.client.force_authenticate(user=self.admin)
+		self.pill = Pill.objects.create(
+			user=self.admin, easypay_invoice_uid='uid-7', easypay_invoice_sequence='777', easypay_fawry_ref='',
+		)
+		self.other = Pill.objects.create(user=self.admin, shakeout_invoice_id='so-1', shakeout_invoice_ref='REF-1')
+		Pill.objects.create(user=self.admin)
+
+	def test_backfill_then_resolve_by_reference(self):
+		out = StringIO()
+		call_command('backfill_payment_references', batch_size=1, stdout=out)
+		call_command('backfill_payment_references', stdout=StringIO())
+		self.assertIn('4 payment references for 2 pills', out.getvalue())
+		self.assertEqual(PaymentReference.objects.count(), 4)
+		self.assertEqual(PaymentReference.find_pill('easypay', 'invoice_sequence', '777'), self.pill)
+		self.assertEqual(PaymentReference.find_pill('shakeout', 'invoice_ref', 'REF-1'), self.other)
+		self.assertIsNone(PaymentReference.find_pill('shakeout', 'invoice_id', '777'))
+
+		response = self.client.get(reverse('products:admin-pill-list-create'), {'search': 'so-1'})
+		self.assertEqual([pill['id'] for pill in response.data['results']], [self.other.id])
+
+	def test_lookup_before_the_backfill_falls_back_to_the_pill_columns(self):
+		self.assertEqual(PaymentReference.find_pill('easypay', 'invoice_sequence', '777'), self.pill)
+		self.assertTrue(PaymentReference.objects.filter(kind='invoice_sequence', value='777', pill=self.pill).exists())
+		with self.assertNumQueries(1):
+			self.assertEqual(PaymentReference.find_pill('easypay', 'invoice_sequence', '777'), self.pill)
+		self.assertIsNone(PaymentReference.find_pill('easypay', 'invoice_sequence', '999'))
@@ -16,6 +16,7 @@ urlpatterns = [
     path('teachers/<int:id>/', views.TeacherDetailView.as_view(), name='teacher-detail'),
     path('products/', views.ProductListView.as_view(), name='product-list'),
     path('products/<int:id>/', views.ProductDetailView.as_view(), name='product-detail'),
+    path('autocomplete/', views.ProductAutocompleteView.as_view(), name='product-autocomplete'),
     path('last-products/', views.Last10ProductsListView.as_view(), name='last-products'),
     path('special-products/active/', views.ActiveSpecialProductsView.as_view(), name='special-products'),
     path('best-products/active/', views.ActiveBestProductsView.as_view(), name='best-products'),
@@ -86,6 +87,8 @@ urlpatterns = [
     path('dashboard/ratings/', views.RatingListCreateView.as_view(), name='admin-rating-list-create'),
     path('dashboard/ratings/<int:pk>/', views.RatingDetailView.as_view(), name='admin-rating-detail'),
     path('dashboard/add-books-to-student/', views.AddBooksToStudentView.as_view(), name='add-books-to-student'),
+    path('dashboard/cohort-assignments/', views.CohortBookAssignmentView.as_view(), name='admin-cohort-assignment'),
+    path('dashboard/jobs/<int:pk>/', views.BackgroundJobDetailView.as_view(), name='admin-job-detail'),
     path('dashboard/purchased-books/', views.AdminPurchasedBookListCreateView.as_view(), name='admin-purchased-books-list-create'),
     path('dashboard/purchased-books/<int:pk>/', views.AdminPurchasedBookRetrieveUpdateDestroyView.as_view(), name='admin-purchased-books-detail'),
     path('dashboard/purchased-books/by-user/<int:user_id>/', views.AdminUserPurchasedBooksView.as_view(), name='admin-user-purchased-books'),
@@ -111,5 +114,6 @@ urlpatterns = [
     path('pills/<int:pill_id>/create-easypay-invoice/', payment_views.create_easypay_invoice_view, name='create_easypay_invoice'),
     path('pills/<int:pill_id>/check-easypay-status/', payment_views.check_easypay_invoice_status_view, name='check_easypay_status'),
     path('pills/<int:pill_id>/create-payment-invoice/', payment_views.create_payment_invoice_view, name='create_payment_invoice'),
+    path('pills/<int:pill_id>/invoice-jobs/<int:job_id>/', payment_views.invoice_job_status_view, name='invoice_job_status'),
 ]
 
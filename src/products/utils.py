@@ -1,7 +1,8 @@
 import json
-import requests
 from django.conf import settings
 
+from services import http_client
+
 def send_whatsapp_message(phone_number, message):
     url = "https://whats.easytech-sotfware.com/api/v1/send-text"
     params = {
@@ -11,7 +12,8 @@ def send_whatsapp_message(phone_number, message):
             "jid": f"2{phone_number}@s.whatsapp.net"
         }
     
-    req = requests.get(url, params=params)
+    # send-text sends on GET: a read timeout must not deliver the message twice
+    req = http_client.get(url, params=params, idempotent=False)
     
     return req.json()
 
@@ -1,4 +1,5 @@
 from datetime import timedelta
+import csv
 import random
 import logging
 from django.shortcuts import get_object_or_404
@@ -8,6 +9,8 @@ import json
 import mimetypes
 
 logger = logging.getLogger(__name__)
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from django.utils import timezone
 from django.db.models import Sum, F, Count, Q, Case, When, IntegerField
 from rest_framework import generics, status
@@ -21,17 +24,22 @@ from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.views import APIView
 from .serializers import *
-from .filters import CategoryFilter, CouponDiscountFilter, PillFilter, ProductFilter, PurchasedBookFilter
+from .filters import CategoryFilter, CouponDiscountFilter, PillFilter, PillSearchFilter, ProductFilter, PurchasedBookFilter
 from .models import (
     Category, CouponDiscount,
     ProductImage, Rating, SubCategory, Product, Pill,
-    PurchasedBook, PillItem
+    PurchasedBook, PillItem, BackgroundJob
 )
 from accounts.models import User
 from .permissions import IsOwner, IsOwnerOrReadOnly
+from .caching import CatalogETagMixin, catalog_cache_key, get_or_build_catalog_response
+from .fieldsets import SparseQuerysetMixin
+from .search import ProductSearchFilter
+from . import autocomplete, jobs
+from .assignments import ASSIGN_BOOKS_JOB
 from services.s3_service import s3_service
 
-class CategoryListView(generics.ListAPIView):
+class CategoryListView(CatalogETagMixin, generics.ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
@@ -52,7 +60,7 @@ class SubjectListView(generics.ListAPIView):
     filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
     search_fields = ['name', ]
  
-class TeacherListView(generics.ListAPIView):
+class TeacherListView(CatalogETagMixin, generics.ListAPIView):
     queryset = Teacher.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = TeacherSerializer
@@ -71,21 +79,38 @@ class TeacherDetailView(generics.RetrieveAPIView):
         serializer = self.get_serializer(teacher, context={'request': request})
         return Response(serializer.data)
 
-class ProductListView(generics.ListAPIView):
+class ProductListView(CatalogETagMixin, SparseQuerysetMixin, generics.ListAPIView):
     queryset = Product.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter]
     filterset_class = ProductFilter
-    search_fields = ['name', 'category__name', 'subject__name' , 'teacher__name', 'description']
 
 
-class ProductDetailView(generics.RetrieveAPIView):
+class ProductDetailView(CatalogETagMixin, SparseQuerysetMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = ProductSerializer
     lookup_field = 'id'
 
+
+class ProductAutocompleteView(APIView):
+    """
+    Search-box suggestions: GET /products/autocomplete/?q=<prefix>&limit=10
+    Served from the worker's in-memory prefix index, not the database.
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 10
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        limit = max(1, min(limit, autocomplete.MAX_SUGGESTIONS))
+        return Response({'query': query, 'results': autocomplete.suggest(query, limit)})
+
 class Last10ProductsListView(generics.ListAPIView):
     queryset = Product.objects.all()
     permission_classes = [IsAuthenticated]
@@ -113,19 +138,25 @@ class CombinedProductsView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, *args, **kwargs):
+        # Same payload for every student: cache it per catalog version + query params
+        data = get_or_build_catalog_response(
+            catalog_cache_key('combined-products', request),
+            lambda: self.build_data(request)
+        )
+        return Response(data, status=status.HTTP_200_OK)
+
+    def build_data(self, request):
         # Get limit parameter with default of 10
         limit = int(request.query_params.get('limit', 10))
         
         # Prepare response data
-        data = {
+        return {
             'last_products': self.get_last_products(limit),
             'important_products': self.get_important_products(limit),
             'first_year_products': self.get_year_products('first-secondary', limit),
             'second_year_products': self.get_year_products('second-secondary', limit),
             'third_year_products': self.get_year_products('third-secondary', limit),
         }
-        
-        return Response(data, status=status.HTTP_200_OK)
     
     def get_last_products(self, limit):
         queryset = Product.objects.all().order_by('-id')[:limit]
@@ -147,27 +178,37 @@ class SpecialBestProductsView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, *args, **kwargs):
+        data = get_or_build_catalog_response(
+            catalog_cache_key('special-best-products', request),
+            lambda: self.build_data(request)
+        )
+        return Response(data, status=status.HTTP_200_OK)
+
+    def build_data(self, request):
         # Get limit parameter with default of 10
         limit = int(request.query_params.get('limit', 10))
         
         # Prepare response data
-        data = {
+        return {
             'special_products': self.get_special_products(limit),
             'best_products': self.get_best_products(limit),
         }
-        
-        return Response(data, status=status.HTTP_200_OK)
+
+    def serialize_products(self, rows):
+        # One serializer for the whole list so the product loader batches its queries
+        return ProductSerializer(
+            [row.product for row in rows], many=True, context={'request': self.request}
+        ).data
     
     def get_special_products(self, limit):
         # Get the special products with their related product data
-        special_products = SpecialProduct.objects.filter(
+        special_products = list(SpecialProduct.objects.filter(
             is_active=True
-        ).order_by('-order')[:limit].select_related('product')
+        ).order_by('-order')[:limit].select_related('product'))
         
         # Serialize with additional fields
         result = []
-        for sp in special_products:
-            product_data = ProductSerializer(sp.product, context={'request': self.request}).data
+        for sp, product_data in zip(special_products, self.serialize_products(special_products)):
             result.append({
                 'order': sp.order,
                 'special_image': self.get_special_image_url(sp),
@@ -184,14 +225,13 @@ class SpecialBestProductsView(APIView):
     
     def get_best_products(self, limit):
         # Get the best products with their related product data
-        best_products = BestProduct.objects.filter(
+        best_products = list(BestProduct.objects.filter(
             is_active=True
-        ).order_by('-order')[:limit].select_related('product')
+        ).order_by('-order')[:limit].select_related('product'))
         
         # Serialize with additional fields
         result = []
-        for bp in best_products:
-            product_data = ProductSerializer(bp.product, context={'request': self.request}).data
+        for bp, product_data in zip(best_products, self.serialize_products(best_products)):
             result.append({
                 'order': bp.order,
                 **product_data
@@ -292,7 +332,11 @@ class PillDetailView(generics.RetrieveAPIView, PillItemPermissionMixin):
 
     def get_object(self):
         pill_id = self.kwargs.get('id')
-        return get_object_or_404(Pill, id=pill_id, user=self.request.user)
+        return get_object_or_404(
+            Pill.objects.prefetch_related('items__product'),
+            id=pill_id,
+            user=self.request.user
+        )
 
 class UserPillsView(generics.ListAPIView):
     serializer_class = PillDetailSerializer
@@ -301,7 +345,12 @@ class UserPillsView(generics.ListAPIView):
     def get_queryset(self):
         # Allow filtering by pill status via query param `status`.
         # Example: ?status=p  or ?status=p,i (comma-separated)
-        queryset = Pill.objects.filter(user=self.request.user).order_by('-date_added')
+        queryset = (
+            Pill.objects.filter(user=self.request.user)
+            .select_related('user', 'coupon')
+            .prefetch_related('items__product')
+            .order_by('-date_added')
+        )
         status_param = self.request.query_params.get('status')
         if status_param:
             statuses = [s.strip() for s in status_param.split(',') if s.strip()]
@@ -310,14 +359,15 @@ class UserPillsView(generics.ListAPIView):
         return queryset
 
 
-class PurchasedBookListView(generics.ListAPIView):
+class PurchasedBookListView(CatalogETagMixin, SparseQuerysetMixin, generics.ListAPIView):
     serializer_class = PurchasedBookSerializer
     permission_classes = [IsAuthenticated]
+    etag_per_user = True
 
     def get_queryset(self):
         return (
             PurchasedBook.objects.filter(user=self.request.user)
-            .select_related('product', 'product__teacher', 'pill')
+            .select_related('user', 'product', 'product__teacher', 'product__cover_image', 'pill')
             .order_by('-created_at')
         )
 
@@ -425,14 +475,13 @@ class AddFreeBookView(APIView):
 
         with transaction.atomic():
             pill = Pill.objects.create(user=request.user, status='p')
-            pill_item = PillItem.objects.create(
+            PillItem.objects.create(
                 user=request.user,
                 product=product,
                 status='p',
                 pill=pill,
                 price_at_sale=float(effective_price or 0)
             )
-            pill.items.add(pill_item)
             pill.grant_purchased_books()
 
         purchased_book = PurchasedBook.objects.get(user=request.user, product=product)
@@ -445,7 +494,31 @@ class RatingPagination(CustomPageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
 
-class ProductRatingListCreateView(generics.ListCreateAPIView):
+class RatingAggregateMixin:
+    """Keep the stored ``Product.ratings_*`` aggregates in step with rating writes."""
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            rating = serializer.save()
+            Product.apply_rating_change(rating.product_id, 1, rating.star_number)
+
+    def perform_update(self, serializer):
+        old_product_id = serializer.instance.product_id
+        old_star_number = serializer.instance.star_number
+        with transaction.atomic():
+            rating = serializer.save()
+            if rating.product_id != old_product_id:
+                Product.apply_rating_change(old_product_id, -1, -old_star_number)
+                Product.apply_rating_change(rating.product_id, 1, rating.star_number)
+            elif rating.star_number != old_star_number:
+                Product.apply_rating_change(rating.product_id, 0, rating.star_number - old_star_number)
+
+    def perform_destroy(self, instance):
+        # The Rating post_delete handler (products.signals) recomputes the product
+        instance.delete()
+
+
+class ProductRatingListCreateView(RatingAggregateMixin, generics.ListCreateAPIView):
     serializer_class = RatingSerializer
     pagination_class = RatingPagination
 
@@ -517,10 +590,12 @@ class ProductRatingListCreateView(generics.ListCreateAPIView):
         user = self.request.user
         if Rating.objects.filter(product=product, user=user).exists():
             raise ValidationError('You already rated this product. Use the update endpoint instead.')
-        serializer.save(user=user, product=product)
+        with transaction.atomic():
+            rating = serializer.save(user=user, product=product)
+            Product.apply_rating_change(product.pk, 1, rating.star_number)
 
 
-class ProductRatingDetailView(generics.RetrieveUpdateDestroyAPIView):
+class ProductRatingDetailView(RatingAggregateMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = RatingSerializer
     permission_classes = [IsAuthenticated, IsOwner]
 
@@ -531,7 +606,7 @@ class ProductRatingDetailView(generics.RetrieveUpdateDestroyAPIView):
         )
 
 
-class RatingByIdOwnerDetailView(generics.RetrieveUpdateDestroyAPIView):
+class RatingByIdOwnerDetailView(RatingAggregateMixin, generics.RetrieveUpdateDestroyAPIView):
     """Allow retrieve/update/delete of a Rating by its id. Owner-only."""
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
@@ -565,7 +640,7 @@ class LovedProductListCreateView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return LovedProduct.objects.filter(user=self.request.user)
+        return LovedProduct.objects.filter(user=self.request.user).select_related('product')
 
     def perform_create(self, serializer):
         serializer.save()
@@ -723,18 +798,23 @@ class CustomPillFilterBackend(filters.BaseFilterBackend):
 
 class PillItemListCreateView(generics.ListCreateAPIView):
     queryset = PillItem.objects.select_related(
-        'user', 'product', 'pill'
+        'user', 'product', 'product__cover_image', 'pill'
     ).prefetch_related('product__images')
     serializer_class = AdminPillItemSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [CustomPillFilterBackend, OrderingFilter]
     ordering_fields = ['date_added', 'quantity']
     ordering = ['-date_added']
-    
+
+    def perform_create(self, serializer):
+        item = serializer.save()
+        if item.pill:
+            item.pill.snapshot_totals()
+
 
 class PillItemRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     queryset = PillItem.objects.select_related(
-        'user', 'product', 'pill'
+        'user', 'product', 'product__cover_image', 'pill'
     )
     serializer_class = AdminPillItemSerializer
     permission_classes = [IsAuthenticated]
@@ -744,6 +824,14 @@ class PillItemRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
         if instance.pill and instance.pill.status == 'p':
             raise serializers.ValidationError("Cannot delete items from paid/delivered pills")
         instance.delete()
+        if instance.pill:
+            instance.pill.snapshot_totals()
+
+    def perform_update(self, serializer):
+        previous_pill = serializer.instance.pill
+        item = serializer.save()
+        for pill in {previous_pill, item.pill} - {None}:
+            pill.snapshot_totals()
 
 
 class RemovePillItemView(APIView):
@@ -770,8 +858,7 @@ class RemovePillItemView(APIView):
             removed_item_info = {
                 'id': pill_item.id,
                 'product_name': pill_item.product.name,
-                'quantity': pill_item.quantity,
-                'price': float(pill_item.price)
+                'price': float(pill_item.price_at_sale or 0)
             }
             
             # Remove the item
@@ -790,8 +877,8 @@ class RemovePillItemView(APIView):
                     'removed_item': removed_item_info
                 }, status=status.HTTP_200_OK)
             
-            # Recalculate pill totals
-            pill.save()  # This will trigger recalculation in the save method
+            # Recalculate the stored pill totals from the remaining items
+            pill.snapshot_totals()
             
             return Response({
                 'success': True,
@@ -838,7 +925,7 @@ class RemovePillItemView(APIView):
 # Admin Endpoints
 class AdminLovedProductListCreateView(generics.ListCreateAPIView):
     queryset = LovedProduct.objects.select_related(
-        'user', 'product'
+        'user', 'product', 'product__cover_image'
     ).prefetch_related('product__images')
     permission_classes = [IsAdminUser]
     serializer_class = AdminLovedProductSerializer
@@ -852,7 +939,7 @@ class AdminLovedProductListCreateView(generics.ListCreateAPIView):
     ordering = ['-created_at']
 
 class AdminLovedProductRetrieveDestroyView(generics.RetrieveDestroyAPIView):
-    queryset = LovedProduct.objects.select_related('user', 'product')
+    queryset = LovedProduct.objects.select_related('user', 'product', 'product__cover_image')
     serializer_class = AdminLovedProductSerializer
     lookup_field = 'pk'
     permission_classes = [IsAdminUser]
@@ -987,6 +1074,7 @@ class ProductImageBulkCreateView(generics.CreateAPIView):
             for image in images
         ]
         ProductImage.objects.bulk_create(product_images)
+        Product.assign_missing_covers([product.pk])
         return Response(
             {"message": "Images uploaded successfully."},
             status=status.HTTP_201_CREATED
@@ -1128,10 +1216,11 @@ from django.db.models import Prefetch
 
 class PillListCreateView(generics.ListCreateAPIView):
     serializer_class = PillCreateSerializer
-    filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, PillSearchFilter]
     filterset_class = PillFilter
-    search_fields = ['user__name', 'user__username', 'pill_number', 'user__parent_phone', 'shakeout_invoice_id', 'shakeout_invoice_ref', 'easypay_invoice_uid', 'easypay_invoice_sequence', 'easypay_fawry_ref']
+    search_fields = ['user__name', 'user__username', 'pill_number', 'user__parent_phone']
     pagination_class = CustomPageNumberPagination
+    cursor_ordering = ('-date_added', '-id')
     permission_classes = [IsAdminUser]
 
     def get_queryset(self):
@@ -1176,45 +1265,69 @@ class DiscountRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminUser]
 
 class CouponListCreateView(generics.ListCreateAPIView):
-    queryset = CouponDiscount.objects.all()
+    queryset = CouponDiscount.objects.prefetch_related('counter_shards')
     serializer_class = CouponDiscountSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = CouponDiscountFilter
     permission_classes = [IsAdminUser]
 
 class CouponRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = CouponDiscount.objects.all()
+    queryset = CouponDiscount.objects.prefetch_related('counter_shards')
     serializer_class = CouponDiscountSerializer
     permission_classes = [IsAdminUser]
 
 
+class _CSVBuffer:
+    """File-like object for csv.writer that hands each row back instead of storing it."""
+    def write(self, value):
+        return value
+
+
 class BulkCouponCreateView(generics.CreateAPIView):
-    """Create multiple coupons at once"""
+    """
+    Create multiple coupons at once (up to 50k) and stream them back as CSV
+    (id, coupon, discount_value, coupon_start, coupon_end, available_use_times,
+    user, min_order_value). The count is also in the X-Coupons-Created header.
+    """
     serializer_class = BulkCouponDiscountSerializer
     permission_classes = [IsAdminUser]
+    csv_columns = [
+        'id', 'coupon', 'discount_value', 'coupon_start', 'coupon_end',
+        'available_use_times', 'user', 'min_order_value',
+    ]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         coupons = serializer.save()
-        
-        # Return the created coupons using CouponDiscountSerializer
-        output_serializer = CouponDiscountSerializer(coupons, many=True)
-        return Response({
-            'success': True,
-            'message': f'{len(coupons)} coupons created successfully',
-            'count': len(coupons),
-            'coupons': output_serializer.data
-        }, status=status.HTTP_201_CREATED)
-
 
-class RatingListCreateView(generics.ListCreateAPIView):
+        response = StreamingHttpResponse(
+            self.csv_rows(coupons), content_type='text/csv; charset=utf-8', status=status.HTTP_201_CREATED
+        )
+        filename = f"coupons-{timezone.now():%Y%m%d-%H%M%S}.csv"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['X-Coupons-Created'] = str(len(coupons))
+        return response
+
+    def csv_rows(self, coupons):
+        writer = csv.writer(_CSVBuffer())
+        yield writer.writerow(self.csv_columns)
+        for coupon in coupons:
+            yield writer.writerow([
+                coupon.pk, coupon.coupon, coupon.discount_value,
+                coupon.coupon_start.isoformat() if coupon.coupon_start else '',
+                coupon.coupon_end.isoformat() if coupon.coupon_end else '',
+                coupon.available_use_times, coupon.user_id or '', coupon.min_order_value,
+            ])
+
+
+class RatingListCreateView(RatingAggregateMixin, generics.ListCreateAPIView):
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
     filterset_fields = ['product']
     permission_classes = [IsAdminUser]
 
-class RatingDetailView(generics.RetrieveUpdateDestroyAPIView):
+class RatingDetailView(RatingAggregateMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
     permission_classes = [IsAdminUser]
@@ -1290,6 +1403,44 @@ def create_shakeout_invoice_view(request, pill_id):
         return Response({'error': 'حدث خطأ أثناء إنشاء الفاتورة، يرجى المحاولة لاحقًا.'}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class CohortBookAssignmentView(APIView):
+    """
+    Dashboard endpoint to grant books to a whole cohort of students
+    POST /products/dashboard/cohort-assignments/
+
+    Request body (JSON or multipart):
+    {
+        "product_ids": [1, 2],
+        "year": "third-secondary",       // and/or division, government, user_type
+        "user_ids": [5, 6],              // optional explicit list
+        "phones": ["01012345678"],       // optional explicit list
+        "file": <upload>                 // optional, one id or phone per line
+    }
+
+    Returns 202 with the job; poll GET /products/dashboard/jobs/<id>/ for progress.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+
+    def post(self, request):
+        serializer = CohortAssignmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job = jobs.enqueue(ASSIGN_BOOKS_JOB, serializer.validated_data, user=request.user)
+        data = BackgroundJobSerializer(job).data
+        data['status_url'] = request.build_absolute_uri(reverse('products:admin-job-detail', args=[job.pk]))
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+
+class BackgroundJobDetailView(generics.RetrieveAPIView):
+    """
+    Progress and result of a background job
+    GET /products/dashboard/jobs/<id>/
+    """
+    queryset = BackgroundJob.objects.all()
+    serializer_class = BackgroundJobSerializer
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+
 class AddBooksToStudentView(APIView):
     """
     Dashboard endpoint to add a list of books directly to a student
@@ -1361,9 +1512,6 @@ class AddBooksToStudentView(APIView):
                         date_sold=timezone.now()
                     )
                     
-                    # Add to pill items
-                    pill.items.add(pill_item)
-                    
                     # Create PurchasedBook
                     purchased_book = PurchasedBook.objects.create(
                         user=user,
@@ -1434,6 +1582,7 @@ class AdminPurchasedBookListCreateView(generics.ListCreateAPIView):
     ordering_fields = ['created_at', 'product_name', 'user__username']
     ordering = ['-created_at']
     pagination_class = CustomPageNumberPagination
+    cursor_ordering = ('-created_at', '-id')
     
     def create(self, request, *args, **kwargs):
         user_id = request.data.get('user')
@@ -0,0 +1,151 @@
+"""
+Durable inbox for payment gateway webhooks.
+
+The webhook views only parse the callback, check its signature and store it
+as a ``WebhookInboxEntry``, then answer 200 straight away. Gateways retry
+callbacks that answer slowly, so the pill update, the library grant and the
+WhatsApp notification are applied later by ``manage.py drain_webhooks``:
+
+* A redelivered callback hits the (gateway, reference, event status) unique
+  index and is acknowledged without being stored again.
+* Entries are claimed with a conditional UPDATE in id order. An entry waits
+  while an older entry of the same invoice is still pending, so callbacks of
+  one pill are applied in the order they arrived.
+* A failing entry is retried with backoff (``jobs.backoff_delay``) and marked
+  failed after ``WEBHOOK_MAX_ATTEMPTS``.
+* An entry still ``processing`` ``WEBHOOK_PROCESSING_TIMEOUT`` seconds after
+  it was claimed belonged to a drainer that died. It is put back to
+  ``received`` (counting the attempt) so it, and the entries queued behind
+  it, are applied.
+"""
+import json
+import logging
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .jobs import backoff_delay
+from .models import WebhookInboxEntry
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_SECONDS = 10
+WEBHOOK_PROCESSING_TIMEOUT = 5 * 60
+# Not worth keeping next to the payload
+SKIPPED_HEADERS = {'cookie', 'authorization'}
+
+PROCESSORS = {
+    'easypay': 'products.easypay_webhooks.apply_easypay_webhook',
+    'shakeout': 'products.shakeout_webhooks.apply_shakeout_webhook',
+}
+
+
+def record_webhook(request, gateway, reference, event_status):
+    """Store a verified callback. Returns ``(entry, created)``; ``created`` is False for a redelivery."""
+    headers = {
+        name: value for name, value in request.headers.items() if name.lower() not in SKIPPED_HEADERS
+    }
+    try:
+        with transaction.atomic():
+            entry = WebhookInboxEntry.objects.create(
+                gateway=gateway,
+                reference=str(reference),
+                event_status=str(event_status),
+                body=request.body.decode('utf-8'),
+                headers=headers,
+            )
+        return entry, True
+    except IntegrityError:
+        entry = WebhookInboxEntry.objects.get(
+            gateway=gateway, reference=str(reference), event_status=str(event_status)
+        )
+        logger.info("Duplicate %s webhook for %s (%s) ignored", gateway, reference, event_status)
+        return entry, False
+
+
+def processing_cutoff():
+    return timezone.now() - timedelta(seconds=WEBHOOK_PROCESSING_TIMEOUT)
+
+
+def release_stale():
+    """Put entries abandoned mid-processing back in the inbox (or fail them). Returns how many."""
+    released = 0
+    stale = WebhookInboxEntry.objects.filter(status='processing', claimed_at__lt=processing_cutoff())
+    for entry_id, attempts in stale.values_list('id', 'attempts'):
+        attempts += 1
+        if attempts < WEBHOOK_MAX_ATTEMPTS:
+            changes = {'status': 'received', 'next_attempt_at': timezone.now()}
+        else:
+            changes = {'status': 'failed', 'processed_at': timezone.now()}
+        released += WebhookInboxEntry.objects.filter(
+            pk=entry_id, status='processing', claimed_at__lt=processing_cutoff()
+        ).update(attempts=attempts, error='Drainer stopped while applying the webhook', **changes)
+    if released:
+        logger.warning("Released %s webhook entries left processing by a stopped drainer", released)
+    return released
+
+
+def claim_next():
+    """Claim the oldest due entry whose invoice has no older entry still pending."""
+    release_stale()
+    earlier_pending = WebhookInboxEntry.objects.filter(
+        Q(status='received') | Q(status='processing', claimed_at__gte=processing_cutoff()),
+        gateway=OuterRef('gateway'),
+        reference=OuterRef('reference'),
+        id__lt=OuterRef('id'),
+    )
+    candidates = (
+        WebhookInboxEntry.objects.filter(status='received', next_attempt_at__lte=timezone.now())
+        .exclude(Exists(earlier_pending))
+        .order_by('id')
+        .values_list('id', flat=True)[:10]
+    )
+    for entry_id in candidates:
+        if WebhookInboxEntry.objects.filter(pk=entry_id, status='received').update(
+            status='processing', claimed_at=timezone.now()
+        ):
+            return WebhookInboxEntry.objects.get(pk=entry_id)
+    return None
+
+
+def process_entry(entry):
+    attempts = entry.attempts + 1
+    try:
+        apply = import_string(PROCESSORS[entry.gateway])
+        with transaction.atomic():
+            pill = apply(json.loads(entry.body))
+    except Exception as exc:
+        logger.exception("Webhook entry %s (%s %s) failed on attempt %s", entry.pk, entry.gateway, entry.reference, attempts)
+        if attempts < WEBHOOK_MAX_ATTEMPTS:
+            changes = {'status': 'received', 'next_attempt_at': timezone.now() + backoff_delay(attempts, WEBHOOK_RETRY_SECONDS)}
+        else:
+            changes = {'status': 'failed', 'processed_at': timezone.now()}
+        changes.update(attempts=attempts, error=str(exc))
+    else:
+        changes = {
+            'status': 'processed',
+            'attempts': attempts,
+            'error': '',
+            'pill': pill,
+            'processed_at': timezone.now(),
+        }
+    WebhookInboxEntry.objects.filter(pk=entry.pk).update(**changes)
+    for field, value in changes.items():
+        setattr(entry, field, value)
+    return entry
+
+
+def drain(limit=None):
+    """Apply due entries until none are left (or ``limit`` ran). Returns how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        entry = claim_next()
+        if entry is None:
+            break
+        process_entry(entry)
+        ran += 1
+    return ran
@@ -4,10 +4,9 @@ from typing import List, Union
 import requests
 from django.conf import settings
 
-logger = logging.getLogger(__name__)
-
-DEFAULT_TIMEOUT = 10
+from services import http_client
 
+logger = logging.getLogger(__name__)
 
 def _build_phone_list(phone_numbers: Union[str, List[str]]) -> List[str]:
     """Normalize phone numbers into a list of strings."""
@@ -45,7 +44,7 @@ def send_beon_sms(phone_numbers: Union[str, List[str]], message: str) -> dict:
     }
 
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=DEFAULT_TIMEOUT)
+        response = http_client.post(api_url, json=payload, headers=headers)
         response.raise_for_status()
         try:
             data = response.json()
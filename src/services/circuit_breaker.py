@@ -0,0 +1,115 @@
+"""
+Per-gateway circuit breakers, shared by all workers through the cache.
+
+Calls made with ``http_client.request(..., breaker='easypay')`` are counted
+in one-minute windows. When at least ``CIRCUIT_MIN_CALLS`` calls failed
+(connection errors, timeouts or 5xx answers) and the failure rate reaches
+``CIRCUIT_FAILURE_RATE``, the circuit opens: for ``CIRCUIT_COOLDOWN_SECONDS``
+every call fails at once with ``CircuitOpenError`` instead of waiting for
+the gateway's timeout. After the cooldown a single worker is let through as
+a probe (half-open); its success closes the circuit, its failure opens it
+again.
+"""
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+PROBE_TIMEOUT = 60
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling a gateway whose circuit is open."""
+
+    def __init__(self, name):
+        self.name = name
+        super().__init__(f'{name} is temporarily unavailable (circuit open), please try again shortly')
+
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.open_key = f'circuit:{name}:open_until'
+        self.probe_key = f'circuit:{name}:probe'
+
+    @property
+    def window(self):
+        return max(1, int(getattr(settings, 'CIRCUIT_WINDOW_SECONDS', 60)))
+
+    @property
+    def cooldown(self):
+        return int(getattr(settings, 'CIRCUIT_COOLDOWN_SECONDS', 30))
+
+    def _counter_keys(self):
+        bucket = int(time.time() // self.window)
+        return f'circuit:{self.name}:calls:{bucket}', f'circuit:{self.name}:failures:{bucket}'
+
+    def _incr(self, key):
+        # add() + incr() stays atomic on shared caches; the bucket expires on its own
+        cache.add(key, 0, self.window * 2)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, self.window * 2)
+            return 1
+
+    @property
+    def state(self):
+        open_until = cache.get(self.open_key)
+        if open_until is None:
+            return CLOSED
+        return OPEN if time.time() < open_until else HALF_OPEN
+
+    def allow_request(self):
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        # Half-open: only the worker that wins the probe key tries the gateway
+        return cache.add(self.probe_key, 1, PROBE_TIMEOUT)
+
+    def record_success(self):
+        if cache.get(self.open_key) is not None:
+            self.reset()
+            return
+        self._incr(self._counter_keys()[0])
+
+    def record_failure(self):
+        if cache.get(self.open_key) is not None:
+            # The half-open probe failed
+            self.trip()
+            return
+        calls_key, failures_key = self._counter_keys()
+        calls = self._incr(calls_key)
+        failures = self._incr(failures_key)
+        min_calls = int(getattr(settings, 'CIRCUIT_MIN_CALLS', 5))
+        rate = float(getattr(settings, 'CIRCUIT_FAILURE_RATE', 0.5))
+        if failures >= min_calls and failures / calls >= rate:
+            self.trip()
+
+    def trip(self):
+        cache.set(self.open_key, time.time() + self.cooldown, None)
+        cache.delete(self.probe_key)
+
+    def reset(self):
+        cache.delete_many([self.open_key, self.probe_key, *self._counter_keys()])
+
+
+_breakers = {}
+
+
+def get_breaker(name):
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+
+def is_available(name):
+    """Whether a call to ``name`` would be attempted now (does not take the probe)."""
+    return get_breaker(name).state != OPEN
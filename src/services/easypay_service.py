@@ -7,6 +7,7 @@ from django.core.cache import cache
 from datetime import datetime, timedelta
 from django.utils import timezone
 
+from services import http_client
 from services.customer_profile import get_customer_profile
 
 logger = logging.getLogger(__name__)
@@ -146,11 +147,11 @@ class EasyPayService:
             logger.info(f"  - Full payload: {json.dumps(payload, indent=2)}")
             
             # Make API request
-            response = requests.post(
+            response = http_client.post(
                 self.create_invoice_url,
                 headers=self.headers,
                 json=payload,
-                timeout=30
+                breaker='easypay'
             )
             
             logger.info(f"EasyPay API response status: {response.status_code}")
@@ -248,10 +249,10 @@ class EasyPayService:
             
             logger.info(f"Getting EasyPay invoice details from: {url}")
             
-            response = requests.get(
+            response = http_client.get(
                 url,
                 headers=self.headers,
-                timeout=30
+                breaker='easypay'
             )
             
             logger.info(f"EasyPay get invoice response status: {response.status_code}")
@@ -345,11 +346,11 @@ class EasyPayService:
             }
             
             # Make API request
-            response = requests.get(
+            response = http_client.get(
                 status_check_url,
                 params=params,
                 headers=self.headers,
-                timeout=30
+                breaker='easypay'
             )
             
             logger.info(f"EasyPay status check response status: {response.status_code}")
@@ -1,9 +1,9 @@
-import requests
 import json
 import logging
 from django.conf import settings
 from django.core.cache import cache
 
+from services import http_client
 from services.customer_profile import get_customer_profile
 
 logger = logging.getLogger(__name__)
@@ -139,11 +139,11 @@ class FawaterakPaymentService:
             logger.info(f"  Pending: {pending_url}")
             logger.info(f"  Fail: {fail_url}")
             
-            response = requests.post(
+            response = http_client.post(
                 self.create_invoice_url,
                 json=payload,
                 headers=headers,
-                timeout=30
+                breaker='fawaterak'
             )
             
             logger.info(f"Fawaterak response: {response.status_code} - {response.text}")
@@ -241,7 +241,12 @@ class FawaterakPaymentService:
                 for payload in payloads:
                     try:
                         logger.info(f"Trying invoice status: {url} with payload: {payload}")
-                        response = requests.post(url, json=payload, headers=headers, timeout=30)
+                        response = http_client.post(
+                            url,
+                            json=payload,
+                            headers=headers,
+                            breaker='fawaterak'
+                        )
                         
                         logger.info(f"Invoice status response: {response.status_code} - {response.text}")
                         
@@ -0,0 +1,119 @@
+"""
+Shared HTTP transport for the payment and messaging integrations.
+
+Every outbound call goes through a pooled ``requests.Session`` so the TCP/TLS
+connection to a gateway is kept alive and reused instead of being opened (and
+handshaken) per call. ``requests.Session`` is not guaranteed to be
+thread-safe, so each thread gets its own session; a session keeps up to
+``HTTP_POOL_MAXSIZE`` connections per host.
+
+Timeouts are always set, with the connect timeout kept short and separate
+from the read timeout. Failed connections and 429/5xx answers are retried
+with jittered exponential backoff; read errors and bad statuses are only
+retried for idempotent methods, so a POST that reached the gateway is never
+sent twice. A GET with side effects (the WhatsApp ``send-text`` API sends a
+message) passes ``idempotent=False`` to get the same treatment. Gateway
+calls pass ``breaker=`` to fail fast while that gateway is down (see
+``services.circuit_breaker``).
+"""
+import logging
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from services.circuit_breaker import CircuitOpenError, get_breaker
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_local = threading.local()
+
+
+def default_timeout():
+    """``(connect, read)`` seconds."""
+    return (
+        float(getattr(settings, 'HTTP_CONNECT_TIMEOUT', 5)),
+        float(getattr(settings, 'HTTP_READ_TIMEOUT', 30)),
+    )
+
+
+def build_session(idempotent=True):
+    """``idempotent=False`` only retries failed connections, never a request that was sent."""
+    retries = int(getattr(settings, 'HTTP_MAX_RETRIES', 3))
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries if idempotent else 0,
+        status=retries,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=RETRY_STATUSES if idempotent else (),
+        respect_retry_after_header=idempotent,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(getattr(settings, 'HTTP_POOL_CONNECTIONS', 10)),
+        pool_maxsize=int(getattr(settings, 'HTTP_POOL_MAXSIZE', 10)),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(idempotent=True):
+    """The calling thread's pooled session, created on first use."""
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    if idempotent not in sessions:
+        sessions[idempotent] = build_session(idempotent)
+    return sessions[idempotent]
+
+
+def reset_session():
+    """Drop the calling thread's sessions and close their pooled connections."""
+    for session in getattr(_local, 'sessions', {}).values():
+        session.close()
+    _local.sessions = {}
+
+
+def request(method, url, timeout=None, breaker=None, idempotent=True, **kwargs):
+    """
+    Send a request on the pooled session. With ``breaker`` (a gateway name)
+    the call goes through that gateway's circuit breaker and raises
+    ``CircuitOpenError`` straight away while the circuit is open. Pass
+    ``idempotent=False`` for calls that must not be repeated once sent.
+    """
+    session = get_session(idempotent)
+    if breaker is None:
+        return session.request(method, url, timeout=timeout or default_timeout(), **kwargs)
+
+    circuit = get_breaker(breaker)
+    if not circuit.allow_request():
+        logger.warning("Circuit for %s is open, not calling %s", breaker, url)
+        raise CircuitOpenError(breaker)
+    try:
+        response = session.request(method, url, timeout=timeout or default_timeout(), **kwargs)
+    except requests.RequestException:
+        circuit.record_failure()
+        raise
+    if response.status_code >= 500:
+        circuit.record_failure()
+    else:
+        circuit.record_success()
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)